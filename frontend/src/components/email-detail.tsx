@@ -38,6 +38,7 @@ interface Email {
   sender: string;
   category: string;
   suggested_response: string;
+  response_pending?: boolean;
   created_at: string;
   confidence_score: number;
 }
@@ -101,8 +102,8 @@ export function EmailDetail({ id }: EmailDetailProps) {
       const data = await response.json();
       console.log("Email carregado com sucesso:", data);
 
-      // Verificar se o email ainda está pendente
-      if (data.category === 'pending' && retryCount < 20) {
+      // Verificar se o email ainda está pendente (ou já classificado, com a resposta sendo gerada)
+      if ((data.category === 'pending' || data.response_pending) && retryCount < 20) {
         setIsPending(true);
         setRetryCount(prev => prev + 1);
         // Agendar nova verificação em 2 segundos
@@ -110,7 +111,7 @@ export function EmailDetail({ id }: EmailDetailProps) {
       } else {
         setIsPending(false);
         // Resetar contador quando processamento completo
-        if (data.category !== 'pending') {
+        if (data.category !== 'pending' && !data.response_pending) {
           setRetryCount(0);
         }
       }
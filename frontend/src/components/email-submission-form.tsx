@@ -42,6 +42,7 @@ export default function EmailSubmissionForm() {
     jobId?: string;
     position?: number;
     waitTime?: number;
+    waitTimeP90?: number;
   } | null>(null);
   const [inputMethod, setInputMethod] = useState("text");
   const fileInputRef = useRef<HTMLInputElement>(null);
@@ -291,14 +292,17 @@ export default function EmailSubmissionForm() {
               throw new Error(jobStatus.error_message || "Falha no processamento");
             case 'expired':
               throw new Error("Tempo limite de processamento excedido");
+            case 'cancelled':
+              throw new Error("Processamento cancelado");
           }
         },
         // Callback para atualizações sobre a fila
-        onQueueUpdate: ({ position, waitTime }) => {
+        onQueueUpdate: ({ position, waitTime, waitTimeP90 }) => {
           setProcessingStatus(prev => ({
             ...prev!,
             position,
             waitTime,
+            waitTimeP90,
             message: `Na fila: posição ${position}`,
           }));
         },
@@ -555,7 +559,10 @@ export default function EmailSubmissionForm() {
                 <span className="text-sm font-medium">{processingStatus.message}</span>
                 <span className="text-xs text-muted-foreground">
                   {processingStatus.status === "enfileirado" && processingStatus.waitTime &&
-                    `Espera estimada: ~${processingStatus.waitTime}s`}
+                    `Espera estimada: ~${processingStatus.waitTime}s` +
+                    (processingStatus.waitTimeP90 && processingStatus.waitTimeP90 > processingStatus.waitTime
+                      ? ` (até ${processingStatus.waitTimeP90}s)`
+                      : "")}
                 </span>
               </div>
               <Progress value={processingStatus.progress} className="h-2" />
@@ -100,6 +100,7 @@ export function QueueStatusDialog() {
         return <CheckCircle2 className="h-4 w-4 text-green-500" />;
       case 'failed':
       case 'expired':
+      case 'cancelled':
         return <XCircle className="h-4 w-4 text-red-500" />;
       default:
         return <Clock className="h-4 w-4" />;
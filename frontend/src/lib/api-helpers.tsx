@@ -9,33 +9,38 @@ export const API_URLS = {
   EMAILS_LIST: `${API_BASE_URL}/api/emails/`,
   EMAIL_DETAIL: (id: string) => `${API_BASE_URL}/api/emails/${id}/`,
   JOB_STATUS: (jobId: string) => `${API_BASE_URL}/api/jobs/${jobId}/`,
+  JOB_EVENTS: (jobId: string) => `${API_BASE_URL}/api/jobs/${jobId}/events/`,
 };
 
 // Tipos
 export interface JobStatus {
   id: string;
   job_type: string;
-  status: "queued" | "processing" | "completed" | "failed" | "expired";
+  status: "queued" | "processing" | "completed" | "failed" | "expired" | "cancelled";
   created_at: string;
   started_at: string | null;
   completed_at: string | null;
   position_in_queue: number;
   estimated_wait_time: number | null;
+  estimated_wait_time_p90?: number | null;
   has_result: boolean;
   has_error: boolean;
   error_message: string | null;
+  cancel_requested?: boolean;
   email?: {
     id: number;
     subject: string;
     category: string;
     confidence_score: number;
     is_processed: boolean;
+    response_pending?: boolean;
   };
 }
 
 export interface QueueUpdate {
   position: number;
   waitTime: number;
+  waitTimeP90?: number;
 }
 
 interface SubmitOptions {
@@ -102,14 +107,17 @@ export function validateFileForUpload(file: File): { isValid: boolean; error?: s
   return { isValid: true };
 }
 
+// Espera máxima de cada long-poll em api/jobs/<id>/?wait=N (o servidor limita a 30s)
+const LONG_POLL_SECONDS = 20;
+
 // Função para submeter email e aguardar o processamento
 export async function submitEmailAndWait(
   formData: FormData,
   options: SubmitOptions = {}
 ) {
   const {
-    maxAttempts = 60, // 1 minuto por padrão
-    interval = 1000, // 1 segundo entre verificações
+    maxAttempts = 60, // 1 minuto por padrão (maxAttempts * interval)
+    interval = 1000, // 1 segundo entre verificações quando não há long-poll
     onUpdate,
     onQueueUpdate,
   } = options;
@@ -129,6 +137,13 @@ export async function submitEmailAndWait(
     body: formData,
   });
 
+  // 429: a fila não atenderia o email a tempo agora; Retry-After (ou retry_after no corpo) diz quando tentar de novo
+  if (submitResponse.status === 429) {
+    const errorData = await submitResponse.json().catch(() => ({}));
+    const retryAfter = Number(submitResponse.headers.get('Retry-After')) || Number(errorData.retry_after) || 60;
+    throw new Error(`Fila cheia no momento. Tente novamente em ${Math.ceil(retryAfter / 60)} minuto(s).`);
+  }
+
   if (!submitResponse.ok) {
     const errorText = await submitResponse.text();
     try {
@@ -152,13 +167,24 @@ export async function submitEmailAndWait(
     onQueueUpdate({
       position: submitData.queue_position || 0,
       waitTime: submitData.estimated_wait || 0,
+      waitTimeP90: submitData.estimated_wait_p90 || 0,
     });
   }
 
-  // Poll para verificar o status até que esteja completo
-  for (let attempt = 0; attempt < maxAttempts; attempt++) {
+  // Long-poll: o servidor segura a requisição até o status mudar (ou ?wait
+  // segundos), então cada resposta traz uma mudança real em vez de um tick fixo.
+  const deadline = Date.now() + maxAttempts * interval;
+  let lastStatus: string | null = null;
+
+  while (Date.now() < deadline) {
     try {
-      const statusResponse = await fetch(API_URLS.JOB_STATUS(jobId));
+      const remaining = Math.ceil((deadline - Date.now()) / 1000);
+      const wait = Math.max(1, Math.min(LONG_POLL_SECONDS, remaining));
+      // Job concluído aguardando o email: o status não muda mais, então volta ao polling simples
+      const statusUrl = lastStatus && lastStatus !== 'completed'
+        ? `${API_URLS.JOB_STATUS(jobId)}?wait=${wait}&status=${lastStatus}`
+        : API_URLS.JOB_STATUS(jobId);
+      const statusResponse = await fetch(statusUrl);
 
       if (!statusResponse.ok) {
         console.error(`Erro ao verificar status: ${statusResponse.status}`);
@@ -166,6 +192,7 @@ export async function submitEmailAndWait(
       }
 
       const jobStatus: JobStatus = await statusResponse.json();
+      lastStatus = jobStatus.status;
 
       // Notificar sobre a atualização
       if (onUpdate) {
@@ -177,6 +204,7 @@ export async function submitEmailAndWait(
         onQueueUpdate({
           position: jobStatus.position_in_queue,
           waitTime: jobStatus.estimated_wait_time || 0,
+          waitTimeP90: jobStatus.estimated_wait_time_p90 || 0,
         });
       }
 
@@ -194,25 +222,35 @@ export async function submitEmailAndWait(
           // O job foi concluído, mas o email ainda pode estar em processamento
           console.log('Job concluído, aguardando processamento final do email...');
           // Continuar o polling para verificar o status do email
+          await new Promise(resolve => setTimeout(resolve, interval));
         }
       }
 
       // Verificar se houve algum erro
-      if (jobStatus.status === 'failed' || jobStatus.status === 'expired') {
+      if (jobStatus.status === 'failed' || jobStatus.status === 'expired' || jobStatus.status === 'cancelled') {
         throw new Error(jobStatus.error_message || `Job falhou com status: ${jobStatus.status}`);
       }
 
-      // Esperar o intervalo antes da próxima verificação
-      await new Promise(resolve => setTimeout(resolve, interval));
-
     } catch (error) {
       console.error('Erro ao verificar status:', error);
       throw error;
     }
   }
 
-  // Se chegamos aqui, atingimos o número máximo de tentativas
-  throw new Error(`Tempo limite excedido após ${maxAttempts} tentativas`);
+  // Se chegamos aqui, o prazo total de espera acabou
+  throw new Error(`Tempo limite excedido após ${Math.round((maxAttempts * interval) / 1000)}s`);
+}
+
+// Cancela um job (ex.: o usuário saiu da página ou reenviou o email corrigido).
+// Jobs na fila saem na hora; jobs em processamento param na próxima etapa.
+export async function cancelJob(jobId: string): Promise<JobStatus> {
+  const response = await fetch(API_URLS.JOB_STATUS(jobId), { method: 'DELETE' });
+
+  // 409: o job já tinha terminado, a resposta traz o status final
+  if (!response.ok && response.status !== 409) {
+    throw new Error(`Erro ao cancelar job: ${response.status}`);
+  }
+  return response.json();
 }
 
 export async function fetchWithTimeout(url: string, options: RequestInit = {}, timeout = 10000) {
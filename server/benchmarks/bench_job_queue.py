@@ -0,0 +1,69 @@
+"""
+Microbenchmark do despacho do JobQueue.
+
+Mede a latência entre o enqueue de um job e o início do seu manipulador
+(p50/p99) com os workers ociosos entre um job e outro, que é o caso comum
+em produção.
+
+Uso (a partir de server/):
+    python benchmarks/bench_job_queue.py --jobs 300 --workers 4
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classifier.job_queue import JobQueue, job_queue as default_queue  # noqa: E402
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run(num_jobs, num_workers, max_gap):
+    # A instância global não participa da medição
+    default_queue.stop_worker()
+    JobQueue._instance = None
+    queue = JobQueue(num_workers=num_workers)
+
+    latencies = []
+    lock = threading.Lock()
+    done = threading.Semaphore(0)
+
+    def handler(data):
+        started = time.perf_counter()
+        with lock:
+            latencies.append(started - data["enqueued_at"])
+        done.release()
+
+    queue.register_job_type("bench", handler)
+    time.sleep(0.2)  # deixa os workers chegarem ao estado ocioso
+
+    for _ in range(num_jobs):
+        queue.enqueue("bench", {"enqueued_at": time.perf_counter()})
+        time.sleep(random.uniform(0, max_gap))
+
+    for _ in range(num_jobs):
+        done.acquire()
+    queue.stop_worker()
+
+    ms = [v * 1000 for v in latencies]
+    print(f"jobs={num_jobs} workers={num_workers} gap<= {max_gap * 1000:.0f}ms")
+    print(f"enqueue->start  p50={percentile(ms, 50):.3f}ms  p99={percentile(ms, 99):.3f}ms  "
+          f"mean={statistics.mean(ms):.3f}ms  max={max(ms):.3f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=300)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-gap", type=float, default=0.02, help="intervalo máximo entre enqueues (s)")
+    args = parser.parse_args()
+    run(args.jobs, args.workers, args.max_gap)
@@ -0,0 +1,95 @@
+"""
+Microbenchmark do RateLimiter sob contenção.
+
+Várias threads chamam try_acquire/can_make_request/get_stats ao mesmo tempo
+com a cota configurada do Gemini e limites altos (o caminho de aceitação é o
+mais caro). Mede a vazão total, a latência por chamada (p50/p99) e confere que
+nenhuma rajada passou do limite por minuto. Com --backend shared o estado fica
+em um arquivo SQLite temporário, como entre os workers do gunicorn.
+
+Uso (a partir de server/):
+    python benchmarks/bench_rate_limiter.py --threads 16 --seconds 3
+    python benchmarks/bench_rate_limiter.py --backend shared --per-minute 600
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classifier.rate_limiter import LimiterState, RateLimiter, SQLiteLimiterState  # noqa: E402
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run(num_threads, seconds, per_minute, per_day, backend):
+    if backend == "shared":
+        state = SQLiteLimiterState("bench", os.path.join(tempfile.mkdtemp(), "rate_limits.sqlite3"))
+    else:
+        state = LimiterState()
+    limiter = RateLimiter(requests_per_minute=per_minute, requests_per_day=per_day, name="bench", state=state)
+
+    latencies = [[] for _ in range(num_threads)]
+    admitted = [0] * num_threads
+    start = threading.Barrier(num_threads + 1)
+    deadline = [0.0]
+
+    def hammer(slot):
+        acquire = limiter.try_acquire
+        calls = (acquire, limiter.can_make_request, acquire, limiter.get_stats)
+        own = latencies[slot]
+        start.wait()
+        i = 0
+        while time.perf_counter() < deadline[0]:
+            call = calls[i % len(calls)]
+            began = time.perf_counter()
+            result = call()
+            own.append(time.perf_counter() - began)
+            if call is acquire and result[0]:
+                admitted[slot] += 1
+            i += 1
+
+    threads = [threading.Thread(target=hammer, args=(n,)) for n in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    began = time.perf_counter()
+    deadline[0] = began + seconds
+    start.wait()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    # O estado do limiter não cresce com o número de requisições aceitas
+    state_bytes = sum(sys.getsizeof(getattr(limiter.state, field)) for field in LimiterState.FIELDS)
+
+    us = [v * 1e6 for own in latencies for v in own]
+    total_admitted = sum(admitted)
+    # Rajada inicial de per_minute e depois uma vaga a cada 60/per_minute segundos
+    allowed = per_minute + int(elapsed * per_minute / 60) + 1
+    print(f"threads={num_threads} segundos={elapsed:.2f} limite={per_minute}/min {per_day}/dia backend={backend}")
+    print(f"chamadas={len(us)} ({len(us) / elapsed:,.0f}/s)  "
+          f"p50={percentile(us, 50):.1f}us  p99={percentile(us, 99):.1f}us  mean={statistics.mean(us):.1f}us")
+    print(f"aceitas={total_admitted} (máximo permitido {allowed})  "
+          f"estado do limiter={state_bytes} bytes")
+    if total_admitted > allowed:
+        print("ERRO: o limite por minuto foi excedido")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--per-minute", type=int, default=60000)
+    parser.add_argument("--per-day", type=int, default=10 ** 9)
+    parser.add_argument("--backend", choices=("memory", "shared"), default="memory")
+    args = parser.parse_args()
+    run(args.threads, args.seconds, args.per_minute, args.per_day, args.backend)
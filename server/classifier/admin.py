@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Email
+from .models import Email, QueuedJob
 
 @admin.register(Email)
 class EmailAdmin(admin.ModelAdmin):
@@ -18,3 +18,12 @@ class EmailAdmin(admin.ModelAdmin):
             'fields': ('created_at', 'user_ip')
         }),
     )
+
+@admin.register(QueuedJob)
+class QueuedJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'job_type', 'status', 'priority', 'attempts', 'created_at', 'completed_at', 'lease_owner']
+    list_filter = ['status', 'job_type', 'dead_letter']
+    search_fields = ['id', 'job_type']
+    readonly_fields = ['id', 'job_type', 'priority', 'status', 'data', 'result', 'error', 'enqueued_at',
+                       'created_at', 'started_at', 'completed_at', 'lease_owner', 'lease_expires_at',
+                       'attempts', 'available_at']
@@ -1,11 +1,17 @@
 import os
 import google.generativeai as genai
 from dotenv import load_dotenv
+import asyncio
+import contextvars
 import json
 import logging
 import random
-from .rate_limiter import RateLimiter
-from .job_queue import job_queue
+import time
+import uuid
+from datetime import timedelta
+from google.api_core.exceptions import ResourceExhausted
+from .rate_limiter import RateLimiter, create_limiter_state
+from .job_queue import job_queue, content_hash, JobCancelled, JobStatus, RetryPolicy, RetryableJobError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -18,15 +24,53 @@ load_dotenv()
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 logger.info(f"GEMINI_API_KEY encontrada: {'Sim' if GEMINI_API_KEY else 'Não'}")
 
+# Cota de tokens de entrada por minuto: o Gemini limita tokens além de requisições,
+# e um documento inteiro cabe num único prompt (1.000.000 no free tier, usando 25% para folga)
+GEMINI_TOKENS_PER_MINUTE = int(os.getenv('GEMINI_TOKENS_PER_MINUTE', 250000))
+CHARS_PER_TOKEN = 4  # estimativa dos tokens do prompt antes da chamada
+
 # Criar rate limiter para a API do Gemini
 # 60 req/min e 60000 req/dia são os limites padrão para Google Gemini Free Tier
 # Vamos usar limites mais conservadores para garantir
+# O estado é compartilhado entre os workers do gunicorn: a cota é da chave, não do processo
+# No modo adaptativo a taxa começa em 20 req/min e se ajusta pelas respostas da API
+# (429 e latência) entre GEMINI_MIN_REQUESTS_PER_MINUTE e GEMINI_MAX_REQUESTS_PER_MINUTE
+GEMINI_ADAPTIVE_RATE = os.getenv('GEMINI_ADAPTIVE_RATE', 'True').lower() in ('true', '1', 't')
+# Parte de cada minuto garantida por classe de chamada, em ordem de prioridade: uma rajada
+# de documentos não empurra as classificações para a heurística. Documentos ficam abaixo
+# de todas e só usam o que as outras classes deixam livre
+GEMINI_CAPACITY_CLASSES = {
+    "classify": float(os.getenv('GEMINI_CLASSIFY_RESERVED', 0.3)),
+    "response": float(os.getenv('GEMINI_RESPONSE_RESERVED', 0.2)),
+}
 gemini_limiter = RateLimiter(
     requests_per_minute=20,  # 60 no free tier, usando 20 para folga
     requests_per_day=15000,  # 60000 no free tier, usando 15000 para folga
-    name="gemini"
+    name="gemini",
+    state=create_limiter_state("gemini"),
+    tokens_per_minute=GEMINI_TOKENS_PER_MINUTE,
+    adaptive=GEMINI_ADAPTIVE_RATE,
+    min_requests_per_minute=int(os.getenv('GEMINI_MIN_REQUESTS_PER_MINUTE', 5)),
+    max_requests_per_minute=int(os.getenv('GEMINI_MAX_REQUESTS_PER_MINUTE', 60)),
+    capacity_classes=GEMINI_CAPACITY_CLASSES
 )
 
+# O Gemini limita cada modelo separadamente: com GEMINI_DOCUMENT_LIMITER, as chamadas do
+# document_model têm um limiter próprio. Por padrão os dois modelos são o mesmo e dividem a cota
+if os.getenv('GEMINI_DOCUMENT_LIMITER', 'False').lower() in ('true', '1', 't'):
+    document_limiter = RateLimiter(
+        requests_per_minute=int(os.getenv('GEMINI_DOCUMENT_REQUESTS_PER_MINUTE', 10)),
+        requests_per_day=int(os.getenv('GEMINI_DOCUMENT_REQUESTS_PER_DAY', 5000)),
+        name="gemini-document",
+        state=create_limiter_state("gemini-document"),
+        tokens_per_minute=GEMINI_TOKENS_PER_MINUTE,
+        adaptive=GEMINI_ADAPTIVE_RATE,
+        min_requests_per_minute=int(os.getenv('GEMINI_MIN_REQUESTS_PER_MINUTE', 5)),
+        max_requests_per_minute=int(os.getenv('GEMINI_MAX_REQUESTS_PER_MINUTE', 60))
+    )
+else:
+    document_limiter = gemini_limiter
+
 if GEMINI_API_KEY:
     try:
         genai.configure(api_key=GEMINI_API_KEY)
@@ -36,23 +80,78 @@ if GEMINI_API_KEY:
 else:
     logger.warning("Chave API do Gemini não encontrada, usando fallback para todas as operações")
 
-# Global variable to store classification confidence
-classification_confidence = 0.0
+# Confiança da última classificação, por contexto: cada worker thread e cada job
+# assíncrono do event loop lê apenas a confiança que ele mesmo calculou
+_classification_confidence = contextvars.ContextVar('classification_confidence', default=0.0)
+
+def get_classification_confidence():
+    """Retorna a confiança da última classificação feita nesta thread (ou tarefa assíncrona)"""
+    return _classification_confidence.get()
+
+def _set_classification_confidence(value):
+    _classification_confidence.set(value)
 
 # Set up models - usando versão mais recente do modelo
 text_model = "gemini-1.5-flash"    # For basic classification and responses
 pro_model = "gemini-1.5-pro"       # For more complex reasoning tasks
 document_model = "gemini-1.5-flash"  # For document processing
 
-def classify_email(subject, content):
-    """
-    Classifies an email as productive or unproductive using Gemini AI.
-    """
-    global classification_confidence
+def _estimate_tokens(prompt):
+    """Tokens de entrada estimados do prompt, cobrados no rate limiter antes da chamada"""
+    return len(prompt) // CHARS_PER_TOKEN + 1
+
+def _limiter_for(capacity_class):
+    """Rate limiter das chamadas da classe: documentos usam o do document_model"""
+    return document_limiter if capacity_class == "document" else gemini_limiter
+
+def _gemini_unavailable(reason, tokens=0, capacity_class=None):
+    """Erro temporário para jobs da fila, com a espera sugerida pelo rate limiter"""
+    _, wait_time = _limiter_for(capacity_class).can_make_request(tokens, capacity_class)
+    return RetryableJobError(reason, retry_after=wait_time or None)
 
+async def _wait_for_gemini(tokens=0, capacity_class=None):
+    """Rate limiting dos handlers assíncronos: espera sem bloquear o event loop"""
+    if not await _limiter_for(capacity_class).wait_if_needed_async(tokens, capacity_class):
+        raise await asyncio.to_thread(_gemini_unavailable, "Rate limit excedido para o Gemini API", tokens, capacity_class)
+
+def _generate(model, prompt, estimated_tokens, capacity_class=None, **kwargs):
+    """Chama o Gemini e informa o resultado (latência ou 429) ao rate limiter"""
+    limiter = _limiter_for(capacity_class)
+    started = time.monotonic()
+    try:
+        response = model.generate_content(prompt, **kwargs)
+    except ResourceExhausted:
+        limiter.report_throttled()
+        raise
+    _log_gemini_usage(limiter, response, estimated_tokens, time.monotonic() - started)
+    return response
+
+async def _generate_async(model, prompt, estimated_tokens, capacity_class=None, **kwargs):
+    """Versão de _generate para os handlers assíncronos; as transações do rate limiter rodam fora do event loop"""
+    limiter = _limiter_for(capacity_class)
+    started = time.monotonic()
+    try:
+        response = await model.generate_content_async(prompt, **kwargs)
+    except ResourceExhausted:
+        await asyncio.to_thread(limiter.report_throttled)
+        raise
+    await asyncio.to_thread(_log_gemini_usage, limiter, response, estimated_tokens, time.monotonic() - started)
+    return response
+
+def _log_gemini_usage(limiter, response, estimated_tokens, latency):
+    """Acerta os tokens estimados com o usage_metadata da resposta, informa a latência e faz o log de uso (uma transação no limiter)"""
+    usage = getattr(response, 'usage_metadata', None)
+    stats = limiter.report_response(latency, estimated_tokens,
+                                    getattr(usage, 'prompt_token_count', None),
+                                    getattr(usage, 'total_token_count', None))
+    logger.debug(f"Uso da API Gemini ({limiter.name}): {stats['day_usage']}/{limiter.requests_per_day} requisições hoje, "
+                 f"{stats['token_minute_usage']}/{limiter.tokens_per_minute} tokens no minuto, "
+                 f"taxa de {limiter.requests_per_minute:.2f} req/min")
+
+def _classification_prompt(subject, content):
     full_content = f"Assunto: {subject}\n\nConteúdo: {content}"
 
-    prompt = f"""
+    return f"""
     Analise o seguinte email e classifique-o como:
     - 'productive' (emails que requerem ação, contêm problemas, perguntas, solicitações, questões técnicas ou assuntos relacionados ao trabalho)
     - 'unproductive' (emails de parabéns, notas de agradecimento, boletins informativos, convites, elogios)
@@ -70,56 +169,93 @@ def classify_email(subject, content):
     Formato: "classificação|valor_confiança"
     """
 
+def _parse_classification(text):
+    """Extrai a categoria da resposta "classificação|valor_confiança" e registra a confiança"""
+    logger.info(f"Resposta bruta da IA para classificação: {text}")
+
+    classification_text = text.strip()
+
+    parts = classification_text.split('|')
+    if len(parts) == 2:
+        category = parts[0].strip().lower()
+        try:
+            confidence = float(parts[1].strip())
+            _set_classification_confidence(confidence)
+        except ValueError:
+            _set_classification_confidence(75.0)
+    else:
+        if "productive" in classification_text.lower():
+            category = "productive"
+        else:
+            category = "unproductive"
+        _set_classification_confidence(75.0)
+
+    logger.info(f"Categoria detectada: {category} com confiança {get_classification_confidence()}")
+    return category
+
+def classify_email(subject, content, fallback=True):
+    """
+    Classifies an email as productive or unproductive using Gemini AI.
+
+    Com fallback=False (jobs da fila), falhas temporárias do Gemini levantam
+    RetryableJobError em vez de cair na classificação heurística.
+    """
+    prompt = _classification_prompt(subject, content)
+    tokens = _estimate_tokens(prompt)
+
     try:
         if not GEMINI_API_KEY:
             logger.warning("API key do Gemini não está configurada. Usando classificação heurística.")
             return _heuristic_classification(subject, content)
 
         # Verificar rate limiting antes de fazer a chamada
-        if not gemini_limiter.wait_if_needed():
+        if not gemini_limiter.wait_if_needed(tokens, "classify"):
+            if not fallback:
+                raise _gemini_unavailable("Rate limit excedido para o Gemini API", tokens, "classify")
             logger.warning("Rate limit excedido para o Gemini API, usando classificação heurística.")
             return _heuristic_classification(subject, content)
 
         model = genai.GenerativeModel(text_model)
         logger.info(f"Iniciando classificação com modelo {text_model}")
-        response = model.generate_content(prompt)
+        response = _generate(model, prompt, tokens, "classify")
 
-        # Log de estatísticas de uso
-        stats = gemini_limiter.get_stats()
-        logger.info(f"Uso da API Gemini: {stats['day_usage']}/{stats['day_limit']} requisições hoje ({stats['day_percent']:.1f}%)")
+        return _parse_classification(response.text)
 
-        logger.info(f"Resposta bruta da IA para classificação: {response.text}")
-
-        classification_text = response.text.strip()
+    except RetryableJobError:
+        raise
+    except Exception as e:
+        logger.error(f"Error classifying email with Gemini: {str(e)}")
+        if not fallback:
+            raise RetryableJobError(f"Erro ao classificar email com Gemini: {e}") from e
+        return _heuristic_classification(subject, content)
 
-        parts = classification_text.split('|')
-        if len(parts) == 2:
-            category = parts[0].strip().lower()
-            try:
-                confidence = float(parts[1].strip())
-                classification_confidence = confidence
-            except ValueError:
-                classification_confidence = 75.0
-        else:
-            if "productive" in classification_text.lower():
-                category = "productive"
-            else:
-                category = "unproductive"
-            classification_confidence = 75.0
+async def classify_email_async(subject, content):
+    """
+    Versão assíncrona de classify_email para os jobs da fila (equivale a fallback=False):
+    a chamada ao Gemini não ocupa uma thread enquanto espera a resposta.
+    """
+    if not GEMINI_API_KEY:
+        logger.warning("API key do Gemini não está configurada. Usando classificação heurística.")
+        return _heuristic_classification(subject, content)
 
-        logger.info(f"Categoria detectada: {category} com confiança {classification_confidence}")
-        return category
+    prompt = _classification_prompt(subject, content)
+    tokens = _estimate_tokens(prompt)
+    await _wait_for_gemini(tokens, "classify")
 
+    try:
+        model = genai.GenerativeModel(text_model)
+        logger.info(f"Iniciando classificação com modelo {text_model}")
+        response = await _generate_async(model, prompt, tokens, "classify")
+        return _parse_classification(response.text)
     except Exception as e:
         logger.error(f"Error classifying email with Gemini: {str(e)}")
-        return _heuristic_classification(subject, content)
+        raise RetryableJobError(f"Erro ao classificar email com Gemini: {e}") from e
 
 def _heuristic_classification(subject, content):
     """
     Fallback classification method using keyword heuristics.
     """
-    global classification_confidence
-    classification_confidence = 75.0
+    _set_classification_confidence(75.0)
 
     logger.info("Usando classificação heurística baseada em palavras-chave")
 
@@ -155,6 +291,137 @@ def _heuristic_classification(subject, content):
         logger.info(f"Classificado como produtivo: {produtivo_count} palavras-chave produtivas vs {improdutivo_count} improdutivas")
         return 'productive'
 
+def classify_emails_batch(emails, fallback=True):
+    """
+    Classifica vários emails com uma única chamada ao Gemini.
+
+    Args:
+        emails: lista de dicionários com subject e content
+        fallback: se False, falhas temporárias levantam RetryableJobError e emails
+            sem resposta válida recebem um RetryableJobError no lugar do resultado
+
+    Returns:
+        Lista, na mesma ordem, de dicionários com category e confidence_score
+    """
+    prompt = _batch_classification_prompt(emails)
+    parsed = {}
+    tokens = _estimate_tokens(prompt)
+    try:
+        if not GEMINI_API_KEY:
+            logger.warning("API key do Gemini não está configurada. Usando classificação heurística.")
+        # Um único lote consome uma única requisição do rate limiter (e os tokens de todos os emails)
+        elif not gemini_limiter.wait_if_needed(tokens, "classify"):
+            if not fallback:
+                raise _gemini_unavailable("Rate limit excedido para o Gemini API", tokens, "classify")
+            logger.warning("Rate limit excedido para o Gemini API, usando classificação heurística.")
+        else:
+            model = genai.GenerativeModel(text_model)
+            logger.info(f"Iniciando classificação de {len(emails)} emails em lote com modelo {text_model}")
+            response = _generate(
+                model, prompt, tokens, "classify",
+                generation_config={"response_mime_type": "application/json"}
+            )
+            logger.info(f"Resposta bruta da IA para classificação em lote: {response.text}")
+            parsed = _parse_batch_classification(response.text, len(emails))
+    except RetryableJobError:
+        raise
+    except Exception as e:
+        logger.error(f"Error classifying email batch with Gemini: {str(e)}")
+        if not fallback:
+            raise RetryableJobError(f"Erro ao classificar lote com Gemini: {e}") from e
+
+    return _batch_results(emails, parsed, fallback)
+
+async def classify_emails_batch_async(emails):
+    """
+    Versão assíncrona de classify_emails_batch para os lotes da fila (equivale a fallback=False):
+    nem a espera pelo rate limiter nem a chamada ao Gemini ocupam uma thread.
+    """
+    prompt = _batch_classification_prompt(emails)
+    parsed = {}
+    tokens = _estimate_tokens(prompt)
+    if not GEMINI_API_KEY:
+        logger.warning("API key do Gemini não está configurada. Usando classificação heurística.")
+    else:
+        await _wait_for_gemini(tokens, "classify")
+        try:
+            model = genai.GenerativeModel(text_model)
+            logger.info(f"Iniciando classificação de {len(emails)} emails em lote com modelo {text_model}")
+            response = await _generate_async(
+                model, prompt, tokens, "classify",
+                generation_config={"response_mime_type": "application/json"}
+            )
+            logger.info(f"Resposta bruta da IA para classificação em lote: {response.text}")
+            parsed = _parse_batch_classification(response.text, len(emails))
+        except Exception as e:
+            logger.error(f"Error classifying email batch with Gemini: {str(e)}")
+            raise RetryableJobError(f"Erro ao classificar lote com Gemini: {e}") from e
+
+    return _batch_results(emails, parsed, fallback=False)
+
+def _batch_classification_prompt(emails):
+    listing = "\n\n".join(
+        f"[{index}] Assunto: {email.get('subject', '')}\nConteúdo: {email.get('content', '')}"
+        for index, email in enumerate(emails)
+    )
+
+    return f"""
+    Analise cada um dos emails abaixo e classifique-o como:
+    - 'productive' (emails que requerem ação, contêm problemas, perguntas, solicitações, questões técnicas ou assuntos relacionados ao trabalho)
+    - 'unproductive' (emails de parabéns, notas de agradecimento, boletins informativos, convites, elogios)
+
+    Emails para analisar (cada um começa com seu número entre colchetes):
+    {listing}
+
+    Regras para classificação:
+    - Emails sobre reuniões, agendamentos ou disponibilidade devem sempre ser classificados como 'productive'
+    - Emails com problemas técnicos, solicitações de suporte ou perguntas são 'productive'
+    - Emails contendo principalmente elogios, parabéns ou conteúdo social são 'unproductive'
+    - Em caso de dúvida, incline-se para a classificação 'productive'
+
+    Responda APENAS com um array JSON com um objeto por email, no formato:
+    [{{"id": 0, "category": "productive", "confidence": 90}}]
+    """
+
+def _batch_results(emails, parsed, fallback):
+    """Resultados do lote na ordem dos emails; os que a IA não respondeu caem na heurística (ou em RetryableJobError)"""
+    results = []
+    for index, email in enumerate(emails):
+        if index not in parsed and GEMINI_API_KEY and not fallback:
+            results.append(RetryableJobError("Email sem classificação válida na resposta do lote"))
+            continue
+        if index not in parsed:
+            # Emails que a IA não respondeu caem na heurística individualmente
+            category = _heuristic_classification(email.get('subject', ''), email.get('content', ''))
+            parsed[index] = {'category': category, 'confidence_score': get_classification_confidence()}
+        results.append(parsed[index])
+    return results
+
+def _parse_batch_classification(text, count):
+    """Extrai {índice: {category, confidence_score}} da resposta JSON de um lote"""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        text = text[text.find('['):]
+
+    parsed = {}
+    for item in json.loads(text):
+        try:
+            index = int(item.get('id'))
+        except (TypeError, ValueError):
+            continue
+
+        category = str(item.get('category', '')).strip().lower()
+        if not 0 <= index < count or category not in ('productive', 'unproductive'):
+            continue
+
+        try:
+            confidence = float(item.get('confidence', 75.0))
+        except (TypeError, ValueError):
+            confidence = 75.0
+        parsed[index] = {'category': category, 'confidence_score': confidence}
+    return parsed
+
 # Funções de detecção de contexto para a geração de resposta
 def _is_meeting_related(subject, content):
     text_lower = (subject + " " + content).lower()
@@ -188,41 +455,26 @@ def _contains_feedback(subject, content):
                        "impressão", "achei", "penso", "considero", "sugestão"]
     return any(keyword in text_lower for keyword in feedback_keywords)
 
-def suggest_response(subject, content, category):
-    """
-    Gera uma resposta sugerida para o email usando Gemini AI.
-    """
-    # Detectar o contexto do email
+def _response_context(subject, content):
+    """Detecta o contexto do email para o prompt e a resposta pré-definida: (é reunião, tipo de contexto)"""
     is_meeting_context = _is_meeting_related(subject, content)
-    is_tech_support = _is_tech_support_related(subject, content)
-    is_project_update = _is_project_related(subject, content)
-    is_request = _is_request_related(subject, content)
-    is_feedback = _contains_feedback(subject, content)
 
     context_type = "geral"
     if is_meeting_context:
         context_type = "reunião"
-    elif is_tech_support:
+    elif _is_tech_support_related(subject, content):
         context_type = "suporte técnico"
-    elif is_project_update:
+    elif _is_project_related(subject, content):
         context_type = "projeto"
-    elif is_request:
+    elif _is_request_related(subject, content):
         context_type = "solicitação"
-    elif is_feedback:
+    elif _contains_feedback(subject, content):
         context_type = "feedback"
 
-    logger.info(f"Gerando resposta para email - categoria: {category}, contexto: {context_type}")
+    return is_meeting_context, context_type
 
-    if not GEMINI_API_KEY:
-        logger.warning("API key do Gemini não está configurada. Usando resposta pré-definida.")
-        return _fallback_response(category, is_meeting_context, context_type)
-
-    # Verificar rate limiting antes de fazer a chamada
-    if not gemini_limiter.wait_if_needed():
-        logger.warning("Rate limit excedido para o Gemini API, usando resposta pré-definida.")
-        return _fallback_response(category, is_meeting_context, context_type)
-
-    # Criar prompt baseado no contexto e categoria
+def _response_prompt(subject, content, category, is_meeting_context, context_type):
+    """Cria o prompt de geração de resposta baseado no contexto e categoria"""
     if category == 'unproductive':
         prompt = f"""
         Você é um assistente de atendimento profissional. Crie uma resposta formal para este email que contém feedback positivo/elogio:
@@ -258,7 +510,7 @@ def suggest_response(subject, content, category):
         - Responda em português usando português brasileiro formal
         - Entre 4-7 linhas de conteúdo para cobrir os principais pontos
         """
-    elif is_tech_support:
+    elif context_type == "suporte técnico":
         prompt = f"""
         Você é um representante de suporte técnico profissional. Crie uma resposta formal para este email contendo uma questão técnica:
 
@@ -277,7 +529,7 @@ def suggest_response(subject, content, category):
         - Responda em português usando português brasileiro formal
         - Entre 5-8 linhas de conteúdo para demonstrar atenção ao caso
         """
-    elif is_project_update:
+    elif context_type == "projeto":
         prompt = f"""
         Você é um gerente de projetos profissional. Crie uma resposta formal para este email sobre atualização de projeto:
 
@@ -315,26 +567,51 @@ def suggest_response(subject, content, category):
         - Entre 4-6 linhas de conteúdo para demonstrar atenção adequada
         """
 
+    return prompt
+
+# Parâmetros de geração das respostas sugeridas
+RESPONSE_GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 1024,
+}
+
+def suggest_response(subject, content, category, fallback=True):
+    """
+    Gera uma resposta sugerida para o email usando Gemini AI.
+
+    Com fallback=False (jobs da fila), falhas temporárias do Gemini levantam
+    RetryableJobError em vez de usar a resposta pré-definida.
+    """
+    # Detectar o contexto do email
+    is_meeting_context, context_type = _response_context(subject, content)
+
+    logger.info(f"Gerando resposta para email - categoria: {category}, contexto: {context_type}")
+
+    if not GEMINI_API_KEY:
+        logger.warning("API key do Gemini não está configurada. Usando resposta pré-definida.")
+        return _fallback_response(category, is_meeting_context, context_type)
+
+    prompt = _response_prompt(subject, content, category, is_meeting_context, context_type)
+    tokens = _estimate_tokens(prompt)
+
+    # Verificar rate limiting antes de fazer a chamada
+    if not gemini_limiter.wait_if_needed(tokens, "response"):
+        if not fallback:
+            raise _gemini_unavailable("Rate limit excedido para o Gemini API", tokens, "response")
+        logger.warning("Rate limit excedido para o Gemini API, usando resposta pré-definida.")
+        return _fallback_response(category, is_meeting_context, context_type)
+
     try:
         logger.info("Enviando prompt para a API Gemini")
 
         model = genai.GenerativeModel(text_model)
-        generation_config = {
-            "temperature": 0.7,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 1024,
-        }
-
-        response = model.generate_content(
-            prompt,
-            generation_config=generation_config
+        response = _generate(
+            model, prompt, tokens, "response",
+            generation_config=RESPONSE_GENERATION_CONFIG
         )
 
-        # Log de estatísticas de uso
-        stats = gemini_limiter.get_stats()
-        logger.info(f"Uso da API Gemini: {stats['day_usage']}/{stats['day_limit']} requisições hoje ({stats['day_percent']:.1f}%)")
-
         logger.info("Resposta recebida da API Gemini")
 
         processed_response = post_process_response(response.text, category, is_meeting_context, context_type)
@@ -343,8 +620,38 @@ def suggest_response(subject, content, category):
 
     except Exception as e:
         logger.error(f"Erro ao gerar resposta com Gemini: {str(e)}")
+        if not fallback:
+            raise RetryableJobError(f"Erro ao gerar resposta com Gemini: {e}") from e
         return _fallback_response(category, is_meeting_context, context_type)
 
+async def suggest_response_async(subject, content, category):
+    """
+    Versão assíncrona de suggest_response para os jobs da fila (equivale a fallback=False):
+    a chamada ao Gemini não ocupa uma thread enquanto espera a resposta.
+    """
+    is_meeting_context, context_type = _response_context(subject, content)
+
+    logger.info(f"Gerando resposta para email - categoria: {category}, contexto: {context_type}")
+
+    if not GEMINI_API_KEY:
+        logger.warning("API key do Gemini não está configurada. Usando resposta pré-definida.")
+        return _fallback_response(category, is_meeting_context, context_type)
+
+    prompt = _response_prompt(subject, content, category, is_meeting_context, context_type)
+    tokens = _estimate_tokens(prompt)
+    await _wait_for_gemini(tokens, "response")
+
+    try:
+        model = genai.GenerativeModel(text_model)
+        response = await _generate_async(
+            model, prompt, tokens, "response",
+            generation_config=RESPONSE_GENERATION_CONFIG
+        )
+        return post_process_response(response.text, category, is_meeting_context, context_type)
+    except Exception as e:
+        logger.error(f"Erro ao gerar resposta com Gemini: {str(e)}")
+        raise RetryableJobError(f"Erro ao gerar resposta com Gemini: {e}") from e
+
 def post_process_response(response, category=None, is_meeting=False, context_type="geral"):
     """
     Ensures response is well-formatted, professional and relevant.
@@ -419,21 +726,8 @@ def _fallback_response(category, is_meeting=False, context_type="geral"):
     else:
         return f"Prezado(a),\n\nAgradecemos por entrar em contato. Recebemos sua solicitação e ela foi registrada em nosso sistema.\n\nSua mensagem já foi encaminhada para o departamento responsável, que irá analisá-la e retornar com uma resposta em até 48 horas úteis.\n\nCaso tenha alguma informação adicional relevante, por favor responda a este email mencionando o número de protocolo abaixo.\n\nAtenciosamente,\nEquipe de Atendimento\n\nProtocolo: {protocol}"
 
-def process_document(file_content, file_type):
-    """
-    Process document content and extract relevant information.
-    """
-    try:
-        if not GEMINI_API_KEY:
-            logger.warning("API key do Gemini não está configurada. Usando extração básica.")
-            return _extract_basic_info(file_content)
-
-        # Verificar rate limiting antes de fazer a chamada
-        if not gemini_limiter.wait_if_needed():
-            logger.warning("Rate limit excedido para o Gemini API, usando extração básica.")
-            return _extract_basic_info(file_content)
-
-        prompt = f"""
+def _document_prompt(file_content):
+    return f"""
         Extract the following information from this email document:
         1. Email subject line
         2. Email body text
@@ -450,37 +744,84 @@ def process_document(file_content, file_type):
         }}
         """
 
-        model = genai.GenerativeModel(document_model)
-        response = model.generate_content(prompt)
+def _parse_document(response_text, file_content):
+    """Extrai subject, content e sender do JSON da resposta; sem JSON válido, usa a extração básica"""
+    try:
+        start_idx = response_text.find('{')
+        end_idx = response_text.rfind('}') + 1
+
+        if start_idx >= 0 and end_idx > start_idx:
+            json_str = response_text[start_idx:end_idx]
+            extracted_data = json.loads(json_str)
+
+            return {
+                "subject": extracted_data.get("subject", "No subject extracted"),
+                "content": extracted_data.get("content", "No content extracted"),
+                "sender": extracted_data.get("sender", "noreply@example.com")
+            }
+        else:
+            return _extract_basic_info(file_content)
 
-        # Log de estatísticas de uso
-        stats = gemini_limiter.get_stats()
-        logger.info(f"Uso da API Gemini: {stats['day_usage']}/{stats['day_limit']} requisições hoje ({stats['day_percent']:.1f}%)")
+    except json.JSONDecodeError:
+        return _extract_basic_info(file_content)
 
-        try:
-            response_text = response.text
-            start_idx = response_text.find('{')
-            end_idx = response_text.rfind('}') + 1
-
-            if start_idx >= 0 and end_idx > start_idx:
-                json_str = response_text[start_idx:end_idx]
-                extracted_data = json.loads(json_str)
-
-                return {
-                    "subject": extracted_data.get("subject", "No subject extracted"),
-                    "content": extracted_data.get("content", "No content extracted"),
-                    "sender": extracted_data.get("sender", "noreply@example.com")
-                }
-            else:
-                return _extract_basic_info(file_content)
-
-        except json.JSONDecodeError:
+def process_document(file_content, file_type, fallback=True):
+    """
+    Process document content and extract relevant information.
+
+    Com fallback=False (jobs da fila), falhas temporárias do Gemini levantam
+    RetryableJobError em vez de cair na extração básica.
+    """
+    try:
+        if not GEMINI_API_KEY:
+            logger.warning("API key do Gemini não está configurada. Usando extração básica.")
             return _extract_basic_info(file_content)
 
+        # O documento inteiro vai no prompt: o custo em tokens é o que mais pesa aqui
+        prompt = _document_prompt(file_content)
+        tokens = _estimate_tokens(prompt)
+
+        # Verificar rate limiting antes de fazer a chamada
+        if not document_limiter.wait_if_needed(tokens, "document"):
+            if not fallback:
+                raise _gemini_unavailable("Rate limit excedido para o Gemini API", tokens, "document")
+            logger.warning("Rate limit excedido para o Gemini API, usando extração básica.")
+            return _extract_basic_info(file_content)
+
+        model = genai.GenerativeModel(document_model)
+        response = _generate(model, prompt, tokens, "document")
+
+        return _parse_document(response.text, file_content)
+
+    except RetryableJobError:
+        raise
     except Exception as e:
         logger.error(f"Error processing document with Gemini: {str(e)}")
+        if not fallback:
+            raise RetryableJobError(f"Erro ao processar documento com Gemini: {e}") from e
         return _extract_basic_info(file_content)
 
+async def process_document_async(file_content, file_type):
+    """
+    Versão assíncrona de process_document para os jobs da fila (equivale a fallback=False):
+    a chamada ao Gemini não ocupa uma thread enquanto espera a resposta.
+    """
+    if not GEMINI_API_KEY:
+        logger.warning("API key do Gemini não está configurada. Usando extração básica.")
+        return _extract_basic_info(file_content)
+
+    prompt = _document_prompt(file_content)
+    tokens = _estimate_tokens(prompt)
+    await _wait_for_gemini(tokens, "document")
+
+    try:
+        model = genai.GenerativeModel(document_model)
+        response = await _generate_async(model, prompt, tokens, "document")
+        return _parse_document(response.text, file_content)
+    except Exception as e:
+        logger.error(f"Error processing document with Gemini: {str(e)}")
+        raise RetryableJobError(f"Erro ao processar documento com Gemini: {e}") from e
+
 def _extract_basic_info(text):
     """
     Basic fallback extraction of email parts when AI fails.
@@ -502,6 +843,9 @@ def _extract_basic_info(text):
         "sender": sender
     }
 
+# Texto da resposta sugerida enquanto o estágio de resposta do email não termina
+RESPONSE_PENDING = "Gerando resposta..."
+
 # Função para atualizar o email no banco quando o job for concluído
 def update_email_with_results(email_id, results):
     """
@@ -509,103 +853,272 @@ def update_email_with_results(email_id, results):
 
     Args:
         email_id: ID do email no banco de dados
-        results: Dicionário com os resultados de classificação (category, confidence_score, suggested_response)
+        results: Dicionário com os resultados de classificação (category, confidence_score, suggested_response);
+            só os campos presentes são gravados, então cada estágio do pipeline grava o seu
     """
+    fields = [field for field in ('category', 'confidence_score', 'suggested_response') if field in results]
     try:
         # Importar o modelo dentro da função para evitar importação circular
         from .models import Email
         email = Email.objects.get(pk=email_id)
 
-        email.category = results.get('category', 'unknown')
-        email.confidence_score = results.get('confidence_score', 0.0)
-        email.suggested_response = results.get('suggested_response', '')
-        email.save()
+        for field in fields:
+            setattr(email, field, results[field])
+        email.save(update_fields=fields)
 
-        logger.info(f"Email ID {email_id} atualizado com sucesso com os resultados da IA")
+        logger.info(f"Email ID {email_id} atualizado com sucesso com os resultados da IA ({', '.join(fields)})")
         return True
     except Exception as e:
         logger.error(f"Erro ao atualizar email ID {email_id} com resultados: {str(e)}")
         return False
 
-# Função para processar email completo e atualizar no banco
-def process_email_and_update(email_data, email_id):
+# Estágios do pipeline de um email: cada um é um job da fila e grava seu resultado ao terminar,
+# então a categoria aparece sem esperar a geração da resposta
+def classify_email_and_update(email_data, email_id):
     """
-    Processa um email e atualiza no banco de dados quando concluído
+    Estágio de classificação: classifica o email e grava a categoria no banco
 
     Args:
         email_data: Dicionário com os dados do email (subject, content, sender)
         email_id: ID do email no banco de dados
 
     Returns:
-        Dicionário com os resultados do processamento
+        Dicionário com a categoria; a resposta fica como RESPONSE_PENDING até o próximo estágio
     """
-    logger.info(f"Processando email ID {email_id} - Assunto: {email_data.get('subject', '')[:30]}...")
+    logger.info(f"Classificando email ID {email_id} - Assunto: {email_data.get('subject', '')[:30]}...")
 
     try:
-        # Classificar o email
-        category = classify_email(email_data.get('subject', ''), email_data.get('content', ''))
-
-        # Gerar resposta sugerida
-        suggested_response = suggest_response(
-            email_data.get('subject', ''),
-            email_data.get('content', ''),
-            category
-        )
-
+        # Falhas temporárias do Gemini levantam RetryableJobError e o email continua pendente
+        category = classify_email(email_data.get('subject', ''), email_data.get('content', ''), fallback=False)
+        # Cancelado durante a classificação: o job termina cancelado e o estágio de resposta não é agendado
+        job_queue.raise_if_cancelled()
         results = {
             'category': category,
-            'confidence_score': classification_confidence,
-            'suggested_response': suggested_response
+            'confidence_score': get_classification_confidence(),
+            'suggested_response': RESPONSE_PENDING
         }
+    except (RetryableJobError, JobCancelled):
+        raise
+    except Exception as e:
+        logger.error(f"Erro ao classificar email ID {email_id}: {str(e)}")
+        results = {
+            'category': 'error',
+            'confidence_score': 0.0,
+            'suggested_response': f"Erro ao processar: {str(e)}"
+        }
+
+    update_email_with_results(email_id, results)
+    return results
+
+def suggest_response_and_update(email_data, email_id):
+    """
+    Estágio de resposta: gera a resposta sugerida para a categoria já gravada e a grava no banco
+
+    Args:
+        email_data: Dicionário com subject, content e category
+        email_id: ID do email no banco de dados
 
-        # Atualizar no banco de dados
-        update_email_with_results(email_id, results)
+    Returns:
+        Dicionário com a resposta sugerida
+    """
+    logger.info(f"Gerando resposta para email ID {email_id}")
 
-        return results
+    try:
+        suggested_response = suggest_response(email_data.get('subject', ''), email_data.get('content', ''),
+                                              email_data.get('category', ''), fallback=False)
+    except (RetryableJobError, JobCancelled):
+        raise
     except Exception as e:
-        logger.error(f"Erro ao processar email ID {email_id}: {str(e)}")
-        # Atualizar com erro no banco
-        error_results = {
+        # A categoria já gravada continua valendo
+        logger.error(f"Erro ao gerar resposta para email ID {email_id}: {str(e)}")
+        suggested_response = f"Erro ao gerar resposta: {str(e)}"
+
+    results = {'suggested_response': suggested_response}
+    update_email_with_results(email_id, results)
+    return results
+
+async def classify_email_and_update_async(email_data, email_id):
+    """
+    Versão assíncrona de classify_email_and_update: a chamada ao Gemini roda no
+    event loop e só a gravação no banco usa uma thread
+    """
+    logger.info(f"Classificando email ID {email_id} - Assunto: {email_data.get('subject', '')[:30]}...")
+
+    try:
+        category = await classify_email_async(email_data.get('subject', ''), email_data.get('content', ''))
+        # A consulta do cancelamento pode ir ao banco, então também roda em uma thread
+        await asyncio.to_thread(job_queue.raise_if_cancelled)
+        results = {
+            'category': category,
+            'confidence_score': get_classification_confidence(),
+            'suggested_response': RESPONSE_PENDING
+        }
+    except (RetryableJobError, JobCancelled):
+        raise
+    except Exception as e:
+        logger.error(f"Erro ao classificar email ID {email_id}: {str(e)}")
+        results = {
             'category': 'error',
             'confidence_score': 0.0,
             'suggested_response': f"Erro ao processar: {str(e)}"
         }
-        update_email_with_results(email_id, error_results)
-        return error_results
+
+    # O ORM do Django não pode ser usado de dentro do event loop
+    await asyncio.to_thread(update_email_with_results, email_id, results)
+    return results
+
+async def suggest_response_and_update_async(email_data, email_id):
+    """Versão assíncrona de suggest_response_and_update"""
+    logger.info(f"Gerando resposta para email ID {email_id}")
+
+    try:
+        suggested_response = await suggest_response_async(email_data.get('subject', ''),
+                                                          email_data.get('content', ''),
+                                                          email_data.get('category', ''))
+    except (RetryableJobError, JobCancelled):
+        raise
+    except Exception as e:
+        logger.error(f"Erro ao gerar resposta para email ID {email_id}: {str(e)}")
+        suggested_response = f"Erro ao gerar resposta: {str(e)}"
+
+    results = {'suggested_response': suggested_response}
+    await asyncio.to_thread(update_email_with_results, email_id, results)
+    return results
+
+# Tempo máximo na fila: jobs consultados por polling perdem o sentido rápido,
+# emails salvos no banco podem esperar mais antes de serem dados como expirados
+INTERACTIVE_JOB_TTL = 600
+EMAIL_JOB_TTL = 3600
+
+# Lotes de classificação: até CLASSIFY_BATCH_SIZE emails por chamada ao Gemini,
+# esperando no máximo CLASSIFY_BATCH_LINGER segundos para completar o lote
+CLASSIFY_BATCH_SIZE = int(os.getenv('CLASSIFY_BATCH_SIZE', 10))
+CLASSIFY_BATCH_LINGER = float(os.getenv('CLASSIFY_BATCH_LINGER', 0.25))
+
+# Falhas temporárias do Gemini (erro da API ou limite atingido) são tentadas de novo
+# com backoff exponencial; jobs que esgotam as tentativas vão para a dead-letter
+AI_RETRY_POLICY = RetryPolicy(max_attempts=4, base_delay=5.0, max_delay=120.0)
+
+# Handlers assíncronos: as chamadas ao Gemini ficam em andamento no event loop da fila
+# (até JOB_QUEUE_ASYNC_CONCURRENCY) em vez de ocupar uma worker thread cada
+AI_ASYNC_HANDLERS = os.getenv('AI_ASYNC_HANDLERS', 'True').lower() in ('true', '1', 't')
+
+# Jobs que chamam o Gemini reservam a chamada no rate limiter antes de sair da fila: sem vaga,
+# esperam num timer até o instante reservado em vez de prender um worker em wait_if_needed.
+# Sem API key os handlers usam as heurísticas e não há chamadas a reservar
+RESERVE_GEMINI_CALLS = bool(GEMINI_API_KEY)
+
+def _ai_concurrency(threaded_limit):
+    """Limite por tipo de job: com handlers assíncronos, o limite do event loop já basta"""
+    return None if AI_ASYNC_HANDLERS else threaded_limit
 
 # Registra handlers para os diferentes tipos de jobs de IA
 def register_ai_handlers():
     """Registrar manipuladores de jobs para operações de IA"""
-    job_queue.register_job_type("classify_email", handle_classify_email)
-    job_queue.register_job_type("suggest_response", handle_suggest_response)
-    job_queue.register_job_type("process_document", handle_process_document)
-    job_queue.register_job_type("process_email_complete", handle_process_email_complete)
+    if AI_ASYNC_HANDLERS:
+        handlers = (handle_classify_email_async, handle_classify_batch_async, handle_suggest_response_async,
+                    handle_process_document_async, handle_process_email_complete_async,
+                    handle_suggest_email_response_async)
+    else:
+        handlers = (handle_classify_email, handle_classify_batch, handle_suggest_response,
+                    handle_process_document, handle_process_email_complete,
+                    handle_suggest_email_response)
+    (classify_handler, classify_batch_handler, suggest_handler, document_handler,
+     email_handler, email_response_handler) = handlers
+
+    # Envios repetidos do mesmo conteúdo (reenvio pelo usuário, retry do frontend)
+    # são agrupados ao job em andamento em vez de chamar a IA de novo
+    job_queue.register_job_type("classify_email", classify_handler, max_concurrency=_ai_concurrency(8), ttl=INTERACTIVE_JOB_TTL,
+                                coalesce_key=_email_content_key, batch_handler=classify_batch_handler,
+                                max_batch_size=CLASSIFY_BATCH_SIZE, batch_linger=CLASSIFY_BATCH_LINGER,
+                                retry_policy=AI_RETRY_POLICY, drop_payload=True,
+                                # Com fila, os lotes saem cheios: uma chamada ao Gemini a cada CLASSIFY_BATCH_SIZE jobs
+                                rate_limiter=gemini_limiter, rate_cost=1.0 / CLASSIFY_BATCH_SIZE,
+                                reserve_rate=RESERVE_GEMINI_CALLS, capacity_class="classify",
+                                rate_tokens=_classification_tokens)
+    job_queue.register_job_type("suggest_response", suggest_handler, max_concurrency=_ai_concurrency(4), ttl=INTERACTIVE_JOB_TTL,
+                                coalesce_key=lambda data: content_hash(data.get('subject'), data.get('content'),
+                                                                       data.get('category')),
+                                retry_policy=AI_RETRY_POLICY, drop_payload=True, rate_limiter=gemini_limiter,
+                                reserve_rate=RESERVE_GEMINI_CALLS, capacity_class="response",
+                                rate_tokens=_response_tokens)
+    # Documentos são grandes: ficam limitados a 2 em paralelo nos dois modos
+    job_queue.register_job_type("process_document", document_handler, max_concurrency=2, ttl=INTERACTIVE_JOB_TTL,
+                                coalesce_key=lambda data: content_hash(data.get('file_type'), data.get('file_content')),
+                                retry_policy=AI_RETRY_POLICY, drop_payload=True, rate_limiter=document_limiter,
+                                reserve_rate=RESERVE_GEMINI_CALLS, capacity_class="document",
+                                rate_tokens=_document_tokens)
+    # Pipeline de um email em dois estágios independentes: process_email_complete classifica
+    # e grava a categoria, e ao concluir enfileira suggest_email_response, que gera e grava a
+    # resposta; estágios de emails diferentes se intercalam entre os workers
+    job_queue.register_job_type("process_email_complete", email_handler, max_concurrency=_ai_concurrency(8),
+                                ttl=EMAIL_JOB_TTL, on_expire=handle_email_job_expired,
+                                coalesce_key=_email_content_key, share_result=share_email_results,
+                                retry_policy=AI_RETRY_POLICY, on_dead_letter=handle_email_job_dead_lettered,
+                                on_cancel=handle_email_job_cancelled,
+                                rate_limiter=gemini_limiter, reserve_rate=RESERVE_GEMINI_CALLS,
+                                capacity_class="classify", rate_tokens=_classification_tokens,
+                                next_stage=queue_email_response_stage,
+                                # O status do job (views._job_payload) ainda precisa do email_id
+                                drop_payload=True, keep_fields=('email_id',))
+    job_queue.register_job_type("suggest_email_response", email_response_handler, max_concurrency=_ai_concurrency(4),
+                                ttl=EMAIL_JOB_TTL, on_expire=handle_response_job_expired,
+                                coalesce_key=lambda data: content_hash(data.get('subject'), data.get('content'),
+                                                                       data.get('category')),
+                                share_result=share_email_results,
+                                retry_policy=AI_RETRY_POLICY, on_dead_letter=handle_response_job_dead_lettered,
+                                on_cancel=handle_response_job_cancelled, rate_limiter=gemini_limiter,
+                                reserve_rate=RESERVE_GEMINI_CALLS, capacity_class="response",
+                                rate_tokens=_response_tokens, drop_payload=True, keep_fields=('email_id',))
     logger.info("Manipuladores de jobs de IA registrados")
 
+def _email_content_key(data):
+    """Chave de coalescência de um email: só assunto e conteúdo influenciam o resultado"""
+    return content_hash(data.get('subject'), data.get('content'))
+
+# Tokens estimados da chamada de cada tipo de job, reservados no rate limiter junto com a requisição
+def _classification_tokens(data):
+    return _estimate_tokens(_classification_prompt(data.get('subject', ''), data.get('content', '')))
+
+def _response_tokens(data):
+    subject, content = data.get('subject', ''), data.get('content', '')
+    return _estimate_tokens(_response_prompt(subject, content, data.get('category', ''),
+                                             *_response_context(subject, content)))
+
+def _document_tokens(data):
+    return _estimate_tokens(_document_prompt(data.get('file_content', '')))
+
 # Handlers individuais para cada tipo de operação
 def handle_classify_email(data):
     """Handler para jobs de classificação de email"""
     subject = data.get('subject', '')
     content = data.get('content', '')
     return {
-        'category': classify_email(subject, content),
-        'confidence_score': classification_confidence
+        'category': classify_email(subject, content, fallback=False),
+        'confidence_score': get_classification_confidence()
     }
 
+def handle_classify_batch(items):
+    """Handler para lotes de jobs de classificação (classify_batch): uma chamada ao Gemini por lote"""
+    return classify_emails_batch([
+        {'subject': data.get('subject', ''), 'content': data.get('content', '')}
+        for data in items
+    ], fallback=False)
+
 def handle_suggest_response(data):
     """Handler para jobs de sugestão de resposta"""
     subject = data.get('subject', '')
     content = data.get('content', '')
     category = data.get('category', '')
     return {
-        'suggested_response': suggest_response(subject, content, category)
+        'suggested_response': suggest_response(subject, content, category, fallback=False)
     }
 
 def handle_process_document(data):
     """Handler para jobs de processamento de documento"""
     file_content = data.get('file_content', '')
     file_type = data.get('file_type', '')
-    return process_document(file_content, file_type)
+    return process_document(file_content, file_type, fallback=False)
 
 # Handler para processamento completo de um email
 def handle_process_email_complete(data):
@@ -620,15 +1133,161 @@ def handle_process_email_complete(data):
     if not email_id:
         raise ValueError("ID do email não fornecido")
 
-    return process_email_and_update(email_data, email_id)
+    return classify_email_and_update(email_data, email_id)
+
+def handle_suggest_email_response(data):
+    """Handler para o estágio de resposta do pipeline de um email"""
+    email_id = data.get('email_id')
+    if not email_id:
+        raise ValueError("ID do email não fornecido")
+
+    return suggest_response_and_update(data, email_id)
+
+# Versões assíncronas dos handlers, executadas no event loop da fila
+async def handle_classify_email_async(data):
+    """Handler assíncrono para jobs de classificação de email"""
+    category = await classify_email_async(data.get('subject', ''), data.get('content', ''))
+    return {
+        'category': category,
+        'confidence_score': get_classification_confidence()
+    }
+
+async def handle_classify_batch_async(items):
+    """Handler assíncrono para lotes de jobs de classificação"""
+    return await classify_emails_batch_async([
+        {'subject': data.get('subject', ''), 'content': data.get('content', '')}
+        for data in items
+    ])
+
+async def handle_suggest_response_async(data):
+    """Handler assíncrono para jobs de sugestão de resposta"""
+    return {
+        'suggested_response': await suggest_response_async(
+            data.get('subject', ''), data.get('content', ''), data.get('category', ''))
+    }
+
+async def handle_process_document_async(data):
+    """Handler assíncrono para jobs de processamento de documento"""
+    return await process_document_async(data.get('file_content', ''), data.get('file_type', ''))
+
+async def handle_process_email_complete_async(data):
+    """Handler assíncrono para jobs de processamento completo de email"""
+    email_id = data.get('email_id')
+    if not email_id:
+        raise ValueError("ID do email não fornecido")
+
+    email_data = {
+        'subject': data.get('subject', ''),
+        'content': data.get('content', ''),
+        'sender': data.get('sender', '')
+    }
+    return await classify_email_and_update_async(email_data, email_id)
+
+async def handle_suggest_email_response_async(data):
+    """Handler assíncrono para o estágio de resposta do pipeline de um email"""
+    email_id = data.get('email_id')
+    if not email_id:
+        raise ValueError("ID do email não fornecido")
+
+    return await suggest_response_and_update_async(data, email_id)
+
+def queue_email_response_stage(job, results):
+    """
+    Próximo estágio de process_email_complete (next_stage): enfileira a resposta
+    sugerida para a categoria recém-gravada e retorna o ID do job
+    """
+    category = results.get('category')
+    if category not in ('productive', 'unproductive'):
+        # Classificação com erro: não há resposta para gerar
+        return None
+
+    email_data = {'subject': job.data.get('subject', ''), 'content': job.data.get('content', '')}
+    return queue_email_response(email_data, category, job.data['email_id'], client_key=job.client_key,
+                                priority=job.priority)
+
+def share_email_results(data, results):
+    """Aplica o resultado do job líder ao email de um job agrupado a ele"""
+    email_id = data.get('email_id')
+    if not email_id:
+        raise ValueError("ID do email não fornecido")
+
+    update_email_with_results(email_id, results)
+    return results
+
+def handle_email_job_expired(job):
+    """Marca o email como expirado quando seu job passa do prazo sem ser processado"""
+    email_id = job.data.get('email_id')
+    if not email_id:
+        return
+
+    update_email_with_results(email_id, {
+        'category': 'expired',
+        'confidence_score': 0.0,
+        'suggested_response': 'O processamento expirou na fila. Envie o email novamente.'
+    })
+
+def handle_email_job_dead_lettered(job):
+    """Marca o email com erro quando seu job esgota as tentativas e vai para a dead-letter"""
+    email_id = job.data.get('email_id')
+    if not email_id:
+        return
+
+    update_email_with_results(email_id, {
+        'category': 'error',
+        'confidence_score': 0.0,
+        'suggested_response': f"Erro ao processar após {job.attempts} tentativa(s): {job.error}"
+    })
+
+def handle_response_job_expired(job):
+    """Estágio de resposta expirado: a categoria continua valendo, só a resposta falta"""
+    email_id = job.data.get('email_id')
+    if not email_id:
+        return
+
+    update_email_with_results(email_id, {
+        'suggested_response': 'A geração da resposta expirou na fila. Envie o email novamente para gerá-la.'
+    })
+
+def handle_response_job_dead_lettered(job):
+    """Estágio de resposta que esgotou as tentativas: a categoria continua valendo"""
+    email_id = job.data.get('email_id')
+    if not email_id:
+        return
+
+    update_email_with_results(email_id, {
+        'suggested_response': f"Erro ao gerar resposta após {job.attempts} tentativa(s): {job.error}"
+    })
+
+def handle_response_job_cancelled(job):
+    """Estágio de resposta cancelado pelo usuário: a categoria continua valendo"""
+    email_id = job.data.get('email_id')
+    if not email_id:
+        return
+
+    update_email_with_results(email_id, {
+        'suggested_response': 'A geração da resposta foi cancelada.'
+    })
+
+def handle_email_job_cancelled(job):
+    """Marca o email como cancelado quando seu job é cancelado pelo usuário"""
+    email_id = job.data.get('email_id')
+    if not email_id:
+        return
+
+    update_email_with_results(email_id, {
+        'category': 'cancelled',
+        'confidence_score': 0.0,
+        'suggested_response': 'O processamento foi cancelado. Envie o email novamente se precisar.'
+    })
 
 # Função wrapper para processar email usando a fila em vez de processamento direto
-def queue_email_processing(email_data):
+def queue_email_processing(email_data, client_key=None):
     """
     Coloca o processamento de email na fila e retorna o ID do job
 
     Args:
         email_data: Dicionário com subject, content e sender
+        client_key: Cliente que enviou o email (IP), para dividir a fila entre clientes
 
     Returns:
         ID do job na fila
@@ -636,20 +1295,22 @@ def queue_email_processing(email_data):
     job_id = job_queue.enqueue(
         job_type="classify_email",
         data=email_data,
-        priority=1
+        priority=1,
+        client_key=client_key
     )
 
     logger.info(f"Email enfileirado para classificação com job ID: {job_id}")
     return job_id
 
 # Função para enfileirar apenas a geração de resposta
-def queue_response_generation(email_data, category):
+def queue_response_generation(email_data, category, client_key=None):
     """
     Coloca a geração de resposta na fila e retorna o ID do job
 
     Args:
         email_data: Dicionário com subject, content e sender
         category: Categoria do email ('productive' ou 'unproductive')
+        client_key: Cliente que enviou o email (IP), para dividir a fila entre clientes
 
     Returns:
         ID do job na fila
@@ -663,20 +1324,22 @@ def queue_response_generation(email_data, category):
     job_id = job_queue.enqueue(
         job_type="suggest_response",
         data=data,
-        priority=2  # Prioridade média para geração de resposta
+        priority=2,  # Prioridade média para geração de resposta
+        client_key=client_key
     )
 
     logger.info(f"Geração de resposta enfileirada com job ID: {job_id}")
     return job_id
 
 # Função para enfileirar processamento de documento
-def queue_document_processing(file_content, file_type):
+def queue_document_processing(file_content, file_type, client_key=None):
     """
     Coloca o processamento de documento na fila e retorna o ID do job
 
     Args:
         file_content: Conteúdo do arquivo
         file_type: Tipo do arquivo (ex: 'pdf', 'txt')
+        client_key: Cliente que enviou o arquivo (IP), para dividir a fila entre clientes
 
     Returns:
         ID do job na fila
@@ -689,20 +1352,23 @@ def queue_document_processing(file_content, file_type):
     job_id = job_queue.enqueue(
         job_type="process_document",
         data=data,
-        priority=1  # Alta prioridade para processamento de documento
+        priority=1,  # Alta prioridade para processamento de documento
+        client_key=client_key
     )
 
     logger.info(f"Processamento de documento enfileirado com job ID: {job_id}")
     return job_id
 
 # Função para enfileirar processamento completo de email
-def queue_complete_email_processing(email_data, email_id):
+def queue_complete_email_processing(email_data, email_id, client_key=None, job_id=None):
     """
     Coloca o processamento completo de email na fila e retorna o ID do job
 
     Args:
         email_data: Dicionário com subject, content e sender
         email_id: ID do email no banco de dados
+        client_key: Cliente que enviou o email (IP), para dividir a fila entre clientes
+        job_id: ID do job já registrado no email (Email.job_id), se houver
 
     Returns:
         ID do job na fila
@@ -717,12 +1383,124 @@ def queue_complete_email_processing(email_data, email_id):
     job_id = job_queue.enqueue(
         job_type="process_email_complete",
         data=data,
-        priority=1  # Alta prioridade
+        priority=1,  # Alta prioridade
+        client_key=client_key,
+        job_id=job_id
     )
 
     logger.info(f"Email ID {email_id} enfileirado para processamento completo com job ID: {job_id}")
     return job_id
 
+# Função para enfileirar o estágio de resposta de um email já classificado
+def queue_email_response(email_data, category, email_id, client_key=None, priority=1, job_id=None):
+    """
+    Coloca a geração e gravação da resposta de um email na fila e retorna o ID do job
+
+    Args:
+        email_data: Dicionário com subject e content
+        category: Categoria já gravada no email
+        email_id: ID do email no banco de dados
+        client_key: Cliente que enviou o email (IP), para dividir a fila entre clientes
+        priority: Prioridade do job (a mesma do estágio de classificação)
+        job_id: ID do job já registrado no email (Email.job_id), se houver
+
+    Returns:
+        ID do job na fila
+    """
+    from .models import Email
+
+    data = {
+        'subject': email_data.get('subject', ''),
+        'content': email_data.get('content', ''),
+        'category': category,
+        'email_id': email_id
+    }
+
+    if job_id is None:
+        # Registrado antes de enfileirar, como no envio: emails órfãos são detectados pelo job
+        job_id = str(uuid.uuid4())
+        Email.objects.filter(pk=email_id).update(job_id=job_id)
+
+    job_id = job_queue.enqueue(
+        job_type="suggest_email_response",
+        data=data,
+        priority=priority,
+        client_key=client_key,
+        job_id=job_id
+    )
+
+    logger.info(f"Email ID {email_id} enfileirado para geração de resposta com job ID: {job_id}")
+    return job_id
+
+# Emails 'pending' mais antigos que isso e sem job na fila são dados como órfãos
+# (job perdido em um redeploy) e voltam para a fila na inicialização
+ORPHAN_EMAIL_GRACE = int(os.getenv('JOB_QUEUE_ORPHAN_GRACE', 300))
+
+def requeue_orphaned_emails(grace=None, limit=500):
+    """
+    Reenfileira emails que ficaram com categoria 'pending' (ou já classificados com a
+    resposta pendente) sem nenhum job processando-os
+
+    Args:
+        grace: Idade mínima (segundos) do email (padrão: ORPHAN_EMAIL_GRACE; com o store
+            em memória, pelo menos EMAIL_JOB_TTL)
+        limit: Máximo de emails reenfileirados por chamada
+
+    Returns:
+        Quantidade de emails reenfileirados
+    """
+    if grace is None:
+        grace = ORPHAN_EMAIL_GRACE
+        if not job_queue.store.shared:
+            # get_job só enxerga a fila deste processo: o job de um email ainda pode estar na
+            # fila em memória de outro worker do gunicorn (reciclados pelo --max-requests)
+            # até vencer o EMAIL_JOB_TTL
+            grace = max(grace, EMAIL_JOB_TTL)
+    from django.db.models import Q
+    from django.utils import timezone
+    from .models import Email
+
+    cutoff = timezone.now() - timedelta(seconds=grace)
+    orphans = Email.objects.filter(
+        Q(category='pending') | Q(suggested_response=RESPONSE_PENDING), created_at__lt=cutoff
+    ).order_by('created_at')[:limit]
+
+    requeued = 0
+    for email in orphans:
+        job = job_queue.get_job(email.job_id) if email.job_id else None
+        if job is not None and job.status not in JobStatus.FINISHED:
+            continue
+
+        # UPDATE condicional: com vários processos iniciando juntos, só um reenfileira cada email
+        job_id = str(uuid.uuid4())
+        if not Email.objects.filter(Q(category='pending') | Q(suggested_response=RESPONSE_PENDING),
+                                    pk=email.pk, job_id=email.job_id).update(job_id=job_id):
+            continue
+
+        email_data = {'subject': email.subject, 'content': email.content, 'sender': email.sender}
+        if email.category == 'pending':
+            queue_complete_email_processing(email_data, email.pk, client_key=email.user_ip, job_id=job_id)
+        else:
+            # Já classificado: só o estágio de resposta se perdeu
+            queue_email_response(email_data, email.category, email.pk, client_key=email.user_ip, job_id=job_id)
+        requeued += 1
+
+    if requeued:
+        logger.warning(f"{requeued} email(s) pendente(s) sem job foram reenfileirados")
+    return requeued
+
+def resume_interrupted_jobs():
+    """
+    Chamado na inicialização do servidor (wsgi.py): restaura os jobs gravados no
+    último desligamento, reenfileira emails órfãos e liga o desligamento gracioso
+    """
+    try:
+        job_queue.restore_snapshot()
+        requeue_orphaned_emails()
+    except Exception as e:
+        logger.error(f"Erro ao retomar jobs interrompidos: {e}", exc_info=True)
+    job_queue.install_shutdown_hook()
+
 # Função para processar email completo (classificação + resposta) de forma síncrona
 # Mantida para compatibilidade com código existente
 def process_email(email_data):
@@ -745,7 +1523,7 @@ def process_email(email_data):
 
     return {
         'category': category,
-        'confidence_score': classification_confidence,
+        'confidence_score': get_classification_confidence(),
         'suggested_response': suggested_response
     }
 
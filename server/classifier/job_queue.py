@@ -1,13 +1,69 @@
+import os
+import asyncio
+import atexit
+import concurrent.futures
+import contextvars
+import hashlib
+import math
+import inspect
+import json
+import random
+import signal
+import tempfile
 import threading
-import queue
 import time
 import uuid
 import logging
+from collections import deque
 from datetime import datetime
-from typing import Dict, Any, Optional, List, Tuple, Callable
+from typing import Dict, Any, Optional, List, Tuple, Callable, Iterable, Iterator
+from .job_stats import DEFAULT_SECONDS_PER_JOB, ProcessingStats, drain_time, slowest
+from .job_store import JobStore, ResultSpill, create_job_store
+from .rate_limiter import using_reservation
 
 logger = logging.getLogger(__name__)
 
+# Tamanho padrão do pool de workers (sobrescrito por JOB_QUEUE_WORKERS)
+DEFAULT_NUM_WORKERS = 8
+
+# Autoscaling do pool: o controlador reavalia a cada AUTOSCALE_INTERVAL segundos quantos
+# workers escoam a fila em até AUTOSCALE_TARGET_WAIT segundos, entre JOB_QUEUE_MIN_WORKERS
+# e JOB_QUEUE_MAX_WORKERS; só reduz depois de AUTOSCALE_SHRINK_AFTER avaliações seguidas
+# pedindo menos, um worker por vez, para não oscilar com rajadas
+DEFAULT_MIN_WORKERS = 2
+AUTOSCALE_INTERVAL = 5.0
+AUTOSCALE_TARGET_WAIT = 10.0
+AUTOSCALE_SHRINK_AFTER = 3
+
+# Intervalo máximo que um worker ocioso fica bloqueado antes de reavaliar a fila;
+# é apenas uma rede de segurança, o despacho normal é feito por notificação
+IDLE_WAKEUP_SECONDS = 30.0
+
+# Fração do lease do store entre duas renovações dos leases dos jobs em processamento
+LEASE_RENEW_FRACTION = 1 / 3
+
+# Por quanto tempo jobs finalizados (e seus resultados) ficam disponíveis para consulta
+DEFAULT_RESULT_TTL = 3600
+
+# Intervalo máximo sem eventos em JobQueue.watch antes de gerar um heartbeat
+WATCH_HEARTBEAT_SECONDS = 15.0
+
+# Prazo padrão para terminar os jobs em processamento ao desligar; na Railway o prazo
+# vem de RAILWAY_DEPLOYMENT_DRAINING_SECONDS, menos uma margem para gravar o snapshot
+DEFAULT_DRAIN_SECONDS = 25.0
+DRAIN_MARGIN_SECONDS = 5.0
+
+# Máximo de handlers assíncronos em andamento no event loop (sobrescrito por JOB_QUEUE_ASYNC_CONCURRENCY);
+# cada um é só uma corrotina esperando a rede, então o limite pode ser bem maior que o pool de threads
+DEFAULT_ASYNC_CONCURRENCY = 32
+
+# Hooks dos jobs (callback do enqueue, on_expire, on_dead_letter, on_cancel) rodam em um pool
+# próprio, fora dos workers: threads do pool (JOB_CALLBACK_WORKERS), hooks aguardando antes de
+# quem despacha esperar por vaga (JOB_CALLBACK_QUEUE) e prazo de cada hook (JOB_CALLBACK_TIMEOUT)
+DEFAULT_CALLBACK_WORKERS = 4
+DEFAULT_CALLBACK_QUEUE = 1000
+DEFAULT_CALLBACK_TIMEOUT = 30.0
+
 class JobStatus:
     """Status possíveis para um job na fila"""
     QUEUED = "queued"        # Na fila, aguardando processamento
@@ -15,60 +71,188 @@ class JobStatus:
     COMPLETED = "completed"   # Processado com sucesso
     FAILED = "failed"         # Falhou durante processamento
     EXPIRED = "expired"       # Expirou na fila sem ser processado
+    CANCELLED = "cancelled"   # Cancelado por quem o enfileirou
+
+    # Estados terminais: o job não volta mais para a fila
+    FINISHED = (COMPLETED, FAILED, EXPIRED, CANCELLED)
+
+class RetryableJobError(Exception):
+    """Falha temporária (ex.: erro ou limite da API): o job pode ser tentado de novo mais tarde"""
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after  # espera mínima sugerida em segundos, se conhecida
+
+
+class JobCancelled(Exception):
+    """Levantada por JobQueue.raise_if_cancelled quando o job em execução foi cancelado"""
+
+
+# Job em execução no handler atual (worker thread ou tarefa do event loop)
+_current_job = contextvars.ContextVar('current_job', default=None)
+
+
+class RetryPolicy:
+    """Novas tentativas de um tipo de job, com backoff exponencial e jitter"""
+    def __init__(self, max_attempts: int = 3, base_delay: float = 2.0, max_delay: float = 300.0,
+                 retry_on: Tuple = (RetryableJobError,)):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on  # exceções consideradas temporárias
+
+    def should_retry(self, error: Exception, attempts: int) -> bool:
+        return attempts < self.max_attempts and isinstance(error, self.retry_on)
+
+    def backoff(self, attempts: int, error: Optional[Exception] = None) -> float:
+        """Espera antes da próxima tentativa: metade fixa e metade aleatória do teto exponencial"""
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after:
+            delay = max(delay, retry_after)
+        return delay
+
 
 class Job:
     """Representa um job individual na fila"""
-    def __init__(self, job_type: str, data: Dict[str, Any], callback: Optional[Callable] = None):
+    # Sem __dict__ por instância: os jobs retidos após finalizar ocupam bem menos memória
+    __slots__ = ('id', 'job_type', 'data', 'priority', 'status', '_result', 'result_path', 'error',
+                 'created_at', 'started_at', 'completed_at', 'callback', 'position_in_queue',
+                 'deadline', 'result_ttl', 'coalesce_key', 'leader_id', 'attempts', 'available_at',
+                 'dead_letter', 'listeners', 'client_key', 'weight', 'cancel_requested',
+                 'wait_estimate', 'next_job_id', 'rate_reserved', 'rate_reserved_tokens',
+                 'rate_reserved_seconds')
+
+    def __init__(self, job_type: str, data: Dict[str, Any], callback: Optional[Callable] = None, priority: int = 1):
         self.id = str(uuid.uuid4())
         self.job_type = job_type
         self.data = data
+        self.priority = priority
         self.status = JobStatus.QUEUED
-        self.result = None
+        self._result = None
+        self.result_path = None  # arquivo com o resultado, quando ele foi descarregado da memória
         self.error = None
         self.created_at = datetime.now()
         self.started_at = None
         self.completed_at = None
         self.callback = callback
         self.position_in_queue = 0  # Será atualizado pelo JobQueue
+        self.deadline = None  # time.time() a partir do qual o job expira se ainda estiver na fila
+        self.result_ttl = DEFAULT_RESULT_TTL  # segundos que o job fica guardado após finalizar
+        self.coalesce_key = None  # hash do conteúdo para agrupar jobs idênticos em andamento
+        self.leader_id = None  # job que está processando o mesmo conteúdo por este (seguidor)
+        self.attempts = 0  # quantas vezes o job já começou a ser processado
+        self.available_at = None  # time.time() a partir do qual um job reagendado pode ser retirado
+        self.dead_letter = False  # falhou de vez e aguarda inspeção na dead-letter
+        self.listeners = []  # funções chamadas com o job a cada mudança de status
+        self.client_key = None  # quem enfileirou (IP, chave de API); a fila reveza entre clientes
+        self.weight = 1.0  # peso do cliente no fair queuing (2.0 = o dobro da vazão)
+        self.cancel_requested = False  # cancelado durante o processamento; o handler para na próxima etapa
+        self.wait_estimate = None  # (p50, p90) em segundos, calculada pelo JobQueue com os tempos medidos
+        self.next_job_id = None  # job do próximo estágio, enfileirado quando este concluiu
+        self.rate_reserved = 0  # requisições já reservadas no rate_limiter do tipo e ainda não usadas
+        self.rate_reserved_tokens = 0  # tokens estimados reservados junto com essas requisições
+        self.rate_reserved_seconds = 0.0  # segundos que essas requisições ocuparam no balde do minuto ao reservar
+
+    @property
+    def result(self):
+        """Resultado do job; resultados descarregados em disco são lidos sob demanda"""
+        result = self._result
+        if result is None and self.result_path is not None:
+            return ResultSpill.load(self.result_path)
+        return result
+
+    @result.setter
+    def result(self, value):
+        self._result = value
+        self.result_path = None
+
+    @property
+    def has_result(self) -> bool:
+        """Se há resultado, sem ler do disco um resultado descarregado"""
+        return self._result is not None or self.result_path is not None
+
+    def offload_result(self, path: str):
+        """Libera o resultado da memória; ele passa a ser lido do arquivo em `path`"""
+        # O caminho vem antes: quem lê o resultado no meio da troca nunca vê None
+        self.result_path = path
+        self._result = None
+
+    def drop_payload(self, keep: Iterable[str] = ()):
+        """Descarta os dados de entrada (conteúdo do email, texto do documento), mantendo só os campos em keep"""
+        self.data = {key: self.data[key] for key in keep if key in self.data}
 
     def start(self):
         """Marca o job como iniciado"""
         self.status = JobStatus.PROCESSING
         self.started_at = datetime.now()
+        self.attempts += 1
+        self._notify_listeners()
+
+    def retry(self, error, available_at: float):
+        """Devolve o job para a fila após uma falha temporária"""
+        self.status = JobStatus.QUEUED
+        self.error = str(error)
+        self.started_at = None
+        self.available_at = available_at
+        self._notify_listeners()
 
     def complete(self, result):
         """Marca o job como completo com resultado"""
         self.status = JobStatus.COMPLETED
         self.result = result
         self.completed_at = datetime.now()
-        if self.callback:
-            try:
-                self.callback(self)
-            except Exception as e:
-                logger.error(f"Erro ao executar callback do job {self.id}: {e}")
+        self._run_callback()
+        self._notify_listeners()
 
     def fail(self, error):
         """Marca o job como falho com erro"""
         self.status = JobStatus.FAILED
         self.error = str(error)
         self.completed_at = datetime.now()
+        self._run_callback()
+        self._notify_listeners()
+
+    def expire(self):
+        """Marca o job como expirado"""
+        self.status = JobStatus.EXPIRED
+        self.error = "Job expirou na fila antes de ser processado"
+        self.completed_at = datetime.now()
+        self._run_callback()
+        self._notify_listeners()
+
+    def cancel(self):
+        """Marca o job como cancelado"""
+        self.status = JobStatus.CANCELLED
+        self.error = "Job cancelado antes de concluir"
+        self.completed_at = datetime.now()
+        self._run_callback()
+        self._notify_listeners()
+
+    def _run_callback(self):
         if self.callback:
             try:
                 self.callback(self)
             except Exception as e:
                 logger.error(f"Erro ao executar callback do job {self.id}: {e}")
 
-    def expire(self):
-        """Marca o job como expirado"""
-        self.status = JobStatus.EXPIRED
-        self.completed_at = datetime.now()
+    def _notify_listeners(self):
+        """Avisa os listeners de cada mudança de status (usado para notificar quem acompanha o job)"""
+        for listener in list(self.listeners):
+            try:
+                listener(self)
+            except Exception as e:
+                logger.error(f"Erro ao notificar listener do job {self.id}: {e}")
 
     def to_dict(self) -> Dict:
         """Converte o job para dicionário para ser retornado via API"""
-        wait_time = None
+        wait_time = wait_time_p90 = None
         if self.status == JobStatus.QUEUED:
-            # Estimar tempo de espera baseado na posição na fila
-            wait_time = self.position_in_queue * 3  # ~3 segundos por job na frente
+            if self.wait_estimate is not None:
+                wait_time, wait_time_p90 = (round(seconds) for seconds in self.wait_estimate)
+            else:
+                # Sem estimativa do JobQueue: tempo padrão por job na frente
+                wait_time = wait_time_p90 = round(self.position_in_queue * DEFAULT_SECONDS_PER_JOB)
 
         processing_time = None
         if self.started_at and self.completed_at:
@@ -81,47 +265,467 @@ class Job:
             "created_at": self.created_at.isoformat(),
             "started_at": self.started_at.isoformat() if self.started_at else None,
             "completed_at": self.completed_at.isoformat() if self.completed_at else None,
+            "expires_at": datetime.fromtimestamp(self.deadline).isoformat() if self.deadline else None,
             "position_in_queue": self.position_in_queue,
-            "estimated_wait_time": wait_time,  # em segundos
+            "estimated_wait_time": wait_time,  # em segundos (mediana)
+            "estimated_wait_time_p90": wait_time_p90,  # em segundos (9 em 10 começam antes disso)
             "processing_time": processing_time,  # em segundos
-            "has_result": self.result is not None,
+            "has_result": self.has_result,
             "has_error": self.error is not None,
-            "error_message": self.error if self.error else None
+            "error_message": self.error if self.error else None,
+            "coalesced_with": self.leader_id,
+            "attempts": self.attempts,
+            "retry_at": datetime.fromtimestamp(self.available_at).isoformat()
+            if self.status == JobStatus.QUEUED and self.available_at and self.attempts else None,
+            # Jobs que ainda não começaram e esperam a vaga reservada no rate limiter
+            "rate_limited_until": datetime.fromtimestamp(self.available_at).isoformat()
+            if self.status == JobStatus.QUEUED and self.available_at and not self.attempts
+            and self.available_at > time.time() else None,
+            "dead_letter": self.dead_letter,
+            "cancel_requested": self.cancel_requested,
+            "next_job_id": self.next_job_id
         }
 
 
+class JobSubscription:
+    """Recebe as mudanças de status de um conjunto de jobs (usada por JobQueue.watch)"""
+    def __init__(self, job_ids: Iterable[str]):
+        self.job_ids = set(job_ids)
+        self.updates = {}  # id -> job com o estado mais recente ainda não consumido
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def push(self, job: 'Job'):
+        with self.condition:
+            self.updates[job.id] = job
+            self.condition.notify_all()
+
+    def close(self):
+        """Acorda quem está esperando; usada para encerrar os streams no desligamento"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def wait(self, timeout: float) -> Dict[str, 'Job']:
+        """Espera até haver mudanças (ou o timeout) e retorna as pendentes"""
+        with self.condition:
+            if not self.updates and not self.closed:
+                self.condition.wait(timeout)
+            updates, self.updates = self.updates, {}
+            return updates
+
+
+class JobTypeSpec:
+    """Configuração de um tipo de job registrado no JobQueue"""
+    # Opções só por nome: a lista cresce a cada recurso e um argumento fora de ordem trocaria opções em silêncio
+    def __init__(self, handler: Callable, *, max_concurrency: Optional[int] = None,
+                 ttl: Optional[float] = None, on_expire: Optional[Callable] = None,
+                 coalesce_key: Optional[Callable] = None, share_result: Optional[Callable] = None,
+                 batch_handler: Optional[Callable] = None, max_batch_size: int = 1, batch_linger: float = 0.0,
+                 retry_policy: Optional[RetryPolicy] = None, on_dead_letter: Optional[Callable] = None,
+                 drop_payload: bool = False, keep_fields: Iterable[str] = (),
+                 on_cancel: Optional[Callable] = None, rate_limiter=None, rate_cost: float = 1.0,
+                 next_stage: Optional[Callable] = None, reserve_rate: bool = False,
+                 capacity_class: Optional[str] = None, rate_tokens: Optional[Callable] = None):
+        self.handler = handler
+        self.max_concurrency = max_concurrency
+        self.ttl = ttl  # segundos que um job pode ficar na fila antes de expirar
+        self.on_expire = on_expire  # chamado com o job quando ele expira na fila
+        self.coalesce_key = coalesce_key  # dados -> conteúdo que identifica jobs idênticos
+        self.share_result = share_result  # (dados do seguidor, resultado do líder) -> resultado do seguidor
+        self.batch_handler = batch_handler  # lista de dados -> lista de resultados, na mesma ordem
+        self.max_batch_size = max_batch_size
+        self.batch_linger = batch_linger  # segundos esperando mais jobs para completar o lote
+        self.retry_policy = retry_policy  # None = falhas são definitivas e não vão para a dead-letter
+        self.on_dead_letter = on_dead_letter  # chamado com o job quando ele vai para a dead-letter
+        self.drop_payload = drop_payload  # descartar os dados de entrada quando o job conclui
+        self.keep_fields = tuple(keep_fields)  # campos dos dados mantidos mesmo com drop_payload
+        self.on_cancel = on_cancel  # chamado com o job quando ele é cancelado
+        self.is_async = inspect.iscoroutinefunction(handler)  # handler roda no event loop da fila
+        self.batch_is_async = inspect.iscoroutinefunction(batch_handler)  # lotes também rodam no event loop
+        self.rate_limiter = rate_limiter  # RateLimiter das chamadas externas que o handler faz
+        self.rate_cost = rate_cost  # chamadas ao rate_limiter por job
+        self.next_stage = next_stage  # (job, resultado) -> ID do job do próximo estágio, ou None
+        self.reserve_rate = reserve_rate  # reservar a vaga no rate_limiter antes de despachar o job
+        self.capacity_class = capacity_class  # classe das chamadas no rate_limiter (capacity_classes)
+        self.rate_tokens = rate_tokens  # dados -> tokens estimados das chamadas do job, reservados com elas
+
+
+class AsyncJobExecutor:
+    """Event loop em uma thread dedicada onde rodam os handlers assíncronos da fila"""
+    def __init__(self, concurrency: int):
+        self.concurrency = max(1, concurrency)  # handlers em andamento ao mesmo tempo
+        self.loop = None
+        self.thread = None
+        self.futures = set()  # handlers entregues ao loop e ainda não finalizados
+        self.lock = threading.Lock()
+
+    def submit(self, handler: Callable, data: Dict[str, Any], on_done: Callable) -> concurrent.futures.Future:
+        """Agenda handler(data) no loop; on_done(resultado, erro) roda em seguida, fora do loop"""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self._start()
+            future = asyncio.run_coroutine_threadsafe(self._call(handler, data, on_done), self.loop)
+            self.futures.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def _start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, args=(self.loop,), name="job-async-loop", daemon=True)
+        self.thread.start()
+        logger.info(f"Event loop de jobs assíncronos iniciado (até {self.concurrency} em andamento)")
+
+    @staticmethod
+    def _run(loop: asyncio.AbstractEventLoop):
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+        finally:
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.close()
+
+    @staticmethod
+    async def _call(handler: Callable, data: Dict[str, Any], on_done: Callable):
+        try:
+            result, error = await handler(data), None
+        except Exception as e:
+            result, error = None, e
+        # Finalizar o job grava no store e roda hooks que podem acessar o banco: fora do loop
+        await asyncio.to_thread(on_done, result, error)
+
+    def _discard(self, future: concurrent.futures.Future):
+        with self.lock:
+            self.futures.discard(future)
+
+    def stop(self, timeout: float):
+        """Espera até `timeout` segundos pelos handlers em andamento e encerra o loop, cancelando os que sobraram"""
+        with self.lock:
+            loop, thread, futures = self.loop, self.thread, list(self.futures)
+            self.loop = self.thread = None
+        if thread is None:
+            return
+
+        if futures:
+            concurrent.futures.wait(futures, timeout=timeout)
+        for future in futures:
+            future.cancel()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=1.0)
+
+
+class CallbackDispatcher:
+    """
+    Pool limitado de threads que executa os hooks dos jobs fora dos workers da fila,
+    para que um hook lento (webhook, gravação no banco) não segure o despacho.
+
+    Um hook que passa de `timeout` segundos é abandonado: conta como timeout e uma thread
+    nova assume a vaga da que ficou presa nele (threads não podem ser interrompidas).
+    Com `max_pending` hooks aguardando, quem despacha espera uma vaga.
+    """
+    def __init__(self, concurrency: int, max_pending: int, timeout: float):
+        self.concurrency = max(1, concurrency)
+        self.max_pending = max(1, max_pending)
+        self.timeout = timeout
+        self.pending = deque()  # (nome, função, argumentos) aguardando uma thread
+        self.running = {}  # thread -> (nome do hook, prazo em time.monotonic())
+        self.threads = set()  # threads do pool, sem as abandonadas em um hook que passou do prazo
+        self.watchdog = None
+        self.stopping = False
+        self.condition = threading.Condition()
+        # Métricas
+        self.latency = ProcessingStats()  # duração dos hooks, em segundos
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.saturated = 0  # vezes em que quem despachou esperou por vaga
+
+    def submit(self, name: str, fn: Callable, *args):
+        """Agenda fn(*args) no pool; depois de stop, executa na própria thread para não perder o hook"""
+        with self.condition:
+            if not self.stopping:
+                self._ensure_threads()
+                if len(self.pending) >= self.max_pending:
+                    self.saturated += 1
+                    logger.warning(f"{len(self.pending)} hooks de jobs aguardando; {name} espera uma vaga")
+                    while len(self.pending) >= self.max_pending and not self.stopping:
+                        self.condition.wait()
+            if not self.stopping:
+                self.pending.append((name, fn, args))
+                self.condition.notify_all()
+                return
+        self._execute(name, fn, args)
+
+    def wrap(self, name: str, fn: Callable) -> Callable:
+        """Versão de um hook fn(job) que é despachada para o pool em vez de rodar em quem a chama"""
+        return lambda job: self.submit(f"{name} do job {job.id}", fn, job)
+
+    def _ensure_threads(self):
+        """Repõe as threads do pool e o watchdog. Chamado com a condição."""
+        while len(self.threads) < self.concurrency:
+            thread = threading.Thread(target=self._run, name=f"job-callback-{len(self.threads)}", daemon=True)
+            self.threads.add(thread)
+            thread.start()
+        if self.watchdog is None or not self.watchdog.is_alive():
+            self.watchdog = threading.Thread(target=self._watch, name="job-callback-watchdog", daemon=True)
+            self.watchdog.start()
+
+    def _run(self):
+        me = threading.current_thread()
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopping:
+                    self.condition.wait()
+                if not self.pending:
+                    self.threads.discard(me)
+                    return
+                name, fn, args = self.pending.popleft()
+                self.running[me] = (name, time.monotonic() + self.timeout)
+                self.condition.notify_all()  # libera quem esperava vaga em submit
+
+            self._execute(name, fn, args)
+
+            with self.condition:
+                self.running.pop(me, None)
+                self.condition.notify_all()  # stop espera os hooks em andamento
+                if me not in self.threads:
+                    # O watchdog já pôs outra thread no lugar desta
+                    return
+
+    def _execute(self, name: str, fn: Callable, args: Tuple):
+        started = time.monotonic()
+        try:
+            fn(*args)
+            failed = False
+        except Exception as e:
+            logger.error(f"Erro ao executar {name}: {e}", exc_info=True)
+            failed = True
+        elapsed = time.monotonic() - started
+
+        self.latency.observe(elapsed)
+        with self.condition:
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+        if elapsed > self.timeout:
+            logger.warning(f"{name} terminou após {elapsed:.1f}s, depois de ter sido abandonado")
+
+    def _watch(self):
+        """Abandona os hooks que passaram do prazo e repõe as threads presas neles"""
+        interval = min(1.0, self.timeout / 4)
+        with self.condition:
+            while not self.stopping:
+                now = time.monotonic()
+                for thread, (name, deadline) in list(self.running.items()):
+                    if deadline <= now and thread in self.threads:
+                        self.threads.discard(thread)
+                        self.timed_out += 1
+                        logger.warning(f"{name} passou de {self.timeout:.0f}s; outra thread assume a vaga")
+                self._ensure_threads()
+                self.condition.wait(interval)
+
+    def stop(self, timeout: float):
+        """Espera até `timeout` segundos pelos hooks aguardando e em andamento e encerra o pool"""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.pending or any(thread in self.threads for thread in self.running):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            dropped = len(self.pending)
+            self.pending.clear()
+            self.stopping = True
+            self.condition.notify_all()
+        if dropped:
+            logger.warning(f"{dropped} hook(s) de jobs não executados dentro do prazo de desligamento")
+
+    def stats(self) -> Dict[str, Any]:
+        with self.condition:
+            return {
+                "pending": len(self.pending),
+                "running": len(self.running),
+                "completed": self.completed,
+                "failed": self.failed,
+                "timed_out": self.timed_out,
+                "saturated": self.saturated,
+                "latency": self.latency.to_dict(),
+            }
+
+
+def drain_budget() -> float:
+    """Segundos para terminar os jobs em processamento ao desligar o processo"""
+    configured = os.getenv('JOB_QUEUE_DRAIN_SECONDS')
+    if configured:
+        return float(configured)
+    railway = os.getenv('RAILWAY_DEPLOYMENT_DRAINING_SECONDS')
+    if railway:
+        return max(1.0, float(railway) - DRAIN_MARGIN_SECONDS)
+    return DEFAULT_DRAIN_SECONDS
+
+
+def content_hash(*parts: Any) -> str:
+    """Hash estável do conteúdo de um job, usado como chave de coalescência"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part or '').encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
 class JobQueue:
-    """Fila de jobs para processamento"""
+    """Fila de jobs para processamento com um pool de workers"""
     _instance = None
 
-    def __new__(cls):
+    def __new__(cls, *args, **kwargs):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
             cls._instance._initialized = False
         return cls._instance
 
-    def __init__(self):
+    def __init__(self, num_workers: Optional[int] = None, store: Optional[JobStore] = None,
+                 result_ttl: Optional[float] = None, snapshot_dir: Optional[str] = None,
+                 async_concurrency: Optional[int] = None, callback_timeout: Optional[float] = None,
+                 min_workers: Optional[int] = None, max_workers: Optional[int] = None):
         if self._initialized:
             return
 
-        self.queue = queue.PriorityQueue()  # (prioridade, timestamp, job)
-        self.jobs = {}  # id -> job
-        self.active_job = None
-        self.worker_thread = None
+        if num_workers is None:
+            num_workers = int(os.getenv('JOB_QUEUE_WORKERS', DEFAULT_NUM_WORKERS))
+            # Sem um tamanho explícito, o pool varia conforme a demanda; JOB_QUEUE_WORKERS é o máximo padrão
+            if min_workers is None:
+                min_workers = int(os.getenv('JOB_QUEUE_MIN_WORKERS', DEFAULT_MIN_WORKERS))
+            if max_workers is None:
+                max_workers = int(os.getenv('JOB_QUEUE_MAX_WORKERS', num_workers))
+        if result_ttl is None:
+            result_ttl = float(os.getenv('JOB_RESULT_TTL', DEFAULT_RESULT_TTL))
+        if snapshot_dir is None:
+            snapshot_dir = os.getenv('JOB_QUEUE_SNAPSHOT_DIR') or os.path.join(
+                tempfile.gettempdir(), 'email_classifier_queue')
+        if async_concurrency is None:
+            async_concurrency = int(os.getenv('JOB_QUEUE_ASYNC_CONCURRENCY', DEFAULT_ASYNC_CONCURRENCY))
+        if callback_timeout is None:
+            callback_timeout = float(os.getenv('JOB_CALLBACK_TIMEOUT', DEFAULT_CALLBACK_TIMEOUT))
+
+        # Limites do autoscaling; iguais (o padrão com num_workers explícito) = pool fixo
+        self.min_workers = max(1, min_workers if min_workers is not None else num_workers)
+        self.max_workers = max(self.min_workers, max_workers if max_workers is not None else num_workers)
+        self.num_workers = max(self.min_workers, min(self.max_workers, num_workers))  # tamanho desejado agora
+        self.result_ttl = result_ttl
+        # Onde os jobs ficam guardados: memória do processo ou banco compartilhado
+        self.store = store if store is not None else create_job_store()
+        self.active_jobs = {}  # id -> job em processamento
+        self.worker_threads = []
+        self.worker_seq = 0  # numeração das threads; workers dispensados deixam buracos
+        self.autoscaler = None
+        self.lease_keeper = None  # renova os leases dos jobs em processamento (stores com lease)
         self.stop_event = threading.Event()
         self.lock = threading.RLock()
-        self.job_types = {}  # Registro de manipuladores por tipo de job
+        # Acorda workers ociosos quando chega trabalho ou uma vaga é liberada
+        self.work_available = threading.Condition(self.lock)
+        # Acorda o worker que está montando um lote quando chega um job do mesmo tipo
+        self.batch_arrived = threading.Condition(self.lock)
+        self.collecting = {}  # job_type -> workers montando um lote desse tipo agora
+        self.job_types = {}  # job_type -> JobTypeSpec com manipulador e opções
+        self.running_counts = {}  # job_type -> jobs em processamento agora
+        # Handlers assíncronos não ocupam worker threads: o worker só retira o job do store
+        # e o entrega ao event loop, enquanto houver vaga em async_in_flight
+        self.async_executor = AsyncJobExecutor(async_concurrency)
+        self.async_in_flight = 0
+        # Hooks dos jobs rodam fora dos workers: a vazão da fila não depende do que eles fazem
+        self.callbacks = CallbackDispatcher(int(os.getenv('JOB_CALLBACK_WORKERS', DEFAULT_CALLBACK_WORKERS)),
+                                            int(os.getenv('JOB_CALLBACK_QUEUE', DEFAULT_CALLBACK_QUEUE)),
+                                            callback_timeout)
+        # Tempos de processamento medidos, para estimar a espera na fila
+        self.processing_stats = {}  # job_type -> ProcessingStats
+        self.overall_stats = ProcessingStats()  # todos os tipos; usada por tipos ainda sem medições
+        self.subscriptions = {}  # id do job -> JobSubscriptions acompanhando o job
+        self.subscription_lock = threading.Lock()
+        self.snapshot_dir = snapshot_dir  # onde shutdown grava os jobs que sobraram na fila
+        self.closing = threading.Event()  # desligamento em andamento: encerra watch/long-poll
+        self._shutdown_hook_installed = False
         self._initialized = True
 
-        # Iniciar thread de processamento de jobs
+        # Iniciar threads de processamento de jobs
         self.start_worker()
 
-    def register_job_type(self, job_type: str, handler: Callable):
-        """Registra um manipulador para um tipo de job"""
-        self.job_types[job_type] = handler
-        logger.info(f"Registrado manipulador para jobs do tipo: {job_type}")
+    @property
+    def active_job(self) -> Optional[Job]:
+        """Job em processamento há mais tempo (compatibilidade com a API antiga)"""
+        with self.lock:
+            return next(iter(self.active_jobs.values()), None)
+
+    def register_job_type(self, job_type: str, handler: Callable, *, max_concurrency: Optional[int] = None,
+                          ttl: Optional[float] = None, on_expire: Optional[Callable] = None,
+                          coalesce_key: Optional[Callable] = None, share_result: Optional[Callable] = None,
+                          batch_handler: Optional[Callable] = None, max_batch_size: int = 1,
+                          batch_linger: float = 0.0, retry_policy: Optional[RetryPolicy] = None,
+                          on_dead_letter: Optional[Callable] = None, drop_payload: bool = False,
+                          keep_fields: Iterable[str] = (), on_cancel: Optional[Callable] = None,
+                          rate_limiter=None, rate_cost: float = 1.0, next_stage: Optional[Callable] = None,
+                          reserve_rate: bool = False, capacity_class: Optional[str] = None,
+                          rate_tokens: Optional[Callable] = None):
+        """
+        Registra um manipulador para um tipo de job
+
+        Args:
+            job_type: tipo do job
+            handler: função que recebe os dados do job e retorna o resultado; se for uma
+                corrotina (async def), roda no event loop da fila sem ocupar um worker
+            max_concurrency: máximo de jobs deste tipo em paralelo (None = limitado só pelo pool)
+            ttl: segundos que um job pode esperar na fila antes de expirar (None = não expira)
+            on_expire: função chamada com o job quando ele expira sem ser processado
+            coalesce_key: função que recebe os dados do job e retorna a chave do seu conteúdo;
+                jobs com a mesma chave enquanto um deles está na fila ou em processamento
+                viram seguidores dele e não chamam o manipulador de novo
+            share_result: função (dados do seguidor, resultado do líder) que aplica o resultado
+                compartilhado a cada seguidor e retorna o resultado dele (padrão: o mesmo do líder)
+            batch_handler: função que processa vários jobs de uma vez; recebe a lista de dados
+                e retorna a lista de resultados na mesma ordem (um item Exception falha só aquele job)
+            max_batch_size: máximo de jobs por lote
+            batch_linger: segundos que o worker espera por mais jobs antes de processar um lote incompleto
+            retry_policy: RetryPolicy para falhas temporárias; jobs que esgotam as tentativas
+                (ou falham com erro não temporário) vão para a dead-letter
+            on_dead_letter: função chamada com o job quando ele vai para a dead-letter
+            drop_payload: descarta os dados de entrada do job quando ele conclui com sucesso
+                (jobs que falham mantêm os dados para poderem ser reprocessados)
+            keep_fields: campos dos dados mantidos mesmo com drop_payload (ex.: 'email_id')
+            on_cancel: função chamada com o job quando ele é cancelado (JobQueue.cancel)
+            rate_limiter: RateLimiter que o handler consulta; a folga dele entra na espera estimada
+            rate_cost: chamadas ao rate_limiter por job (em lotes, a chamada dividida pelo lote)
+            next_stage: função (job, resultado) chamada quando um job do tipo conclui; enfileira
+                o próximo estágio do pipeline como um job independente e retorna o ID dele
+                (ou None se não houver próximo estágio). Seguidores avançam cada um por si.
+            reserve_rate: reserva as chamadas do job no rate_limiter (RateLimiter.reserve) antes de
+                despachá-lo; sem vaga, o job espera num timer do store até o instante reservado e o
+                worker segue com outros jobs, em vez de dormir dentro de wait_if_needed
+            capacity_class: classe das chamadas do tipo no rate_limiter (RateLimiter capacity_classes),
+                usada nas reservas e na espera estimada
+            rate_tokens: função que recebe os dados do job e retorna os tokens estimados das
+                suas chamadas; com reserve_rate, eles entram na reserva, e jobs sem tokens
+                na cota do minuto também esperam no timer em vez de dormir num worker
+        """
+        with self.lock:
+            self.job_types[job_type] = JobTypeSpec(
+                handler, max_concurrency=max_concurrency, ttl=ttl, on_expire=on_expire,
+                coalesce_key=coalesce_key, share_result=share_result,
+                batch_handler=batch_handler, max_batch_size=max_batch_size, batch_linger=batch_linger,
+                retry_policy=retry_policy, on_dead_letter=on_dead_letter,
+                drop_payload=drop_payload, keep_fields=keep_fields, on_cancel=on_cancel,
+                rate_limiter=rate_limiter, rate_cost=rate_cost, next_stage=next_stage,
+                reserve_rate=reserve_rate, capacity_class=capacity_class, rate_tokens=rate_tokens,
+            )
+            self.running_counts.setdefault(job_type, 0)
+            self.processing_stats.setdefault(job_type, ProcessingStats())
+        logger.info(f"Registrado manipulador para jobs do tipo: {job_type} (concorrência máxima: {max_concurrency or self.num_workers})")
 
-    def enqueue(self, job_type: str, data: Dict[str, Any], priority: int = 1, callback: Optional[Callable] = None) -> str:
+    def enqueue(self, job_type: str, data: Dict[str, Any], priority: int = 1, callback: Optional[Callable] = None,
+                ttl: Optional[float] = None, client_key: Optional[str] = None, weight: float = 1.0,
+                job_id: Optional[str] = None) -> str:
         """
         Coloca um job na fila para processamento
 
@@ -129,151 +733,1173 @@ class JobQueue:
             job_type: tipo do job (deve ter um manipulador registrado)
             data: dados para processamento
             priority: prioridade do job (menor valor = maior prioridade)
-            callback: função a chamar quando o job for concluído
+            callback: função a chamar quando o job for concluído (roda no pool de hooks, não no worker)
+            ttl: segundos que o job pode esperar na fila (padrão: ttl do tipo de job)
+            client_key: cliente que enfileirou o job; jobs de clientes diferentes são
+                intercalados para um envio em massa não travar a fila dos demais
+            weight: peso do cliente na divisão da fila (padrão 1.0)
+            job_id: ID do job, quando quem enfileira já o registrou (padrão: um UUID novo)
 
         Returns:
             ID do job
         """
-        if job_type not in self.job_types:
+        spec = self.job_types.get(job_type)
+        if spec is None:
             raise ValueError(f"Tipo de job não registrado: {job_type}")
 
-        job = Job(job_type, data, callback)
+        if callback is not None:
+            callback = self.callbacks.wrap("callback", callback)
+        job = Job(job_type, data, callback, priority)
+        if job_id is not None:
+            job.id = job_id
+        job.client_key = client_key
+        job.weight = weight
+        ttl = ttl if ttl is not None else spec.ttl
+        if ttl is not None:
+            job.deadline = time.time() + ttl
+
+        self._admit(job, spec)
+        return job.id
+
+    def _admit(self, job: Job, spec: JobTypeSpec):
+        """Coloca no store um job novo (ou restaurado de um snapshot), agrupando-o a um líder se houver"""
+        job_type, priority = job.job_type, job.priority
+        job.listeners.append(self._publish)
+        job.result_ttl = self.result_ttl
+
+        if spec.coalesce_key is None:
+            # Enfileirar com prioridade; o store também atualiza as posições na fila
+            self.store.add(job)
+
+            with self.lock:
+                self._notify_arrival(job_type)
+                logger.info(f"Job {job.id} do tipo {job_type} enfileirado com prioridade {priority}")
+            return
 
+        job.coalesce_key = f"{job_type}:{spec.coalesce_key(job.data)}"
         with self.lock:
-            self.jobs[job.id] = job
-            # Atualizar as posições dos jobs na fila
-            self._update_queue_positions()
+            # Procurar o líder e registrar o seguidor sob o mesmo lock em que o
+            # líder é finalizado, para nenhum seguidor ficar sem resultado
+            leader = self.store.find_inflight(job.coalesce_key)
+            if leader is not None:
+                job.leader_id = leader.id
+            self.store.add(job)
 
-            # Enfileirar com prioridade
-            self.queue.put((priority, time.time(), job))
-            logger.info(f"Job {job.id} do tipo {job_type} enfileirado com prioridade {priority}")
+            if leader is None:
+                self._notify_arrival(job_type)
+                logger.info(f"Job {job.id} do tipo {job_type} enfileirado com prioridade {priority}")
+            else:
+                logger.info(f"Job {job.id} do tipo {job_type} agrupado ao job {leader.id} com o mesmo conteúdo")
 
-        return job.id
+    def _notify_arrival(self, job_type: str):
+        """Acorda quem deve retirar um job recém-enfileirado. Chamado com o lock."""
+        if self.collecting.get(job_type):
+            # Um worker está montando um lote deste tipo e vai pegar o job
+            self.batch_arrived.notify_all()
+        else:
+            self.work_available.notify()
 
     def get_job(self, job_id: str) -> Optional[Job]:
         """Obtém um job pelo ID"""
-        return self.jobs.get(job_id)
+        job = self.store.get(job_id)
+        if job is not None and job.leader_id and job.status == JobStatus.QUEUED:
+            # Seguidores não entram na fila; a posição deles é a do líder
+            leader = self.store.get(job.leader_id)
+            if leader is not None:
+                job.position_in_queue = leader.position_in_queue
+        if job is not None and job.status == JobStatus.QUEUED:
+            self._estimate_waits([job])
+        return job
+
+    def get_dead_letters(self, limit: int = 50) -> List[Job]:
+        """Jobs que falharam de vez, do mais recente para o mais antigo"""
+        return self.store.dead_letters(limit)
+
+    def retry_dead_letter(self, job_id: str) -> Optional[Job]:
+        """Devolve para a fila um job da dead-letter, com as tentativas zeradas"""
+        job = self.store.remove_dead_letter(job_id)
+        if job is None:
+            return None
+
+        spec = self.job_types.get(job.job_type)
+        job.status = JobStatus.QUEUED
+        job.result = None
+        job.error = None
+        job.started_at = None
+        job.completed_at = None
+        job.attempts = 0
+        job.available_at = None
+        job.dead_letter = False
+        job.leader_id = None  # volta como job independente
+        job.deadline = time.time() + spec.ttl if spec is not None and spec.ttl is not None else None
+        self.store.requeue(job)
+        self._publish(job)
+
+        with self.lock:
+            self._notify_arrival(job.job_type)
+        logger.info(f"Job {job.id} do tipo {job.job_type} devolvido da dead-letter para a fila")
+        return job
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """
+        Cancela um job. Jobs aguardando (na fila, agrupados a um líder ou esperando uma
+        nova tentativa) saem da fila na hora; jobs em processamento recebem um pedido de
+        cancelamento que o handler atende na próxima etapa (raise_if_cancelled).
+        Retorna o job (None se não existir); jobs já finalizados não mudam.
+        """
+        with self.lock:
+            # Sob o lock de _admit: nenhum job novo se agrupa a este enquanto ele sai da fila
+            job = self.store.withdraw(job_id)
+        if job is not None:
+            self._finish_cancelled(job, self.job_types.get(job.job_type))
+            return job
+
+        job = self.store.get(job_id)
+        if job is not None and job.status == JobStatus.COMPLETED and job.next_job_id:
+            # Estágio já concluído: o cancelamento vale para o restante do pipeline
+            return self.cancel(job.next_job_id) or job
+        if job is None or job.status in JobStatus.FINISHED:
+            return job
+        if self.store.request_cancel(job_id):
+            job.cancel_requested = True
+            logger.info(f"Cancelamento do job {job_id} solicitado durante o processamento")
+        return job
+
+    def raise_if_cancelled(self):
+        """
+        Ponto de cancelamento para handlers com várias etapas: levanta JobCancelled se o
+        job em execução foi cancelado. Fora de um job da fila, não faz nada.
+        """
+        job = _current_job.get()
+        if job is None:
+            return
+        if job.cancel_requested or self.store.cancel_requested(job.id):
+            job.cancel_requested = True
+            raise JobCancelled(f"Job {job.id} cancelado durante o processamento")
+
+    def _finish_cancelled(self, job: Job, spec: Optional[JobTypeSpec]):
+        """Finaliza um job cancelado, executa o hook do tipo e devolve à fila os seguidores dele"""
+        self._listen(job)
+        job.cancel()
+        self._release_reservation(job, spec)
+        self.store.update(job)
+        logger.info(f"Job {job.id} do tipo {job.job_type} cancelado")
+
+        if spec is not None and spec.on_cancel is not None:
+            self.callbacks.submit(f"on_cancel do job {job.id}", spec.on_cancel, job)
+
+        self._promote_followers(job)
+
+    def _promote_followers(self, leader: Job):
+        """
+        Devolve à fila os seguidores de um líder cancelado: foram enviados por outras
+        requisições e ainda esperam um resultado. Voltam como jobs independentes.
+        """
+        if leader.coalesce_key is None:
+            return
+
+        with self.lock:
+            followers = self.store.take_followers(leader.id)
+            for follower in followers:
+                self._listen(follower)
+                follower.status = JobStatus.QUEUED
+                follower.leader_id = None
+                self.store.requeue(follower)
+                self._notify_arrival(follower.job_type)
+        if followers:
+            logger.info(f"{len(followers)} job(s) agrupado(s) ao job cancelado {leader.id} devolvido(s) para a fila")
+
+    def subscribe(self, job_ids: Iterable[str]) -> JobSubscription:
+        """Passa a receber as mudanças de status dos jobs informados"""
+        subscription = JobSubscription(job_ids)
+        with self.subscription_lock:
+            for job_id in subscription.job_ids:
+                self.subscriptions.setdefault(job_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: JobSubscription):
+        with self.subscription_lock:
+            for job_id in subscription.job_ids:
+                subscribers = self.subscriptions.get(job_id)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.subscriptions[job_id]
+
+    def _publish(self, job: Job):
+        """Listener registrado nos jobs: repassa a mudança para as assinaturas do job"""
+        with self.subscription_lock:
+            subscribers = list(self.subscriptions.get(job.id, ()))
+        for subscription in subscribers:
+            subscription.push(job)
+
+    def _listen(self, job: Job):
+        """Registra o listener de publicação em um job carregado do store"""
+        # Com o store em banco, cada leitura cria um objeto Job novo
+        if self._publish not in job.listeners:
+            job.listeners.append(self._publish)
+
+    def watch(self, job_ids: Iterable[str], timeout: float,
+              heartbeat: float = WATCH_HEARTBEAT_SECONDS) -> Iterator[Optional[Tuple[str, Optional[Job]]]]:
+        """
+        Acompanha um ou mais jobs sem polling de HTTP.
+
+        Gera (id, job) com o estado atual de cada job e depois a cada mudança de
+        status, até todos terminarem ou o timeout acabar; job é None se o ID não
+        existir. Gera None quando passa `heartbeat` segundos sem mudanças.
+        As mudanças chegam pelos listeners dos jobs; com um store compartilhado,
+        jobs processados por outros processos são relidos a cada poll_interval.
+        """
+        job_ids = list(dict.fromkeys(job_ids))
+        subscription = self.subscribe(job_ids)
+        try:
+            deadline = time.monotonic() + timeout
+            last_event = time.monotonic()
+            sent = {}  # id -> último status enviado
+            updates = {job_id: self.get_job(job_id) for job_id in job_ids}
+
+            while True:
+                for job_id, job in updates.items():
+                    status = job.status if job is not None else None
+                    if job_id in sent and sent[job_id] == status:
+                        continue
+                    sent[job_id] = status
+                    last_event = time.monotonic()
+                    yield job_id, job
+
+                pending = [job_id for job_id in job_ids
+                           if sent.get(job_id) is not None and sent[job_id] not in JobStatus.FINISHED]
+                remaining = deadline - time.monotonic()
+                if not pending or remaining <= 0 or self.closing.is_set():
+                    return
+
+                wait = min(remaining, heartbeat)
+                if self.store.shared:
+                    wait = min(wait, self.store.poll_interval)
+
+                updates = subscription.wait(wait)
+                if not updates and self.store.shared:
+                    updates = {job_id: self.get_job(job_id) for job_id in pending}
+                if not updates and time.monotonic() - last_event >= heartbeat:
+                    last_event = time.monotonic()
+                    yield None
+        finally:
+            self.unsubscribe(subscription)
+
+    def wait_for_change(self, job_id: str, known_status: Optional[str], timeout: float) -> Optional[Job]:
+        """
+        Long-poll: bloqueia até o status do job ser diferente de known_status
+        (ou até o timeout) e retorna o job no estado mais recente
+        """
+        job = None
+        for update in self.watch([job_id], timeout):
+            if update is None:
+                continue
+            _, job = update
+            if job is None or job.status != known_status:
+                break
+        return job
 
     def get_queue_status(self) -> Dict[str, Any]:
         """Obtém o status atual da fila"""
+        queue_lengths = self.store.queue_lengths()
+        queue_length = sum(queue_lengths.values())
+        queued_jobs = self.store.queued(limit=5)
+        self._estimate_waits(queued_jobs, queue_lengths)
+        wait_p50, wait_p90 = self._drain_estimate(queue_lengths)
+
         with self.lock:
-            queued_jobs = [j for j in self.jobs.values() if j.status == JobStatus.QUEUED]
-            processing_job = self.active_job
+            active_jobs = list(self.active_jobs.values())
 
             status = {
-                "queue_length": len(queued_jobs),
-                "active_job": processing_job.to_dict() if processing_job else None,
-                "estimated_wait": len(queued_jobs) * 3,  # ~3 segundos por job
-                "queued_jobs": [j.to_dict() for j in queued_jobs[:5]],  # Mostrar no máximo 5 jobs
-                "processing_count": 1 if processing_job else 0,
+                "queue_length": queue_length,
+                "active_job": active_jobs[0].to_dict() if active_jobs else None,
+                "active_jobs": [j.to_dict() for j in active_jobs],
+                "estimated_wait": round(wait_p50),  # segundos para escoar a fila atual (mediana)
+                "estimated_wait_p90": round(wait_p90),
+                "queued_jobs": [j.to_dict() for j in queued_jobs],  # Mostrar no máximo 5 jobs
+                "processing_count": len(active_jobs),
+                "num_workers": self.num_workers,
+                "min_workers": self.min_workers,
+                "max_workers": self.max_workers,
+                "async_in_flight": self.async_in_flight,
+                "async_limit": self.async_executor.concurrency,
+                "backend": type(self.store).__name__,
+                "running_by_type": {
+                    job_type: {"running": count, "limit": self.job_types[job_type].max_concurrency}
+                    for job_type, count in self.running_counts.items()
+                },
+                "callbacks": self.callbacks.stats(),
+                "processing_stats": {
+                    job_type: stats.to_dict() for job_type, stats in self.processing_stats.items()
+                },
             }
 
             return status
 
+    def admission_delay(self, job_type: str, max_wait: float, count: int = 1) -> Optional[int]:
+        """
+        Controle de admissão: None se `count` novos jobs do tipo começariam em até
+        max_wait segundos (mediana estimada, com a fila, a vazão medida e a folga do
+        rate limiter atuais); senão, os segundos até a fila escoar o bastante para
+        aceitá-los, para o Retry-After de quem enfileira.
+        """
+        queue_lengths = self.store.queue_lengths()
+        queue_lengths[job_type] = queue_lengths.get(job_type, 0) + count
+        wait, _ = self._drain_estimate(queue_lengths)
+        if wait <= max_wait:
+            return None
+        logger.warning(f"Admissão recusada para {count} job(s) do tipo {job_type}: "
+                       f"espera estimada de {wait:.0f}s, máximo {max_wait:.0f}s")
+        return max(1, math.ceil(wait - max_wait))
+
     def start_worker(self):
-        """Inicia o worker thread se não estiver rodando"""
-        if self.worker_thread is None or not self.worker_thread.is_alive():
-            self.stop_event.clear()
-            self.worker_thread = threading.Thread(target=self._process_queue, daemon=True)
-            self.worker_thread.start()
-            logger.info("Worker thread iniciada para processamento de jobs")
-
-    def stop_worker(self):
-        """Para o worker thread"""
-        if self.worker_thread and self.worker_thread.is_alive():
-            logger.info("Solicitando parada do worker thread...")
+        """Inicia o pool de worker threads, repondo as que não estiverem rodando"""
+        with self.lock:
+            self.worker_threads = [t for t in self.worker_threads if t.is_alive()]
+            if not self.worker_threads:
+                self.stop_event.clear()
+
+            missing = self.num_workers - len(self.worker_threads)
+            for _ in range(missing):
+                thread = threading.Thread(target=self._process_queue, name=f"job-worker-{self.worker_seq}", daemon=True)
+                self.worker_seq += 1
+                thread.start()
+                self.worker_threads.append(thread)
+
+            if self.max_workers > self.min_workers and (self.autoscaler is None or not self.autoscaler.is_alive()):
+                self.autoscaler = threading.Thread(target=self._autoscale, name="job-autoscaler", daemon=True)
+                self.autoscaler.start()
+
+            if self.store.lease_seconds and (self.lease_keeper is None or not self.lease_keeper.is_alive()):
+                self.lease_keeper = threading.Thread(target=self._renew_leases, name="job-lease-keeper", daemon=True)
+                self.lease_keeper.start()
+
+        if missing > 0:
+            logger.info(f"{missing} worker thread(s) iniciada(s) para processamento de jobs")
+
+    def scale_workers(self, target: int) -> int:
+        """
+        Ajusta o pool para `target` workers (dentro de min_workers e max_workers): inicia os
+        que faltam ou dispensa os excedentes, que saem ao terminar o job atual. Retorna o novo tamanho.
+        """
+        with self.lock:
+            target = max(self.min_workers, min(self.max_workers, target))
+            previous, self.num_workers = self.num_workers, target
+            if target < previous:
+                # Workers ociosos acordam e os excedentes saem do pool
+                self.work_available.notify_all()
+        if target != previous:
+            logger.info(f"Pool de workers ajustado de {previous} para {target}")
+        if target > previous:
+            self.start_worker()
+        return target
+
+    def desired_workers(self) -> int:
+        """
+        Workers necessários agora: os ocupados mais os que escoam a fila em até
+        AUTOSCALE_TARGET_WAIT segundos pelo tempo de processamento medido de cada tipo.
+
+        Tipos com rate limiter não pedem mais workers do que a cota por minuto sustenta,
+        e nenhum se a cota do minuto já acabou: o worker extra só ficaria esperando o limiter.
+        """
+        queue_lengths = self.store.queue_lengths()
+        with self.lock:
+            specs = {job_type: self.job_types.get(job_type) for job_type in queue_lengths}
+            needed = float(len(self.active_jobs) - self.async_in_flight)
+            async_room = self.async_in_flight < self.async_executor.concurrency
+
+        handoff = False
+        for job_type, count in queue_lengths.items():
+            spec = specs[job_type]
+            if spec is not None and spec.is_async:
+                # Handlers assíncronos só ocupam o worker para serem entregues ao event loop
+                handoff = handoff or async_room
+                continue
+
+            service = self._service_time(job_type)[0]
+            wanted = count * service / AUTOSCALE_TARGET_WAIT
+            if spec is not None and spec.rate_limiter is not None and spec.rate_cost > 0:
+                stats = spec.rate_limiter.get_stats()
+                if stats["minute_usage"] >= stats["minute_limit"]:
+                    wanted = 0.0
+                else:
+                    # Jobs em paralelo que a cota sustenta: vazão do limiter x tempo de cada job
+                    wanted = min(wanted, stats["minute_limit"] / 60.0 * service / spec.rate_cost)
+            if spec is not None and spec.max_concurrency:
+                wanted = min(wanted, spec.max_concurrency)
+            needed += wanted
+
+        if handoff:
+            needed += 1
+        return max(self.min_workers, min(self.max_workers, math.ceil(needed)))
+
+    def _autoscale(self):
+        """Controlador do autoscaling: cresce na hora, reduz devagar"""
+        low_checks = 0
+        while not self.stop_event.wait(AUTOSCALE_INTERVAL):
+            try:
+                desired = self.desired_workers()
+                if desired > self.num_workers:
+                    low_checks = 0
+                    self.scale_workers(desired)
+                elif desired < self.num_workers:
+                    low_checks += 1
+                    if low_checks >= AUTOSCALE_SHRINK_AFTER:
+                        self.scale_workers(self.num_workers - 1)
+                else:
+                    low_checks = 0
+            except Exception as e:
+                logger.error(f"Erro no autoscaling dos workers: {e}", exc_info=True)
+
+    def _renew_leases(self):
+        """
+        Heartbeat dos jobs em processamento: sem ele, um handler mais longo que o lease
+        voltaria para a fila ainda rodando e outro processo o executaria de novo
+        """
+        while not self.stop_event.wait(self.store.lease_seconds * LEASE_RENEW_FRACTION):
+            with self.lock:
+                job_ids = list(self.active_jobs)
+            try:
+                self.store.renew_leases(job_ids)
+            except Exception as e:
+                logger.error(f"Erro ao renovar os leases dos jobs em processamento: {e}", exc_info=True)
+
+    def _retire_surplus_worker(self) -> bool:
+        """Tira a thread atual do pool se ele está maior que o tamanho desejado. Chamado com o lock."""
+        if len(self.worker_threads) <= self.num_workers:
+            return False
+        me = threading.current_thread()
+        if me not in self.worker_threads:
+            return False
+        self.worker_threads.remove(me)
+        logger.info(f"Worker {me.name} dispensado pelo autoscaling ({len(self.worker_threads)} restantes)")
+        return True
+
+    def stop_worker(self, timeout: float = 5.0):
+        """Para todas as worker threads, esperando até `timeout` segundos pelo job atual de cada uma"""
+        alive = [t for t in self.worker_threads if t.is_alive()]
+        if not alive:
+            return
+
+        logger.info(f"Solicitando parada de {len(alive)} worker thread(s)...")
+        with self.lock:
             self.stop_event.set()
-            self.worker_thread.join(timeout=5.0)
-            if self.worker_thread.is_alive():
-                logger.warning("Worker thread não parou em tempo hábil!")
-            else:
-                logger.info("Worker thread parado com sucesso.")
+            self.work_available.notify_all()
+            self.batch_arrived.notify_all()
+        deadline = time.time() + timeout
+        for thread in alive:
+            thread.join(timeout=max(0.0, deadline - time.time()))
 
-    def _process_queue(self):
-        """Loop principal do processamento de jobs"""
-        while not self.stop_event.is_set():
+        still_alive = [t for t in alive if t.is_alive()]
+        if still_alive:
+            logger.warning(f"{len(still_alive)} worker thread(s) não pararam em tempo hábil!")
+        else:
+            logger.info("Worker threads paradas com sucesso.")
+
+    def install_shutdown_hook(self):
+        """
+        Liga o desligamento gracioso ao fim do processo (redeploy, reinício do worker
+        do gunicorn): o SIGTERM encerra os streams de watch para as requisições
+        terminarem, e shutdown roda quando o interpretador sai.
+        """
+        if self._shutdown_hook_installed:
+            return
+        self._shutdown_hook_installed = True
+        atexit.register(self.shutdown)
+
+        if threading.current_thread() is not threading.main_thread():
+            return
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def on_sigterm(signum, frame):
+            self.close_streams()
+            if callable(previous):
+                previous(signum, frame)
+            elif previous == signal.SIG_DFL:
+                raise SystemExit(0)
+
+        signal.signal(signal.SIGTERM, on_sigterm)
+
+    def close_streams(self):
+        """Encerra watch/long-poll em andamento, sem esperar o timeout de cada um"""
+        self.closing.set()
+        with self.subscription_lock:
+            subscriptions = {s for subscribers in self.subscriptions.values() for s in subscribers}
+        for subscription in subscriptions:
+            subscription.close()
+
+    def drain(self, timeout: float) -> List[Job]:
+        """
+        Para de despachar jobs e espera até `timeout` segundos pelos que estão em
+        processamento. Retorna os que não terminaram a tempo, de volta ao status queued.
+        """
+        logger.info(f"Drenando a fila: aguardando até {timeout:.0f}s pelos jobs em processamento")
+        deadline = time.time() + timeout
+        self.stop_worker(timeout)
+        # Handlers assíncronos seguem no event loop depois que os workers param
+        self.async_executor.stop(max(0.0, deadline - time.time()))
+        # Hooks dos jobs que terminaram durante a drenagem
+        self.callbacks.stop(max(0.0, deadline - time.time()))
+
+        with self.lock:
+            unfinished = [job for job in self.active_jobs.values() if job.status not in JobStatus.FINISHED]
+        for job in unfinished:
+            job.status = JobStatus.QUEUED
+            job.started_at = None
+        if unfinished:
+            logger.warning(f"{len(unfinished)} job(s) não terminaram dentro do prazo de desligamento")
+        return unfinished
+
+    def shutdown(self, timeout: Optional[float] = None) -> int:
+        """
+        Desligamento gracioso: drena a fila dentro do prazo e grava os jobs que
+        sobraram em um snapshot local, recarregado por restore_snapshot na próxima
+        inicialização. Retorna quantos jobs foram gravados.
+        """
+        self.close_streams()
+        unfinished = self.drain(drain_budget() if timeout is None else timeout)
+
+        if self.store.shared:
+            # Os jobs da fila já estão no banco; os interrompidos voltam agora, sem esperar o lease
+            for job in unfinished:
+                self.store.requeue(job)
+            return 0
+
+        pending = {job.id: job for job in self.store.pending()}
+        pending.update((job.id, job) for job in unfinished)
+        # O snapshot não leva reservas: o estado do limiter pode ser compartilhado e
+        # continuaria com as vagas marcadas. O job restaurado reserva de novo ao esperar.
+        for job in pending.values():
+            self._release_reservation(job, self.job_types.get(job.job_type))
+        return self._write_snapshot(list(pending.values()))
+
+    def _write_snapshot(self, jobs: List[Job]) -> int:
+        records = []
+        for job in sorted(jobs, key=lambda j: j.created_at):
+            if job.callback is not None:
+                logger.warning(f"Callback do job {job.id} não é gravado no snapshot")
+            record = {
+                "id": job.id,
+                "job_type": job.job_type,
+                "data": job.data,
+                "priority": job.priority,
+                "client_key": job.client_key,
+                "weight": job.weight,
+                "attempts": job.attempts,
+                "error": job.error,
+                "deadline": job.deadline,
+                "created_at": job.created_at.isoformat(),
+            }
             try:
-                # Verificar se há jobs na fila
-                if self.queue.empty():
-                    time.sleep(0.1)  # Evita consumo alto de CPU
-                    continue
+                records.append(json.dumps(record))
+            except (TypeError, ValueError) as e:
+                logger.error(f"Job {job.id} não pôde ser gravado no snapshot: {e}")
 
-                # Pegar o próximo job
-                _, _, job = self.queue.get(block=False)
+        if not records:
+            return 0
 
-                # Verificar se o job é válido
-                if job.id not in self.jobs:
-                    logger.warning(f"Job {job.id} não encontrado no registro de jobs")
-                    continue
+        path = os.path.join(self.snapshot_dir, f"queue-{os.getpid()}-{int(time.time())}.json")
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+                f.write(f"[{','.join(records)}]")
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logger.error(f"Não foi possível gravar o snapshot da fila em {path}: {e}")
+            return 0
+
+        logger.info(f"{len(records)} job(s) da fila gravado(s) em {path} para a próxima inicialização")
+        return len(records)
+
+    def restore_snapshot(self) -> int:
+        """
+        Reenfileira os jobs gravados por shutdown, com os mesmos IDs. Cada arquivo é
+        renomeado antes de ser lido, então só um processo restaura cada snapshot.
+        """
+        if self.store.shared or not os.path.isdir(self.snapshot_dir):
+            return 0
+
+        restored = 0
+        for name in sorted(os.listdir(self.snapshot_dir)):
+            if not (name.startswith('queue-') and name.endswith('.json')):
+                continue
+            path = os.path.join(self.snapshot_dir, name)
+            claimed = f"{path}.restoring-{os.getpid()}"
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue  # outro processo pegou este snapshot
+
+            try:
+                with open(claimed, encoding='utf-8') as f:
+                    records = json.load(f)
+                for record in records:
+                    restored += self._restore_job(record)
+                os.remove(claimed)
+            except (OSError, ValueError) as e:
+                logger.error(f"Snapshot da fila {claimed} inválido: {e}")
+
+        if restored:
+            logger.info(f"{restored} job(s) restaurado(s) do snapshot da fila")
+        return restored
+
+    def _restore_job(self, record: Dict[str, Any]) -> int:
+        spec = self.job_types.get(record['job_type'])
+        if spec is None:
+            logger.warning(f"Job {record['id']} do snapshot ignorado: tipo {record['job_type']} não registrado")
+            return 0
+        if self.store.get(record['id']) is not None:
+            return 0
+
+        job = Job(record['job_type'], record['data'], priority=record['priority'])
+        job.id = record['id']
+        job.client_key = record.get('client_key')
+        job.weight = record.get('weight', 1.0)
+        job.attempts = record.get('attempts', 0)
+        job.error = record.get('error')
+        job.deadline = record.get('deadline')
+        job.created_at = datetime.fromisoformat(record['created_at'])
+        # Seguidores voltam como jobs novos e são reagrupados pelo conteúdo
+        self._admit(job, spec)
+        return 1
+
+    def _next_job(self) -> Optional[Job]:
+        """
+        Retira do store o próximo job elegível: o de maior prioridade entre
+        os tipos que ainda não atingiram seu limite de concorrência.
+        Só chamamos dentro de contextos já protegidos pelo lock.
+        """
+        async_full = self.async_in_flight >= self.async_executor.concurrency
+        eligible_types = [
+            job_type for job_type, spec in self.job_types.items()
+            if (spec.max_concurrency is None
+                or self.running_counts.get(job_type, 0) < spec.max_concurrency)
+            # Jobs de um tipo que está formando lote ficam para o worker que o monta
+            and not self.collecting.get(job_type)
+            # Com o event loop cheio, jobs assíncronos esperam no store, na ordem da fila
+            and not (spec.is_async and async_full)
+        ]
+        if not eligible_types:
+            return None
 
-                # Atualizar as posições dos jobs na fila
-                with self.lock:
-                    self.active_job = job
-                    self._update_queue_positions()
+        job = self.store.claim(eligible_types, threading.current_thread().name)
+        if job is None:
+            return None
 
-                # Marcar job como em processamento
-                job.start()
+        self.running_counts[job.job_type] = self.running_counts.get(job.job_type, 0) + 1
+        if self.job_types[job.job_type].is_async:
+            self.async_in_flight += 1
+        self.active_jobs[job.id] = job
+        self._listen(job)
+        return job
 
-                # Verificar se o tipo de job tem um manipulador registrado
-                if job.job_type not in self.job_types:
-                    job.fail(f"Nenhum manipulador registrado para tipo de job: {job.job_type}")
+    def _wait_for_job(self) -> Optional[Job]:
+        """
+        Bloqueia até haver um job elegível, até o pedido de parada ou até o
+        autoscaling dispensar o worker (nesses dois casos retorna None).
+        Não há polling: enqueue, a liberação de uma vaga e stop_worker
+        acordam os workers pela condição work_available, e o timer mais
+        próximo do store (expiração/retenção) limita o tempo de espera.
+        """
+        while not self.stop_event.is_set():
+            with self.work_available:
+                if self._retire_surplus_worker():
+                    return None
+                expired = self.store.run_timers(time.time())
+                if not expired:
+                    job = self._next_job()
+                    if job is not None:
+                        # Timers de novas tentativas podem liberar vários jobs de uma vez;
+                        # cada worker que acorda repassa o aviso enquanto houver fila
+                        if not self.store.shared and self.store.queue_length():
+                            self.work_available.notify()
+                        return job
+                    self.work_available.wait(timeout=self._wait_timeout())
                     continue
 
-                # Executar o job
-                handler = self.job_types[job.job_type]
-                logger.info(f"Processando job {job.id} do tipo {job.job_type}")
+            # Finaliza jobs expirados fora do lock: hooks podem acessar o banco
+            self._finish_expired(expired)
+        return None
+
+    def _wait_timeout(self) -> float:
+        """Quanto um worker ocioso pode dormir sem perder um timer ou trabalho de outro processo"""
+        # Com um store compartilhado, jobs enfileirados por outros processos
+        # não geram notificação local, então consultamos o store periodicamente
+        timeout = self.store.poll_interval if self.store.shared else IDLE_WAKEUP_SECONDS
+        next_timer = self.store.next_timer_at()
+        if next_timer is not None:
+            timeout = min(timeout, max(0.0, next_timer - time.time()))
+        return timeout
+
+    def _finish_expired(self, jobs: List[Job]):
+        """Marca como expirados os jobs que passaram do prazo ainda na fila"""
+        for job in jobs:
+            self._expire_job(job)
+            self._settle_followers(job)
 
+    def _expire_job(self, job: Job):
+        spec = self.job_types.get(job.job_type)
+        self._listen(job)
+        job.expire()
+        self._release_reservation(job, spec)
+        self.store.update(job)
+        logger.info(f"Job {job.id} do tipo {job.job_type} expirou na fila sem ser processado")
+
+        if spec is not None and spec.on_expire is not None:
+            self.callbacks.submit(f"on_expire do job {job.id}", spec.on_expire, job)
+
+    def _settle_followers(self, leader: Job):
+        """Finaliza os seguidores de um líder com o mesmo desfecho dele"""
+        if leader.coalesce_key is None:
+            return
+
+        with self.lock:
+            followers = self.store.take_followers(leader.id)
+        if not followers:
+            return
+
+        spec = self.job_types.get(leader.job_type)
+        # Lido uma vez só: o resultado do líder pode ter sido descarregado em disco
+        leader_result = leader.result
+        for follower in followers:
+            if leader.status == JobStatus.EXPIRED:
+                self._expire_job(follower)
+                continue
+
+            self._listen(follower)
+            follower.started_at = leader.started_at
+            if leader.status == JobStatus.COMPLETED:
                 try:
-                    result = handler(job.data)
-                    job.complete(result)
-                    logger.info(f"Job {job.id} concluído com sucesso")
+                    result = leader_result
+                    if spec is not None and spec.share_result is not None:
+                        result = spec.share_result(follower.data, leader_result)
+                    follower.complete(result)
+                    self._advance(follower, spec, result)
                 except Exception as e:
-                    logger.error(f"Erro ao processar job {job.id}: {e}", exc_info=True)
-                    job.fail(e)
+                    logger.error(f"Erro ao aplicar resultado do job {leader.id} ao seguidor {follower.id}: {e}")
+                    follower.fail(e)
+            else:
+                follower.fail(leader.error)
+            self.store.update(follower)
+            self._release_payload(follower, spec)
+            if leader.dead_letter:
+                # Cada seguidor fica na dead-letter para ser reprocessado por conta própria
+                self._dead_letter(follower, spec)
+
+        logger.info(f"Resultado do job {leader.id} compartilhado com {len(followers)} job(s) agrupado(s)")
+
+    def _process_queue(self):
+        """Loop principal de cada worker do pool"""
+        while not self.stop_event.is_set():
+            try:
+                # Pegar o próximo job elegível (bloqueia enquanto não houver)
+                job = self._wait_for_job()
+                if job is None:
+                    break
+
+                batch = [job]
+                released = False
+                try:
+                    spec = self.job_types.get(job.job_type)
+                    if spec is not None and spec.batch_handler is not None and spec.max_batch_size > 1:
+                        self._collect_batch(batch, spec)
+                    if spec is not None and spec.reserve_rate and self._park_until_reserved(batch, spec):
+                        # Sem vaga no rate limiter agora: o worker segue com outros jobs
+                        released = True
+                    elif len(batch) > 1 and spec.batch_is_async:
+                        released = self._submit_async_batch(batch, spec)
+                    elif len(batch) > 1:
+                        self._run_batch(batch, spec)
+                    elif spec is not None and spec.is_async:
+                        # A vaga é liberada quando o handler termina no event loop
+                        released = self._submit_async(job, spec)
+                    else:
+                        self._run_job(job)
                 finally:
-                    with self.lock:
-                        self.active_job = None
-                        # Limpar jobs antigos
-                        self._cleanup_old_jobs()
-                        # Atualizar posições na fila
-                        self._update_queue_positions()
-
-            except queue.Empty:
-                # Fila vazia, simplesmente continua
-                pass
+                    if not released:
+                        self._release_slot(job, batch)
+
             except Exception as e:
                 logger.error(f"Erro no worker thread: {e}", exc_info=True)
                 time.sleep(1)  # Evita ciclo rápido em caso de erro
 
-    def _update_queue_positions(self):
-        """Atualiza as posições dos jobs na fila"""
-        # Isso é uma aproximação, já que PriorityQueue não permite iteração
-        # Só chamamos dentro de contextos já protegidos pelo lock
-        queued_jobs = [j for j in self.jobs.values() if j.status == JobStatus.QUEUED]
-        # Ordenamos por prioridade simulada (poderia ser melhorado)
-        # Na prática, a ordem real é determinada pela PriorityQueue
-        for i, job in enumerate(queued_jobs):
-            job.position_in_queue = i
-
-    def _cleanup_old_jobs(self, max_age_seconds=3600):
-        """Limpa jobs concluídos ou falhos antigos"""
-        # Só chamamos dentro de contextos já protegidos pelo lock
-        current_time = datetime.now()
-        to_remove = []
-
-        for job_id, job in self.jobs.items():
-            if job.status in (JobStatus.COMPLETED, JobStatus.FAILED, JobStatus.EXPIRED):
-                if job.completed_at:
-                    age = (current_time - job.completed_at).total_seconds()
-                    if age > max_age_seconds:
-                        to_remove.append(job_id)
-
-        for job_id in to_remove:
-            del self.jobs[job_id]
-
-        if to_remove:
-            logger.debug(f"Removidos {len(to_remove)} jobs antigos")
+    def _park_until_reserved(self, batch: List[Job], spec: JobTypeSpec) -> bool:
+        """
+        Reserva no rate limiter as chamadas (e os tokens estimados delas, com rate_tokens)
+        que o lote (ou job) ainda não tem reservadas. A reserva é dividida entre os jobs
+        (cada um guarda a sua parte das chamadas e os seus tokens), para que um job cancelado
+        ou expirado devolva só a própria parte.
+        Se a vaga só abre no futuro, devolve os jobs à fila com available_at no instante
+        reservado, onde esperam num timer do store como as novas tentativas, libera a vaga
+        do tipo e retorna True. Os jobs guardam a reserva para quando voltarem (classes
+        abaixo da mais alta só reservam quando há vaga agora e tentam de novo ao voltar).
+        """
+        if spec.rate_limiter is None or spec.rate_cost <= 0 or any(job.cancel_requested for job in batch):
+            # Cancelados seguem para _run_job/_run_batch, que os finalizam
+            return False
+
+        def calls(size):
+            # Um lote faz uma chamada: o custo fracionário por job é arredondado para cima
+            return max(1, math.ceil(spec.rate_cost * size - 1e-9)) if size else 0
+
+        needed = calls(len(batch))
+        missing = max(0, needed - sum(job.rate_reserved for job in batch))
+        # O que falta vai para os jobs abaixo da sua parte nas chamadas do lote
+        job_requests, left = [], missing
+        for i, job in enumerate(batch):
+            take = min(left, max(0, calls(i + 1) - calls(i) - job.rate_reserved))
+            job_requests.append(take)
+            left -= take
+        job_tokens = [0] * len(batch)
+        if spec.rate_tokens is not None:
+            job_tokens = [max(0, spec.rate_tokens(job.data) - job.rate_reserved_tokens) for job in batch]
+        missing_tokens = sum(job_tokens)
+        if not missing and not missing_tokens:
+            return False
+
+        slot, reserved, seconds = spec.rate_limiter.try_reserve(missing, spec.capacity_class, missing_tokens)
+        if reserved:
+            for job, requests, tokens in zip(batch, job_requests, job_tokens):
+                job.rate_reserved += requests
+                job.rate_reserved_tokens += tokens
+                job.rate_reserved_seconds += seconds * requests / missing if missing else 0.0
+        if slot <= time.time():
+            return False
+
+        # Sob o lock, nenhum worker retira os jobs de volta antes de a vaga ser liberada
+        with self.lock:
+            for job in batch:
+                job.available_at = slot
+                self.store.requeue(job)
+            self._release_slot(batch[0], batch)
+        logger.info(f"{len(batch)} job(s) do tipo {batch[0].job_type} aguardando o rate limiter por "
+                    f"{slot - time.time():.1f}s")
+        return True
+
+    def _release_reservation(self, job: Job, spec: Optional[JobTypeSpec]):
+        """Devolve ao rate limiter as requisições e os tokens reservados por um job que não vai rodar"""
+        if (job.rate_reserved or job.rate_reserved_tokens) and spec is not None and spec.rate_limiter is not None:
+            # Os segundos reservados, não os da taxa atual: no modo adaptativo ela pode ter mudado
+            spec.rate_limiter.release(job.rate_reserved, job.rate_reserved_tokens, job.rate_reserved_seconds)
+        job.rate_reserved = job.rate_reserved_tokens = 0
+        job.rate_reserved_seconds = 0.0
+
+    def _use_reservation(self, jobs: List[Job], spec: JobTypeSpec):
+        """Entrega ao handler as requisições e os tokens reservados pelos jobs; wait_if_needed os consome sem esperar"""
+        reserved = reserved_tokens = 0
+        for job in jobs:
+            reserved, job.rate_reserved = reserved + job.rate_reserved, 0
+            reserved_tokens, job.rate_reserved_tokens = reserved_tokens + job.rate_reserved_tokens, 0
+            job.rate_reserved_seconds = 0.0
+        return using_reservation(spec.rate_limiter, reserved, reserved_tokens)
+
+    def _release_slot(self, job: Job, batch: List[Job]):
+        """Tira os jobs de active_jobs e libera a vaga que ocupavam"""
+        with self.lock:
+            for member in batch:
+                self.active_jobs.pop(member.id, None)
+            # Um lote ocupa uma única vaga do tipo
+            self.running_counts[job.job_type] -= 1
+            spec = self.job_types.get(job.job_type)
+            if spec is not None and spec.is_async:
+                self.async_in_flight -= 1
+            # A vaga liberada pode destravar um job do mesmo tipo
+            self.work_available.notify()
+
+    def _collect_batch(self, batch: List[Job], spec: JobTypeSpec):
+        """
+        Completa o lote iniciado por batch[0] com jobs do mesmo tipo que já estão
+        na fila ou que chegam dentro de spec.batch_linger segundos
+        """
+        job_type = batch[0].job_type
+        deadline = time.monotonic() + spec.batch_linger
+        with self.lock:
+            self.collecting[job_type] = self.collecting.get(job_type, 0) + 1
+            try:
+                while len(batch) < spec.max_batch_size and not self.stop_event.is_set():
+                    job = self.store.claim([job_type], threading.current_thread().name)
+                    if job is not None:
+                        self.active_jobs[job.id] = job
+                        self._listen(job)
+                        batch.append(job)
+                        continue
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.batch_arrived.wait(timeout=min(remaining, self._wait_timeout()))
+            finally:
+                self.collecting[job_type] -= 1
+                # Jobs que chegaram depois do lote cheio voltam para os demais workers
+                self.work_available.notify()
+
+    def _start_batch(self, jobs: List[Job], spec: JobTypeSpec) -> List[Job]:
+        """Finaliza os cancelados e marca os demais jobs do lote como em processamento"""
+        # Cancelados entre a retirada da fila e o início não entram no lote
+        for job in [job for job in jobs if job.cancel_requested]:
+            self._finish_cancelled(job, spec)
+        jobs = [job for job in jobs if not job.cancel_requested]
+        for job in jobs:
+            job.start()
+            self.store.update(job)
+        return jobs
+
+    def _run_batch(self, jobs: List[Job], spec: JobTypeSpec):
+        """Executa um lote de jobs com uma única chamada ao batch_handler do tipo"""
+        jobs = self._start_batch(jobs, spec)
+        if not jobs:
+            return
+
+        logger.info(f"Processando lote de {len(jobs)} jobs do tipo {jobs[0].job_type} ({threading.current_thread().name})")
+
+        try:
+            with self._use_reservation(jobs, spec):
+                results = spec.batch_handler([job.data for job in jobs])
+        except Exception as e:
+            results = e
+        self._finish_batch(jobs, spec, results)
+
+    def _submit_async_batch(self, batch: List[Job], spec: JobTypeSpec) -> bool:
+        """Entrega um lote com batch_handler assíncrono ao event loop; a vaga é liberada quando ele termina"""
+        jobs = self._start_batch(batch, spec)
+        if not jobs:
+            return False
+        logger.info(f"Processando lote de {len(jobs)} jobs do tipo {jobs[0].job_type} no event loop")
+
+        def on_done(results, error):
+            try:
+                self._finish_batch(jobs, spec, error if error is not None else results)
+            except Exception as e:
+                logger.error(f"Erro ao finalizar lote assíncrono do tipo {jobs[0].job_type}: {e}", exc_info=True)
+            finally:
+                self._release_slot(batch[0], batch)
+
+        reservation = self._use_reservation(jobs, spec)
+
+        async def run(items):
+            with reservation:
+                return await spec.batch_handler(items)
+
+        self.async_executor.submit(run, [job.data for job in jobs], on_done)
+        return True
+
+    def _finish_batch(self, jobs: List[Job], spec: JobTypeSpec, results):
+        """Aplica a cada job do lote o seu resultado (ou a exceção que derrubou o lote inteiro)"""
+        if not isinstance(results, Exception) and len(results) != len(jobs):
+            results = ValueError(f"Lote com {len(jobs)} jobs retornou {len(results)} resultados")
+        if isinstance(results, Exception):
+            logger.error(f"Erro ao processar lote de jobs do tipo {jobs[0].job_type}: {results}", exc_info=results)
+            results = [results] * len(jobs)
+
+        for job, result in zip(jobs, results):
+            if isinstance(result, Exception):
+                self._handle_failure(job, spec, result)
+                continue
+            job.complete(result)
+            # O lote ocupa um slot só: cada job custou uma fração do tempo
+            self._record_processing_time(job, len(jobs))
+            self._advance(job, spec, result)
+            self.store.update(job)
+            self._release_payload(job, spec)
+            self._settle_followers(job)
+
+    def _run_job(self, job: Job):
+        """Executa um job com o manipulador registrado para seu tipo"""
+        if job.cancel_requested:
+            # Cancelado entre a retirada da fila e o início
+            self._finish_cancelled(job, self.job_types.get(job.job_type))
+            return
+
+        # Marcar job como em processamento
+        job.start()
+        self.store.update(job)
+
+        # Verificar se o tipo de job tem um manipulador registrado
+        spec = self.job_types.get(job.job_type)
+        if spec is None:
+            job.fail(f"Nenhum manipulador registrado para tipo de job: {job.job_type}")
+            self.store.update(job)
+            return
+
+        # Executar o job
+        logger.info(f"Processando job {job.id} do tipo {job.job_type} ({threading.current_thread().name})")
+
+        token = _current_job.set(job)
+        try:
+            with self._use_reservation([job], spec):
+                result = spec.handler(job.data)
+        except Exception as e:
+            self._handle_failure(job, spec, e)
+            return
+        finally:
+            _current_job.reset(token)
+
+        self._complete_job(job, spec, result)
+
+    def _submit_async(self, job: Job, spec: JobTypeSpec) -> bool:
+        """Marca o job como em processamento e entrega seu handler assíncrono ao event loop"""
+        if job.cancel_requested:
+            self._finish_cancelled(job, spec)
+            return False
+
+        job.start()
+        self.store.update(job)
+        logger.info(f"Processando job {job.id} do tipo {job.job_type} no event loop ({self.async_in_flight} em andamento)")
+
+        def on_done(result, error):
+            try:
+                if error is not None:
+                    self._handle_failure(job, spec, error)
+                else:
+                    self._complete_job(job, spec, result)
+            except Exception as e:
+                logger.error(f"Erro ao finalizar job assíncrono {job.id}: {e}", exc_info=True)
+            finally:
+                self._release_slot(job, [job])
+
+        reservation = self._use_reservation([job], spec)
+
+        async def run(data):
+            # Cada tarefa do loop tem seu próprio contexto: raise_if_cancelled enxerga este job
+            _current_job.set(job)
+            with reservation:
+                return await spec.handler(data)
+
+        self.async_executor.submit(run, job.data, on_done)
+        return True
+
+    def _complete_job(self, job: Job, spec: JobTypeSpec, result: Any):
+        job.complete(result)
+        logger.info(f"Job {job.id} concluído com sucesso")
+        self._record_processing_time(job)
+        self._advance(job, spec, result)
+        self.store.update(job)
+        self._release_payload(job, spec)
+        self._settle_followers(job)
+
+    def _advance(self, job: Job, spec: Optional[JobTypeSpec], result: Any):
+        """
+        Enfileira o próximo estágio de um job concluído, se o tipo tiver um. Chamado antes
+        de _release_payload, enquanto o job ainda tem os dados de que o estágio precisa.
+        """
+        if spec is None or spec.next_stage is None or job.cancel_requested:
+            return
+        try:
+            job.next_job_id = spec.next_stage(job, result)
+        except Exception as e:
+            # O estágio concluído continua valendo; só o restante do pipeline não foi agendado
+            logger.error(f"Erro ao enfileirar o próximo estágio do job {job.id}: {e}", exc_info=True)
+            return
+        if job.next_job_id:
+            logger.info(f"Job {job.id} concluído; próximo estágio enfileirado como {job.next_job_id}")
+
+    def _record_processing_time(self, job: Job, batch_size: int = 1):
+        """Alimenta as estatísticas de tempo de processamento com um job concluído"""
+        seconds = (job.completed_at - job.started_at).total_seconds() / batch_size
+        stats = self.processing_stats.get(job.job_type)
+        if stats is not None:
+            stats.observe(seconds)
+        self.overall_stats.observe(seconds)
+
+    def _service_time(self, job_type: str) -> Tuple[float, float]:
+        """(p50, p90) do tempo de processamento do tipo; sem medições, o da fila toda ou o padrão"""
+        for stats in (self.processing_stats.get(job_type), self.overall_stats):
+            service = stats.service_time() if stats is not None else None
+            if service is not None:
+                return service
+        return DEFAULT_SECONDS_PER_JOB, DEFAULT_SECONDS_PER_JOB
+
+    def _drain_estimate(self, queue_lengths: Dict[str, int], fraction: float = 1.0) -> Tuple[float, float]:
+        """
+        Tempo (p50, p90) para escoar a fração informada dos jobs na fila.
+
+        O gargalo pode ser o pool de workers, o event loop dos handlers assíncronos,
+        o limite de concorrência de um tipo ou a folga do rate limiter para as chamadas
+        que esses jobs vão fazer; vale o mais lento deles.
+        """
+        with self.lock:
+            specs = {job_type: self.job_types.get(job_type) for job_type in queue_lengths}
+
+        estimates = []
+        work = {False: [0.0, 0.0], True: [0.0, 0.0]}  # segundos de processamento nos workers / no event loop
+        calls = {}  # RateLimiter -> chamadas que esses jobs vão fazer
+        for job_type, count in queue_lengths.items():
+            count *= fraction
+            spec = specs[job_type]
+            service = self._service_time(job_type)
+            pool = work[spec is not None and spec.is_async]
+            pool[0] += count * service[0]
+            pool[1] += count * service[1]
+            if spec is None:
+                continue
+            if spec.max_concurrency:
+                estimates.append(drain_time(count, service, spec.max_concurrency))
+            if spec.rate_limiter is not None:
+                key = (spec.rate_limiter, spec.capacity_class)
+                calls[key] = calls.get(key, 0.0) + count * spec.rate_cost
+
+        for pool, parallelism in ((work[False], self.num_workers), (work[True], self.async_executor.concurrency)):
+            estimates.append((pool[0] / parallelism, pool[1] / parallelism))
+        for (limiter, capacity_class), count in calls.items():
+            seconds = limiter.seconds_until_capacity(count, capacity_class)
+            estimates.append((seconds, seconds))
+        return slowest(estimates)
+
+    def _estimate_waits(self, jobs: List[Job], queue_lengths: Optional[Dict[str, int]] = None):
+        """Preenche a espera estimada dos jobs na fila: o tempo para escoar os jobs à frente de cada um"""
+        if queue_lengths is None:
+            queue_lengths = self.store.queue_lengths()
+        total = sum(queue_lengths.values())
+        if not total:
+            return
+        for job in jobs:
+            if job.status == JobStatus.QUEUED:
+                job.wait_estimate = self._drain_estimate(queue_lengths, min(job.position_in_queue / total, 1.0))
+
+    def _release_payload(self, job: Job, spec: Optional[JobTypeSpec]):
+        """Descarta os dados de entrada de um job concluído, se o tipo pedir"""
+        if spec is None or not spec.drop_payload or job.status != JobStatus.COMPLETED:
+            return
+        job.drop_payload(spec.keep_fields)
+        self.store.compact(job)
+
+    def _handle_failure(self, job: Job, spec: JobTypeSpec, error: Exception):
+        """
+        Reagenda o job com backoff se a política do tipo permitir; caso contrário
+        o marca como falho e, se o tipo tem política de retry, o move para a dead-letter
+        """
+        if isinstance(error, JobCancelled) or self.store.cancel_requested(job.id):
+            # Cancelado durante o processamento: não há nova tentativa
+            self._finish_cancelled(job, spec)
+            return
+
+        policy = spec.retry_policy
+        if policy is not None and policy.should_retry(error, job.attempts):
+            delay = policy.backoff(job.attempts, error)
+            job.retry(error, time.time() + delay)
+            # O job espera em um timer do store, sem ocupar nenhum worker
+            self.store.requeue(job)
+            logger.warning(f"Job {job.id} falhou na tentativa {job.attempts}/{policy.max_attempts}: {error}. "
+                           f"Nova tentativa em {delay:.1f}s")
+            return
+
+        logger.error(f"Erro ao processar job {job.id}: {error}", exc_info=error)
+        job.fail(error)
+        self.store.update(job)
+
+        if policy is not None:
+            self._dead_letter(job, spec)
+
+        self._settle_followers(job)
 
+    def _dead_letter(self, job: Job, spec: JobTypeSpec):
+        """Move um job falho para a dead-letter e executa o hook do tipo"""
+        job.dead_letter = True
+        self.store.dead_letter(job)
+        logger.warning(f"Job {job.id} do tipo {job.job_type} movido para a dead-letter após {job.attempts} tentativa(s)")
+        if spec.on_dead_letter is not None:
+            self.callbacks.submit(f"on_dead_letter do job {job.id}", spec.on_dead_letter, job)
 
 # Instância global para uso em todo o aplicativo
 job_queue = JobQueue()
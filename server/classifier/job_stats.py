@@ -0,0 +1,109 @@
+import math
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+# Peso de cada novo tempo de processamento na média móvel (EWMA) e no decaimento dos quantis:
+# 0.05 faz as últimas ~20 medições dominarem a estimativa
+DEFAULT_STATS_ALPHA = 0.05
+
+# Razão entre os limites de buckets vizinhos do sketch: quantis com erro relativo de ~2,5%
+SKETCH_GAMMA = 1.05
+
+# Menor tempo registrado, para o logaritmo dos buckets (jobs instantâneos caem no primeiro bucket)
+SKETCH_MIN_SECONDS = 0.001
+
+# Tempo assumido por job enquanto o tipo ainda não tem medições
+DEFAULT_SECONDS_PER_JOB = 3.0
+
+
+class QuantileSketch:
+    """
+    Quantis aproximados com buckets logarítmicos e decaimento exponencial.
+
+    Cada medição pesa 1/(1 - alpha) vezes a anterior, então as antigas perdem
+    importância sem precisar ser removidas; a memória é um bucket por faixa de
+    tempo observada (algumas dezenas), não uma entrada por medição.
+    """
+    def __init__(self, alpha: float = DEFAULT_STATS_ALPHA, gamma: float = SKETCH_GAMMA):
+        self.gamma = gamma
+        self.log_gamma = math.log(gamma)
+        self.growth = 1.0 / (1.0 - alpha)
+        self.weight = 1.0  # peso da próxima medição
+        self.buckets = {}  # índice -> peso acumulado dos tempos em (gamma^(i-1), gamma^i]
+        self.total = 0.0
+
+    def add(self, value: float):
+        index = math.ceil(math.log(max(value, SKETCH_MIN_SECONDS)) / self.log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0.0) + self.weight
+        self.total += self.weight
+        self.weight *= self.growth
+        if self.weight > 1e9:
+            self._rescale()
+
+    def _rescale(self):
+        """Volta os pesos para perto de 1 e descarta buckets que já não influenciam os quantis"""
+        scale = 1.0 / self.weight
+        self.buckets = {index: weight * scale for index, weight in self.buckets.items()
+                        if weight * scale > 1e-6}
+        self.total = sum(self.buckets.values())
+        self.weight = 1.0
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Tempo abaixo do qual fica a fração q das medições recentes (None sem medições)"""
+        if not self.buckets:
+            return None
+        rank = q * self.total
+        accumulated = 0.0
+        for index in sorted(self.buckets):
+            accumulated += self.buckets[index]
+            if accumulated >= rank:
+                break
+        # Ponto do bucket com o mesmo erro relativo para os dois limites
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+
+class ProcessingStats:
+    """Média móvel e quantis do tempo de processamento de um tipo de job"""
+    def __init__(self, alpha: float = DEFAULT_STATS_ALPHA):
+        self.alpha = alpha
+        self.ewma = None
+        self.samples = 0
+        self.sketch = QuantileSketch(alpha)
+        self.lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self.lock:
+            self.ewma = seconds if self.ewma is None else self.ewma + self.alpha * (seconds - self.ewma)
+            self.sketch.add(seconds)
+            self.samples += 1
+
+    def service_time(self) -> Optional[Tuple[float, float]]:
+        """(p50, p90) do tempo de processamento, ou None se ainda não houve medições"""
+        with self.lock:
+            if not self.samples:
+                return None
+            return self.sketch.quantile(0.5), self.sketch.quantile(0.9)
+
+    def to_dict(self) -> Dict:
+        with self.lock:
+            return {
+                "samples": self.samples,
+                "ewma": round(self.ewma, 3) if self.ewma is not None else None,
+                "p50": round(self.sketch.quantile(0.5), 3) if self.samples else None,
+                "p90": round(self.sketch.quantile(0.9), 3) if self.samples else None,
+            }
+
+
+def drain_time(count: int, service: Tuple[float, float], parallelism: int) -> Tuple[float, float]:
+    """(p50, p90) para `parallelism` slots processarem `count` jobs com o tempo de serviço informado"""
+    rounds = count / max(parallelism, 1)
+    return rounds * service[0], rounds * service[1]
+
+
+def slowest(estimates: Iterable[Tuple[float, float]]) -> Tuple[float, float]:
+    """O gargalo entre várias estimativas (p50, p90): a maior de cada quantil"""
+    p50 = p90 = 0.0
+    for estimate_p50, estimate_p90 in estimates:
+        p50 = max(p50, estimate_p50)
+        p90 = max(p90, estimate_p90)
+    return p50, p90
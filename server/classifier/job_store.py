@@ -0,0 +1,1032 @@
+import os
+import heapq
+import json
+import random
+import socket
+import tempfile
+import threading
+import time
+import logging
+from collections import OrderedDict
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Máximo de jobs finalizados guardados em memória; acima disso os menos
+# consultados recentemente são descartados antes do fim da retenção
+DEFAULT_MAX_RETAINED_JOBS = 2000
+
+# Resultados maiores que isso (JSON, em bytes) vão para o disco em vez de ficar na memória
+DEFAULT_SPILL_THRESHOLD = 64 * 1024
+
+# Custo virtual (segundos) de cada job no fair queuing: os jobs de um mesmo cliente
+# são agendados este tempo (dividido pelo peso) um depois do outro
+FAIR_SHARE_QUANTUM = 1.0
+
+# Segundos de espera que valem um nível de prioridade: um job de prioridade 2 que
+# já esperou isso empata com um de prioridade 1 recém-chegado (nenhum job fica parado para sempre)
+DEFAULT_PRIORITY_AGING = 30.0
+
+# Tempo que um worker pode segurar um job antes de ele voltar para a fila
+# (protege contra processos que morrem no meio do processamento)
+DEFAULT_LEASE_SECONDS = 600
+
+# Intervalo entre consultas ao banco quando não há notificação local de trabalho
+DEFAULT_POLL_INTERVAL = 1.0
+
+# Máximo de jobs guardados na dead-letter em memória (os mais antigos são descartados)
+DEFAULT_DEAD_LETTER_LIMIT = 500
+
+
+class _IndexNode:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, levels):
+        self.key = key
+        self.next = [None] * levels
+        self.width = [1] * levels
+
+
+class OrderedIndex:
+    """
+    Conjunto ordenado com consulta de posição (skip list indexável).
+
+    Cada link guarda quantos elementos ele "pula", o que permite inserir,
+    remover e calcular o rank de uma chave em O(log n) esperado, sem
+    percorrer a estrutura inteira. As chaves devem ser únicas e comparáveis.
+    """
+    MAX_LEVELS = 24
+
+    def __init__(self):
+        self.size = 0
+        self.head = _IndexNode(None, self.MAX_LEVELS)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator:
+        node = self.head.next[0]
+        while node is not None:
+            yield node.key
+            node = node.next[0]
+
+    def _random_levels(self) -> int:
+        levels = 1
+        while levels < self.MAX_LEVELS and random.random() < 0.5:
+            levels += 1
+        return levels
+
+    def _search(self, key) -> Tuple[List[_IndexNode], List[int]]:
+        """Último nó com chave < key em cada nível e os passos dados em cada nível"""
+        chain = [None] * self.MAX_LEVELS
+        steps = [0] * self.MAX_LEVELS
+        node = self.head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level] is not None and node.next[level].key < key:
+                steps[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        return chain, steps
+
+    def insert(self, key) -> None:
+        chain, steps = self._search(key)
+        levels = self._random_levels()
+        new_node = _IndexNode(key, levels)
+
+        distance = 0
+        for level in range(levels):
+            prev = chain[level]
+            new_node.next[level] = prev.next[level]
+            prev.next[level] = new_node
+            new_node.width[level] = prev.width[level] - distance
+            prev.width[level] = distance + 1
+            distance += steps[level]
+        for level in range(levels, self.MAX_LEVELS):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key) -> None:
+        chain, _ = self._search(key)
+        target = chain[0].next[0]
+        if target is None or target.key != key:
+            raise KeyError(key)
+
+        levels = len(target.next)
+        for level in range(levels):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(levels, self.MAX_LEVELS):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def rank(self, key) -> int:
+        """Quantidade de elementos com chave menor que key"""
+        _, steps = self._search(key)
+        return sum(steps)
+
+    def first(self):
+        """Menor chave do índice (None se vazio)"""
+        node = self.head.next[0]
+        return node.key if node is not None else None
+
+
+class JobStore:
+    """
+    Interface de armazenamento dos jobs usada pelo JobQueue.
+
+    O store guarda os jobs e decide qual é o próximo a ser processado;
+    o JobQueue cuida dos workers, dos limites de concorrência e dos manipuladores.
+    Todas as operações devem ser seguras para uso concorrente.
+    """
+    # True quando outros processos enxergam os mesmos jobs
+    shared = False
+    poll_interval = None
+    lease_seconds = None  # validade do lease de um job em processamento (None: stores sem lease)
+    priority_aging = DEFAULT_PRIORITY_AGING
+
+    @staticmethod
+    def _fair_start(client_tail: Optional[float], now: float, weight: float) -> float:
+        """
+        Instante virtual de um novo job do cliente (virtual clock): logo depois do
+        último job dele ainda na fila, ou de agora se ele não tem nenhum. Um cliente
+        com 500 jobs na fila não passa na frente de quem acabou de chegar.
+        """
+        return max(now, client_tail or 0.0) + FAIR_SHARE_QUANTUM / max(weight, 0.01)
+
+    def _dispatch_at(self, start: float, priority: int) -> float:
+        """Ordem de despacho: prioridades valem priority_aging segundos de espera cada"""
+        return start + priority * self.priority_aging
+
+    def add(self, job) -> None:
+        """Persiste um job novo na fila"""
+        raise NotImplementedError
+
+    def claim(self, job_types: Iterable[str], worker_id: str):
+        """
+        Retira atomicamente o job de maior prioridade entre os tipos informados
+        e o marca como em processamento. Retorna None se não houver nenhum.
+        """
+        raise NotImplementedError
+
+    def update(self, job) -> None:
+        """Persiste mudanças de status, resultado ou erro de um job"""
+        raise NotImplementedError
+
+    def renew_leases(self, job_ids: Iterable[str]) -> None:
+        """Renova o lease dos jobs que este processo ainda está processando"""
+
+    def compact(self, job) -> None:
+        """Persiste os dados de entrada reduzidos de um job concluído (Job.drop_payload)"""
+
+    def requeue(self, job) -> None:
+        """
+        Devolve à fila um job que já existe no store (nova tentativa ou saída da
+        dead-letter). Ele só pode ser retirado a partir de job.available_at.
+        """
+        raise NotImplementedError
+
+    def withdraw(self, job_id: str):
+        """
+        Retira atomicamente um job que ainda aguarda (na fila, seguidor de um líder ou
+        esperando uma nova tentativa), para ser cancelado. Retorna None se ele já foi
+        retirado por um worker, já terminou ou não existe.
+        """
+        raise NotImplementedError
+
+    def request_cancel(self, job_id: str) -> bool:
+        """Registra o pedido de cancelamento de um job em processamento (False se ele já terminou)"""
+        raise NotImplementedError
+
+    def cancel_requested(self, job_id: str) -> bool:
+        """Se o cancelamento do job foi pedido, inclusive por outro processo"""
+        raise NotImplementedError
+
+    def dead_letter(self, job) -> None:
+        """Guarda um job que falhou de vez na dead-letter, fora da retenção normal"""
+        raise NotImplementedError
+
+    def dead_letters(self, limit: int = 50) -> List:
+        """Jobs da dead-letter, do mais recente para o mais antigo"""
+        raise NotImplementedError
+
+    def remove_dead_letter(self, job_id: str):
+        """Retira um job da dead-letter e o retorna (None se ele não estiver lá)"""
+        raise NotImplementedError
+
+    def get(self, job_id: str):
+        """Obtém um job pelo ID (None se não existir)"""
+        raise NotImplementedError
+
+    def queue_length(self) -> int:
+        """Quantidade de jobs aguardando processamento"""
+        raise NotImplementedError
+
+    def queued(self, limit: Optional[int] = None) -> List:
+        """Jobs aguardando, na ordem em que serão despachados"""
+        raise NotImplementedError
+
+    def queue_lengths(self) -> Dict[str, int]:
+        """Quantidade de jobs aguardando por tipo (só os tipos com jobs na fila)"""
+        raise NotImplementedError
+
+    def find_inflight(self, coalesce_key: str):
+        """Líder na fila ou em processamento com a chave de conteúdo informada (ou None)"""
+        raise NotImplementedError
+
+    def pending(self) -> List:
+        """
+        Todos os jobs ainda não processados (na fila, seguidores e novas tentativas
+        agendadas), para o snapshot do desligamento. Só usado por stores locais.
+        """
+        raise NotImplementedError
+
+    def take_followers(self, leader_id: str) -> List:
+        """
+        Retira os seguidores ainda aguardando o líder informado, para serem
+        finalizados com o resultado dele. Cada seguidor é entregue uma única vez.
+        """
+        raise NotImplementedError
+
+    def next_timer_at(self) -> Optional[float]:
+        """Instante (time.time()) do próximo timer de expiração/retenção, se houver"""
+        return None
+
+    def run_timers(self, now: float) -> List:
+        """
+        Processa os timers vencidos: descarta jobs finalizados cuja retenção
+        acabou e retira da fila os jobs que passaram do prazo (job.deadline).
+        Retorna os jobs retirados por prazo, para o JobQueue marcá-los como expirados.
+        """
+        raise NotImplementedError
+
+
+class ResultSpill:
+    """
+    Descarrega em disco os resultados grandes de jobs finalizados, um arquivo
+    JSON por id do job. O Job guarda só o caminho e lê o arquivo sob demanda.
+    """
+    def __init__(self, directory: str, threshold: int = DEFAULT_SPILL_THRESHOLD):
+        self.directory = directory
+        self.threshold = threshold
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def offload(self, job) -> bool:
+        """Grava o resultado do job em disco se ele passar do limite; retorna se descarregou"""
+        if job.result_path is not None or not job.has_result:
+            return False
+        try:
+            encoded = json.dumps(job.result).encode('utf-8')
+        except (TypeError, ValueError):
+            return False  # resultado não serializável continua em memória
+        if len(encoded) < self.threshold:
+            return False
+
+        path = self._path(job.id)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Grava em um arquivo temporário e renomeia: leitores nunca veem um arquivo pela metade
+            with open(f"{path}.tmp", 'wb') as f:
+                f.write(encoded)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logger.warning(f"Não foi possível descarregar o resultado do job {job.id} em disco: {e}")
+            return False
+
+        job.offload_result(path)
+        logger.debug(f"Resultado do job {job.id} ({len(encoded)} bytes) descarregado em {path}")
+        return True
+
+    def discard(self, job_id: str):
+        try:
+            os.remove(self._path(job_id))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Não foi possível remover o resultado descarregado do job {job_id}: {e}")
+
+    @staticmethod
+    def load(path: str):
+        try:
+            with open(path, 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Resultado descarregado em {path} indisponível: {e}")
+            return None
+
+
+class MemoryJobStore(JobStore):
+    """
+    Store em memória, local ao processo (comportamento original da fila).
+
+    Os jobs aguardando ficam em um OrderedIndex por tipo, ordenados por
+    (dispatch_at, seq): o instante virtual do cliente (fair queuing entre
+    job.client_key) mais o envelhecimento da prioridade. Posição na fila, tamanho
+    da fila e a prévia dos próximos jobs são respondidos pelos índices, sem varrer self.jobs.
+
+    Prazos de jobs na fila e retenção de jobs finalizados ficam em uma heap
+    de timers (instante, seq, ação, id). Entradas de jobs que já saíram da fila
+    são descartadas quando vencem, então o custo da limpeza é proporcional
+    aos timers que vencem, e não ao total de jobs guardados.
+
+    Jobs agrupados a um líder (job.leader_id) não entram nos índices de despacho:
+    ficam em self.followers até o líder terminar. Jobs reagendados para uma nova
+    tentativa ficam em self.delayed e esperam um timer RELEASE antes de voltar aos índices.
+
+    A memória é limitada: só max_jobs jobs finalizados ficam guardados (LRU por
+    consulta em self.finished) e, com um ResultSpill, resultados grandes vão para o disco.
+    Jobs na fila, em processamento ou na dead-letter nunca são descartados pelo limite.
+    """
+    EXPIRE = 'expire'
+    EVICT = 'evict'
+    RELEASE = 'release'
+
+    def __init__(self, dead_letter_limit: int = DEFAULT_DEAD_LETTER_LIMIT,
+                 max_jobs: int = DEFAULT_MAX_RETAINED_JOBS, spill: Optional[ResultSpill] = None,
+                 priority_aging: float = DEFAULT_PRIORITY_AGING):
+        self.jobs = {}  # id -> job
+        self.ready = {}  # job_type -> OrderedIndex de chaves dos jobs aguardando
+        self.keys = {}  # id do job aguardando -> chave no índice
+        self.by_key = {}  # chave -> job
+        self.clients = {}  # client_key -> [instante virtual do último job, jobs aguardando]
+        self.priority_aging = priority_aging
+        self.timers = []  # heap de (instante, seq, ação, id do job)
+        self.inflight = {}  # chave de conteúdo -> líder na fila ou em processamento
+        self.followers = {}  # id do líder -> seguidores aguardando o resultado dele
+        self.delayed = set()  # ids dos jobs esperando o timer RELEASE de uma nova tentativa
+        self.dead = OrderedDict()  # id -> job na dead-letter, do mais antigo para o mais novo
+        self.dead_letter_limit = dead_letter_limit
+        self.finished = OrderedDict()  # ids dos jobs finalizados, do menos para o mais consultado
+        self.max_jobs = max_jobs
+        self.spill = spill
+        self.lock = threading.RLock()
+        self._sequence = 0
+
+    def add(self, job) -> None:
+        with self.lock:
+            self.jobs[job.id] = job
+            if job.leader_id is not None:
+                self.followers.setdefault(job.leader_id, []).append(job)
+                if job.deadline is not None:
+                    self._schedule(job.deadline, self.EXPIRE, job.id)
+                return
+
+            if job.coalesce_key is not None:
+                self.inflight[job.coalesce_key] = job
+            self._index(job)
+
+    def _index(self, job):
+        """Coloca um job nos índices de despacho"""
+        # Só chamamos dentro de contextos já protegidos pelo lock
+        self._sequence += 1
+        client = self.clients.get(job.client_key)
+        start = self._fair_start(client[0] if client else None, time.time(), job.weight)
+        self.clients[job.client_key] = [start, (client[1] if client else 0) + 1]
+        key = (self._dispatch_at(start, job.priority), self._sequence)
+        self.ready.setdefault(job.job_type, OrderedIndex()).insert(key)
+        self.keys[job.id] = key
+        self.by_key[key] = job
+        if job.deadline is not None:
+            self._schedule(job.deadline, self.EXPIRE, job.id)
+
+    def _schedule(self, when: float, action: str, job_id: str):
+        # Só chamamos dentro de contextos já protegidos pelo lock
+        self._sequence += 1
+        heapq.heappush(self.timers, (when, self._sequence, action, job_id))
+
+    def _detach(self, job_id: str):
+        """Retira um job aguardando dos índices de despacho"""
+        # Só chamamos dentro de contextos já protegidos pelo lock
+        key = self.keys.pop(job_id)
+        job = self.by_key.pop(key)
+        self.ready[job.job_type].remove(key)
+        client = self.clients[job.client_key]
+        client[1] -= 1
+        if not client[1]:
+            # Cliente sem jobs na fila volta a ser agendado a partir de agora
+            del self.clients[job.client_key]
+        return job
+
+    def claim(self, job_types: Iterable[str], worker_id: str):
+        with self.lock:
+            best_type, best_key = None, None
+            for job_type in job_types:
+                index = self.ready.get(job_type)
+                key = index.first() if index else None
+                if key is not None and (best_key is None or key < best_key):
+                    best_type, best_key = job_type, key
+
+            if best_type is None:
+                return None
+
+            return self._detach(self.by_key[best_key].id)
+
+    def update(self, job) -> None:
+        # Os objetos Job já são a fonte da verdade em memória;
+        # só agendamos a retenção quando o job termina
+        from .job_queue import JobStatus
+
+        if job.status not in JobStatus.FINISHED:
+            return
+
+        if self.spill is not None:
+            # Escrita em disco fora do lock
+            self.spill.offload(job)
+
+        with self.lock:
+            if job.coalesce_key is not None and self.inflight.get(job.coalesce_key) is job:
+                del self.inflight[job.coalesce_key]
+            # Atualizações de um job já finalizado (resultado compartilhado, next_job_id,
+            # cancel_requested) não agendam outro EVICT: só a transição para o estado final
+            if job.id not in self.finished:
+                self._schedule(time.time() + job.result_ttl, self.EVICT, job.id)
+            self.finished[job.id] = None
+            self.finished.move_to_end(job.id)
+            evicted = []
+            while len(self.finished) > self.max_jobs:
+                oldest_id, _ = self.finished.popitem(last=False)
+                self.jobs.pop(oldest_id, None)
+                evicted.append(oldest_id)
+
+        if evicted:
+            logger.debug(f"Limite de {self.max_jobs} jobs retidos: descartados {len(evicted)} job(s) menos consultados")
+            self._discard_spilled(evicted)
+
+    def _discard_spilled(self, job_ids: Iterable[str]):
+        if self.spill is not None:
+            for job_id in job_ids:
+                self.spill.discard(job_id)
+
+    def requeue(self, job) -> None:
+        with self.lock:
+            self.jobs[job.id] = job
+            if job.coalesce_key is not None:
+                self.inflight.setdefault(job.coalesce_key, job)
+            if job.available_at is not None and job.available_at > time.time():
+                self.delayed.add(job.id)
+                self._schedule(job.available_at, self.RELEASE, job.id)
+            else:
+                self._index(job)
+
+    def withdraw(self, job_id: str):
+        with self.lock:
+            # Cada caso sai da sua própria estrutura, sem varrer a fila
+            if job_id in self.keys:
+                return self._detach(job_id)
+            if job_id in self.delayed:
+                self.delayed.discard(job_id)
+                return self.jobs.get(job_id)
+            return self._detach_follower(job_id)
+
+    def request_cancel(self, job_id: str) -> bool:
+        from .job_queue import JobStatus
+
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status in JobStatus.FINISHED:
+                return False
+            job.cancel_requested = True
+            return True
+
+    def cancel_requested(self, job_id: str) -> bool:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return job is not None and job.cancel_requested
+
+    def dead_letter(self, job) -> None:
+        with self.lock:
+            self.dead[job.id] = job
+            # A dead-letter tem limite próprio e não entra no LRU dos finalizados
+            self.finished.pop(job.id, None)
+            while len(self.dead) > self.dead_letter_limit:
+                oldest_id, _ = self.dead.popitem(last=False)
+                self.jobs.pop(oldest_id, None)
+
+    def dead_letters(self, limit: int = 50) -> List:
+        with self.lock:
+            return list(islice(reversed(self.dead.values()), limit))
+
+    def remove_dead_letter(self, job_id: str):
+        with self.lock:
+            return self.dead.pop(job_id, None)
+
+    def get(self, job_id: str):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job_id in self.keys:
+                job.position_in_queue = self.position(job_id)
+            elif job_id in self.finished:
+                self.finished.move_to_end(job_id)
+            return job
+
+    def position(self, job_id: str) -> int:
+        """Jobs à frente na ordem de despacho: soma dos ranks em cada índice, O(T log n)"""
+        with self.lock:
+            key = self.keys[job_id]
+            return sum(index.rank(key) for index in self.ready.values())
+
+    def queue_length(self) -> int:
+        with self.lock:
+            return sum(len(index) for index in self.ready.values())
+
+    def queue_lengths(self) -> Dict[str, int]:
+        with self.lock:
+            return {job_type: len(index) for job_type, index in self.ready.items() if len(index)}
+
+    def queued(self, limit: Optional[int] = None) -> List:
+        with self.lock:
+            # Merge dos índices já ordenados: só percorre os primeiros `limit` de cada tipo
+            merged = heapq.merge(*(islice(index, limit) for index in self.ready.values()))
+            jobs = []
+            for position, key in enumerate(islice(merged, limit)):
+                job = self.by_key[key]
+                job.position_in_queue = position
+                jobs.append(job)
+            return jobs
+
+    def find_inflight(self, coalesce_key: str):
+        with self.lock:
+            return self.inflight.get(coalesce_key)
+
+    def take_followers(self, leader_id: str) -> List:
+        with self.lock:
+            return self.followers.pop(leader_id, [])
+
+    def pending(self) -> List:
+        from .job_queue import JobStatus
+
+        with self.lock:
+            return [job for job in self.jobs.values() if job.status == JobStatus.QUEUED]
+
+    def next_timer_at(self) -> Optional[float]:
+        with self.lock:
+            return self.timers[0][0] if self.timers else None
+
+    def run_timers(self, now: float) -> List:
+        from .job_queue import JobStatus
+
+        expired, evicted = [], []
+        with self.lock:
+            while self.timers and self.timers[0][0] <= now:
+                _, _, action, job_id = heapq.heappop(self.timers)
+                if action == self.EXPIRE:
+                    # Ignora timers de jobs que já foram despachados
+                    if job_id in self.keys:
+                        expired.append(self._detach(job_id))
+                    else:
+                        follower = self._detach_follower(job_id)
+                        if follower is not None:
+                            expired.append(follower)
+                elif action == self.RELEASE:
+                    job = self.jobs.get(job_id)
+                    # Jobs cancelados enquanto esperavam já saíram de self.delayed
+                    if job is None or job_id not in self.delayed or job.status != JobStatus.QUEUED:
+                        continue
+                    self.delayed.discard(job_id)
+                    # O prazo pode ter vencido enquanto o job esperava a nova tentativa
+                    if job.deadline is not None and job.deadline <= now:
+                        expired.append(job)
+                    else:
+                        self._index(job)
+                elif action == self.EVICT:
+                    job = self.jobs.get(job_id)
+                    # Jobs na dead-letter ficam até serem reprocessados ou descartados pelo limite
+                    if job is not None and job.status in JobStatus.FINISHED and job_id not in self.dead:
+                        del self.jobs[job_id]
+                        self.finished.pop(job_id, None)
+                        evicted.append(job_id)
+
+        if evicted:
+            logger.debug(f"Removidos {len(evicted)} jobs antigos")
+            self._discard_spilled(evicted)
+        return expired
+
+    def _detach_follower(self, job_id: str):
+        """Retira um seguidor da lista do seu líder (None se ele já foi entregue)"""
+        # Só chamamos dentro de contextos já protegidos pelo lock
+        job = self.jobs.get(job_id)
+        if job is None or job.leader_id is None:
+            return None
+        followers = self.followers.get(job.leader_id, [])
+        if job not in followers:
+            return None
+        followers.remove(job)
+        return job
+
+
+class DatabaseJobStore(JobStore):
+    """
+    Store persistente no banco via ORM do Django (modelo QueuedJob).
+
+    Todos os workers do gunicorn compartilham a mesma fila, as mesmas posições
+    e os mesmos resultados, e os jobs sobrevivem a reinícios. A retirada de jobs
+    usa SELECT ... FOR UPDATE SKIP LOCKED quando o banco suporta (PostgreSQL);
+    no SQLite é feita com um UPDATE condicional (compare-and-set) no status.
+
+    Seguidores de um job agrupado ficam com leader_id preenchido e nunca são
+    retirados da fila por claim; quem finaliza o líder, em qualquer processo,
+    também finaliza os seguidores.
+    """
+    shared = True
+
+    def __init__(self, lease_seconds: int = DEFAULT_LEASE_SECONDS,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 cleanup_interval: float = 60.0,
+                 expire_interval: float = 5.0,
+                 priority_aging: float = DEFAULT_PRIORITY_AGING):
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.cleanup_interval = cleanup_interval
+        self.expire_interval = expire_interval
+        self.priority_aging = priority_aging
+        self.worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+        self._last_cleanup = 0.0
+        self._last_expire_check = 0.0
+        self._last_lease_check = 0.0
+
+    # Conversão entre o modelo e o Job em memória
+
+    @staticmethod
+    def _to_db_datetime(value):
+        from django.utils import timezone
+
+        if value is None:
+            return None
+        return timezone.make_aware(value) if timezone.is_naive(value) else value
+
+    @staticmethod
+    def _from_db_datetime(value):
+        from django.utils import timezone
+
+        if value is None:
+            return None
+        return timezone.localtime(value).replace(tzinfo=None) if timezone.is_aware(value) else value
+
+    def _to_job(self, record):
+        from .job_queue import Job
+
+        job = Job(record.job_type, record.data, priority=record.priority)
+        job.id = record.id
+        job.status = record.status
+        job.result = record.result
+        job.error = record.error
+        job.created_at = self._from_db_datetime(record.created_at)
+        job.started_at = self._from_db_datetime(record.started_at)
+        job.completed_at = self._from_db_datetime(record.completed_at)
+        job.deadline = record.expires_at
+        job.coalesce_key = record.coalesce_key
+        job.leader_id = record.leader_id
+        job.attempts = record.attempts
+        job.available_at = record.available_at
+        job.dead_letter = record.dead_letter
+        job.client_key = record.client_key
+        job.cancel_requested = record.cancel_requested
+        job.next_job_id = record.next_job_id
+        job.rate_reserved = record.rate_reserved
+        job.rate_reserved_tokens = record.rate_reserved_tokens
+        job.rate_reserved_seconds = record.rate_reserved_seconds
+        return job
+
+    @staticmethod
+    def _waiting():
+        """
+        Jobs aguardando despacho (exclui seguidores, que esperam o líder,
+        e jobs reagendados cuja nova tentativa ainda não chegou)
+        """
+        from django.db.models import Q
+        from .models import QueuedJob
+        from .job_queue import JobStatus
+
+        return QueuedJob.objects.filter(status=JobStatus.QUEUED, leader_id__isnull=True).filter(
+            Q(available_at__isnull=True) | Q(available_at__lte=time.time())
+        )
+
+    def _position(self, record) -> int:
+        from django.db.models import Q
+
+        return self._waiting().filter(
+            Q(dispatch_at__lt=record.dispatch_at) |
+            Q(dispatch_at=record.dispatch_at, enqueued_at__lt=record.enqueued_at)
+        ).count()
+
+    def _next_dispatch_at(self, job) -> float:
+        """dispatch_at de um job entrando na fila, a partir dos jobs do cliente que ainda aguardam"""
+        from django.db.models import F, Max
+        from .models import QueuedJob
+        from .job_queue import JobStatus
+
+        # Entre processos a leitura não é atômica; no pior caso dois jobs do mesmo
+        # cliente empatam, o que só afeta a justiça e não a corretude
+        tail = QueuedJob.objects.filter(
+            status=JobStatus.QUEUED, client_key=job.client_key, leader_id__isnull=True
+        ).exclude(pk=job.id).aggregate(
+            tail=Max(F('dispatch_at') - F('priority') * self.priority_aging)
+        )['tail']
+        return self._dispatch_at(self._fair_start(tail, time.time(), job.weight), job.priority)
+
+    # Operações do store
+
+    def add(self, job) -> None:
+        from .models import QueuedJob
+
+        QueuedJob.objects.create(
+            id=job.id,
+            job_type=job.job_type,
+            priority=job.priority,
+            status=job.status,
+            data=job.data,
+            enqueued_at=time.time(),
+            expires_at=job.deadline,
+            result_expires_at=None,
+            created_at=self._to_db_datetime(job.created_at),
+            coalesce_key=job.coalesce_key,
+            leader_id=job.leader_id,
+            client_key=job.client_key,
+            # Seguidores não entram na ordem de despacho
+            dispatch_at=self._next_dispatch_at(job) if job.leader_id is None else None,
+        )
+
+    def claim(self, job_types: Iterable[str], worker_id: str):
+        from django.db import close_old_connections, connection, transaction
+        from .models import QueuedJob
+        from .job_queue import JobStatus
+
+        job_types = list(job_types)
+        if not job_types:
+            return None
+
+        close_old_connections()
+        self._requeue_expired_leases()
+
+        owner = f"{self.worker_prefix}:{worker_id}"
+        lease_expires_at = time.time() + self.lease_seconds
+        candidates = self._waiting().filter(job_type__in=job_types).order_by('dispatch_at', 'enqueued_at')
+
+        if connection.features.has_select_for_update_skip_locked:
+            with transaction.atomic():
+                record = candidates.select_for_update(skip_locked=True).first()
+                if record is None:
+                    return None
+                record.status = JobStatus.PROCESSING
+                record.lease_owner = owner
+                record.lease_expires_at = lease_expires_at
+                record.save(update_fields=['status', 'lease_owner', 'lease_expires_at'])
+                return self._to_job(record)
+
+        # Fallback (SQLite): tenta marcar o candidato; se outro processo
+        # o pegou primeiro, o UPDATE não afeta nenhuma linha e tentamos o próximo
+        for record in candidates[:10]:
+            claimed = QueuedJob.objects.filter(pk=record.pk, status=JobStatus.QUEUED).update(
+                status=JobStatus.PROCESSING,
+                lease_owner=owner,
+                lease_expires_at=lease_expires_at,
+            )
+            if claimed:
+                record.status = JobStatus.PROCESSING
+                return self._to_job(record)
+        return None
+
+    def update(self, job) -> None:
+        from django.db import close_old_connections
+        from .models import QueuedJob
+
+        from .job_queue import JobStatus
+
+        close_old_connections()
+        finished = job.status in JobStatus.FINISHED
+        QueuedJob.objects.filter(pk=job.id).update(
+            status=job.status,
+            result=job.result,
+            error=job.error,
+            started_at=self._to_db_datetime(job.started_at),
+            completed_at=self._to_db_datetime(job.completed_at),
+            result_expires_at=time.time() + job.result_ttl if finished else None,
+            attempts=job.attempts,
+            next_job_id=job.next_job_id,
+        )
+
+    def renew_leases(self, job_ids: Iterable[str]) -> None:
+        from django.db import close_old_connections
+        from .models import QueuedJob
+        from .job_queue import JobStatus
+
+        job_ids = list(job_ids)
+        if not job_ids:
+            return
+        close_old_connections()
+        # Só os leases deste processo: um job já devolvido à fila e retirado por outro fica com ele
+        QueuedJob.objects.filter(
+            pk__in=job_ids, status=JobStatus.PROCESSING, lease_owner__startswith=f"{self.worker_prefix}:"
+        ).update(lease_expires_at=time.time() + self.lease_seconds)
+
+    def compact(self, job) -> None:
+        from .models import QueuedJob
+
+        QueuedJob.objects.filter(pk=job.id).update(data=job.data)
+
+    def requeue(self, job) -> None:
+        from django.db import close_old_connections
+        from .models import QueuedJob
+        from .job_queue import JobStatus
+
+        close_old_connections()
+        QueuedJob.objects.filter(pk=job.id).update(
+            status=JobStatus.QUEUED,
+            result=None,
+            error=job.error,
+            started_at=None,
+            completed_at=None,
+            attempts=job.attempts,
+            available_at=job.available_at,
+            expires_at=job.deadline,
+            result_expires_at=None,
+            lease_owner='',
+            lease_expires_at=None,
+            dead_letter=False,
+            leader_id=job.leader_id,
+            rate_reserved=job.rate_reserved,
+            rate_reserved_tokens=job.rate_reserved_tokens,
+            rate_reserved_seconds=job.rate_reserved_seconds,
+            # Volta para o fim da vez do cliente, como um job novo
+            dispatch_at=self._next_dispatch_at(job),
+        )
+
+    def withdraw(self, job_id: str):
+        from .models import QueuedJob
+        from .job_queue import JobStatus
+
+        # UPDATE condicional: um worker de outro processo pode ter retirado o job antes
+        if not QueuedJob.objects.filter(pk=job_id, status=JobStatus.QUEUED).update(status=JobStatus.CANCELLED):
+            return None
+        return self._to_job(QueuedJob.objects.get(pk=job_id))
+
+    def request_cancel(self, job_id: str) -> bool:
+        from .models import QueuedJob
+        from .job_queue import JobStatus
+
+        return bool(QueuedJob.objects.filter(pk=job_id).exclude(
+            status__in=JobStatus.FINISHED
+        ).update(cancel_requested=True))
+
+    def cancel_requested(self, job_id: str) -> bool:
+        from .models import QueuedJob
+
+        return QueuedJob.objects.filter(pk=job_id, cancel_requested=True).exists()
+
+    def dead_letter(self, job) -> None:
+        from .models import QueuedJob
+
+        QueuedJob.objects.filter(pk=job.id).update(dead_letter=True)
+
+    def dead_letters(self, limit: int = 50) -> List:
+        from .models import QueuedJob
+
+        records = QueuedJob.objects.filter(dead_letter=True).order_by('-completed_at')[:limit]
+        return [self._to_job(record) for record in records]
+
+    def remove_dead_letter(self, job_id: str):
+        from .models import QueuedJob
+
+        # UPDATE condicional: só uma requisição tira cada job da dead-letter
+        if not QueuedJob.objects.filter(pk=job_id, dead_letter=True).update(dead_letter=False):
+            return None
+        return self._to_job(QueuedJob.objects.get(pk=job_id))
+
+    def get(self, job_id: str):
+        from .models import QueuedJob
+        from .job_queue import JobStatus
+
+        record = QueuedJob.objects.filter(pk=job_id).first()
+        if record is None:
+            return None
+
+        job = self._to_job(record)
+        if record.status == JobStatus.QUEUED:
+            job.position_in_queue = self._position(record)
+        return job
+
+    def queue_length(self) -> int:
+        return self._waiting().count()
+
+    def queue_lengths(self) -> Dict[str, int]:
+        from django.db.models import Count
+
+        counts = self._waiting().values('job_type').annotate(count=Count('id')).order_by()
+        return {row['job_type']: row['count'] for row in counts}
+
+    def queued(self, limit: Optional[int] = None) -> List:
+        records = self._waiting().order_by('dispatch_at', 'enqueued_at')
+        if limit is not None:
+            records = records[:limit]
+
+        jobs = []
+        for position, record in enumerate(records):
+            job = self._to_job(record)
+            job.position_in_queue = position
+            jobs.append(job)
+        return jobs
+
+    def find_inflight(self, coalesce_key: str):
+        from .models import QueuedJob
+        from .job_queue import JobStatus
+
+        record = QueuedJob.objects.filter(
+            coalesce_key=coalesce_key,
+            leader_id__isnull=True,
+            status__in=[JobStatus.QUEUED, JobStatus.PROCESSING],
+        ).order_by('enqueued_at').first()
+        return self._to_job(record) if record is not None else None
+
+    def take_followers(self, leader_id: str) -> List:
+        from .models import QueuedJob
+        from .job_queue import JobStatus
+
+        owner = f"{self.worker_prefix}:followers"
+        followers = []
+        for record in QueuedJob.objects.filter(leader_id=leader_id, status=JobStatus.QUEUED):
+            # UPDATE condicional: o seguidor pode ter expirado em outro processo
+            claimed = QueuedJob.objects.filter(pk=record.pk, status=JobStatus.QUEUED).update(
+                status=JobStatus.PROCESSING,
+                lease_owner=owner,
+                lease_expires_at=time.time() + self.lease_seconds,
+            )
+            if claimed:
+                record.status = JobStatus.PROCESSING
+                followers.append(self._to_job(record))
+        return followers
+
+    def run_timers(self, now: float) -> List:
+        from django.db import close_old_connections
+        from .models import QueuedJob
+        from .job_queue import JobStatus
+
+        # O banco é consultado no máximo a cada expire_interval/cleanup_interval,
+        # não a cada iteração dos workers
+        expired = []
+        if now - self._last_expire_check >= self.expire_interval:
+            self._last_expire_check = now
+            close_old_connections()
+
+            due = QueuedJob.objects.filter(status=JobStatus.QUEUED, expires_at__lte=now)[:100]
+            for record in due:
+                # UPDATE condicional: só um processo marca cada job como expirado
+                if QueuedJob.objects.filter(pk=record.pk, status=JobStatus.QUEUED).update(status=JobStatus.EXPIRED):
+                    expired.append(self._to_job(record))
+
+        if now - self._last_cleanup >= self.cleanup_interval:
+            self._last_cleanup = now
+            removed, _ = QueuedJob.objects.filter(
+                status__in=JobStatus.FINISHED, result_expires_at__lte=now, dead_letter=False
+            ).delete()
+            if removed:
+                logger.debug(f"Removidos {removed} jobs antigos")
+
+        return expired
+
+    def _requeue_expired_leases(self):
+        """Devolve para a fila jobs cujo worker morreu sem concluí-los"""
+        from .models import QueuedJob
+        from .job_queue import JobStatus
+
+        now = time.time()
+        if now - self._last_lease_check < self.lease_seconds / 10:
+            return
+        self._last_lease_check = now
+
+        requeued = QueuedJob.objects.filter(
+            status=JobStatus.PROCESSING, lease_expires_at__lt=now
+        ).update(status=JobStatus.QUEUED, lease_owner='', lease_expires_at=None)
+        if requeued:
+            logger.warning(f"{requeued} job(s) com lease expirado devolvido(s) para a fila")
+
+
+def create_job_store(backend: Optional[str] = None) -> JobStore:
+    """
+    Cria o store configurado em JOB_QUEUE_BACKEND ('memory' ou 'database').
+    """
+    backend = (backend or os.getenv('JOB_QUEUE_BACKEND', 'memory')).lower()
+    priority_aging = float(os.getenv('JOB_QUEUE_PRIORITY_AGING', DEFAULT_PRIORITY_AGING))
+    if backend == 'database':
+        logger.info("JobQueue usando store persistente no banco de dados")
+        return DatabaseJobStore(
+            lease_seconds=int(os.getenv('JOB_QUEUE_LEASE_SECONDS', DEFAULT_LEASE_SECONDS)),
+            poll_interval=float(os.getenv('JOB_QUEUE_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)),
+            priority_aging=priority_aging,
+        )
+    if backend != 'memory':
+        raise ValueError(f"Backend de fila desconhecido: {backend}")
+
+    spill = None
+    spill_bytes = int(os.getenv('JOB_RESULT_SPILL_BYTES', DEFAULT_SPILL_THRESHOLD))
+    if spill_bytes > 0:
+        directory = os.getenv('JOB_RESULT_SPILL_DIR') or os.path.join(tempfile.gettempdir(), 'email_classifier_jobs')
+        # Um diretório por processo: cada worker do gunicorn tem sua própria fila em memória
+        spill = ResultSpill(os.path.join(directory, str(os.getpid())), spill_bytes)
+    return MemoryJobStore(
+        max_jobs=int(os.getenv('JOB_QUEUE_MAX_RETAINED', DEFAULT_MAX_RETAINED_JOBS)),
+        spill=spill,
+        priority_aging=priority_aging,
+    )
@@ -64,6 +64,7 @@ class CorsMiddleware:
             response["Access-Control-Allow-Headers"] = "Content-Type, X-Requested-With, Accept, Authorization, X-CSRFToken, Origin, Cache-Control, Pragma"
             response["Access-Control-Allow-Credentials"] = "true"
             response["Access-Control-Max-Age"] = "86400"
+            response["Access-Control-Expose-Headers"] = "Retry-After"
 
             # Headers adicionais para debug
             response["X-CORS-Debug"] = f"Origin: {origin}, Allowed: {origin_allowed}"
@@ -92,6 +93,8 @@ class CorsMiddleware:
         response["Access-Control-Allow-Headers"] = "Content-Type, X-Requested-With, Accept, Authorization, X-CSRFToken, Origin, Cache-Control, Pragma"
         response["Access-Control-Allow-Credentials"] = "true"
         response["Access-Control-Max-Age"] = "86400"
+        # Sem isso o navegador esconde o Retry-After das respostas 429 do frontend
+        response["Access-Control-Expose-Headers"] = "Retry-After"
 
         # Headers adicionais de segurança
         response["X-Content-Type-Options"] = "nosniff"
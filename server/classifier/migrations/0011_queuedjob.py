@@ -0,0 +1,37 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('classifier', '0010_merge_user_ip_migrations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedJob',
+            fields=[
+                ('id', models.CharField(max_length=36, primary_key=True, serialize=False, verbose_name='ID do Job')),
+                ('job_type', models.CharField(max_length=50, verbose_name='Tipo')),
+                ('priority', models.IntegerField(default=1, verbose_name='Prioridade')),
+                ('status', models.CharField(default='queued', max_length=20, verbose_name='Status')),
+                ('data', models.JSONField(default=dict, verbose_name='Dados')),
+                ('result', models.JSONField(blank=True, null=True, verbose_name='Resultado')),
+                ('error', models.TextField(blank=True, null=True, verbose_name='Erro')),
+                ('enqueued_at', models.FloatField(verbose_name='Enfileirado em')),
+                ('created_at', models.DateTimeField(verbose_name='Criado em')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Iniciado em')),
+                ('completed_at', models.DateTimeField(blank=True, null=True, verbose_name='Concluído em')),
+                ('lease_owner', models.CharField(blank=True, default='', max_length=200, verbose_name='Worker Responsável')),
+                ('lease_expires_at', models.FloatField(blank=True, null=True, verbose_name='Lease Expira em')),
+            ],
+            options={
+                'verbose_name': 'Job da Fila',
+                'verbose_name_plural': 'Jobs da Fila',
+                'indexes': [
+                    models.Index(fields=['status', 'priority', 'enqueued_at'], name='classifier_job_dispatch_idx'),
+                    models.Index(fields=['status', 'completed_at'], name='classifier_job_cleanup_idx'),
+                    models.Index(fields=['status', 'lease_expires_at'], name='classifier_job_lease_idx'),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('classifier', '0011_queuedjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuedjob',
+            name='expires_at',
+            field=models.FloatField(blank=True, null=True, verbose_name='Expira em'),
+        ),
+        migrations.AddField(
+            model_name='queuedjob',
+            name='result_expires_at',
+            field=models.FloatField(blank=True, null=True, verbose_name='Retenção até'),
+        ),
+        migrations.RemoveIndex(
+            model_name='queuedjob',
+            name='classifier_job_cleanup_idx',
+        ),
+        migrations.AddIndex(
+            model_name='queuedjob',
+            index=models.Index(fields=['status', 'expires_at'], name='classifier_job_expire_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='queuedjob',
+            index=models.Index(fields=['status', 'result_expires_at'], name='classifier_job_retention_idx'),
+        ),
+    ]
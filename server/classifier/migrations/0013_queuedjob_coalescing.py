@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('classifier', '0012_queuedjob_expiration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuedjob',
+            name='coalesce_key',
+            field=models.CharField(blank=True, max_length=120, null=True, verbose_name='Chave de Conteúdo'),
+        ),
+        migrations.AddField(
+            model_name='queuedjob',
+            name='leader_id',
+            field=models.CharField(blank=True, max_length=36, null=True, verbose_name='Agrupado ao Job'),
+        ),
+        migrations.AddIndex(
+            model_name='queuedjob',
+            index=models.Index(fields=['coalesce_key', 'status'], name='classifier_job_coalesce_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='queuedjob',
+            index=models.Index(fields=['leader_id', 'status'], name='classifier_job_leader_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('classifier', '0013_queuedjob_coalescing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuedjob',
+            name='attempts',
+            field=models.IntegerField(default=0, verbose_name='Tentativas'),
+        ),
+        migrations.AddField(
+            model_name='queuedjob',
+            name='available_at',
+            field=models.FloatField(blank=True, null=True, verbose_name='Disponível em'),
+        ),
+        migrations.AddField(
+            model_name='queuedjob',
+            name='dead_letter',
+            field=models.BooleanField(default=False, verbose_name='Dead-letter'),
+        ),
+        migrations.AddIndex(
+            model_name='queuedjob',
+            index=models.Index(fields=['dead_letter', 'completed_at'], name='classifier_job_dead_letter_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+from django.db import migrations, models
+from django.db.models import F
+
+# Mesmo valor padrão de JOB_QUEUE_PRIORITY_AGING: mantém a ordem dos jobs já enfileirados
+PRIORITY_AGING = 30.0
+
+
+def fill_dispatch_at(apps, schema_editor):
+    QueuedJob = apps.get_model('classifier', 'QueuedJob')
+    QueuedJob.objects.update(dispatch_at=F('enqueued_at') + F('priority') * PRIORITY_AGING)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('classifier', '0014_queuedjob_retries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuedjob',
+            name='client_key',
+            field=models.CharField(blank=True, max_length=100, null=True, verbose_name='Cliente'),
+        ),
+        migrations.AddField(
+            model_name='queuedjob',
+            name='dispatch_at',
+            field=models.FloatField(blank=True, null=True, verbose_name='Ordem de Despacho'),
+        ),
+        migrations.RunPython(fill_dispatch_at, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='queuedjob',
+            name='classifier_job_dispatch_idx',
+        ),
+        migrations.AddIndex(
+            model_name='queuedjob',
+            index=models.Index(fields=['status', 'dispatch_at'], name='classifier_job_fair_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='queuedjob',
+            index=models.Index(fields=['client_key', 'status'], name='classifier_job_client_idx'),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('classifier', '0015_queuedjob_fair_queuing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='job_id',
+            field=models.CharField(blank=True, default='', max_length=36, verbose_name='ID do Job'),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('classifier', '0016_email_job_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuedjob',
+            name='cancel_requested',
+            field=models.BooleanField(default=False, verbose_name='Cancelamento Solicitado'),
+        ),
+    ]
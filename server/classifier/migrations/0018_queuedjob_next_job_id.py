@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('classifier', '0017_queuedjob_cancel_requested'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuedjob',
+            name='next_job_id',
+            field=models.CharField(blank=True, max_length=36, null=True, verbose_name='Próximo Estágio'),
+        ),
+    ]
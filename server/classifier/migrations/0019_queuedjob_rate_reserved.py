@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('classifier', '0018_queuedjob_next_job_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuedjob',
+            name='rate_reserved',
+            field=models.IntegerField(default=0, verbose_name='Requisições Reservadas'),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('classifier', '0019_queuedjob_rate_reserved'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuedjob',
+            name='rate_reserved_tokens',
+            field=models.IntegerField(default=0, verbose_name='Tokens Reservados'),
+        ),
+    ]
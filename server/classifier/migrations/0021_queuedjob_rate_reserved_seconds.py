@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('classifier', '0020_queuedjob_rate_reserved_tokens'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuedjob',
+            name='rate_reserved_seconds',
+            field=models.FloatField(default=0.0, verbose_name='Segundos Reservados'),
+        ),
+    ]
@@ -28,6 +28,8 @@ class Email(models.Model):
                                            null=True, verbose_name='Método de Classificação')
     # Atualizar campo user_ip com valor padrão
     user_ip = models.GenericIPAddressField(default='127.0.0.1', verbose_name='IP do Usuário')
+    # Job da fila que está processando o email (usado para reenfileirar emails órfãos)
+    job_id = models.CharField(max_length=36, blank=True, default='', verbose_name='ID do Job')
 
     def __str__(self):
         return f"{self.subject} - {self.category}"
@@ -51,3 +53,63 @@ class Email(models.Model):
             models.Index(fields=['sender']),
             models.Index(fields=['user_ip']),
         ]
+
+
+class QueuedJob(models.Model):
+    """Job da fila persistido no banco (backend 'database' do JobQueue)"""
+    id = models.CharField(max_length=36, primary_key=True, verbose_name='ID do Job')
+    job_type = models.CharField(max_length=50, verbose_name='Tipo')
+    priority = models.IntegerField(default=1, verbose_name='Prioridade')
+    status = models.CharField(max_length=20, default='queued', verbose_name='Status')
+    data = models.JSONField(default=dict, verbose_name='Dados')
+    result = models.JSONField(null=True, blank=True, verbose_name='Resultado')
+    error = models.TextField(null=True, blank=True, verbose_name='Erro')
+    # Timestamp (time.time()) usado para ordenar jobs de mesma prioridade
+    enqueued_at = models.FloatField(verbose_name='Enfileirado em')
+    # Prazo (time.time()) para o job sair da fila; depois disso ele expira
+    expires_at = models.FloatField(null=True, blank=True, verbose_name='Expira em')
+    # Quando o registro de um job finalizado pode ser removido
+    result_expires_at = models.FloatField(null=True, blank=True, verbose_name='Retenção até')
+    created_at = models.DateTimeField(verbose_name='Criado em')
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name='Iniciado em')
+    completed_at = models.DateTimeField(null=True, blank=True, verbose_name='Concluído em')
+    lease_owner = models.CharField(max_length=200, blank=True, default='', verbose_name='Worker Responsável')
+    lease_expires_at = models.FloatField(null=True, blank=True, verbose_name='Lease Expira em')
+    # Jobs com o mesmo conteúdo em andamento são agrupados ao primeiro (líder)
+    coalesce_key = models.CharField(max_length=120, null=True, blank=True, verbose_name='Chave de Conteúdo')
+    leader_id = models.CharField(max_length=36, null=True, blank=True, verbose_name='Agrupado ao Job')
+    attempts = models.IntegerField(default=0, verbose_name='Tentativas')
+    # Jobs reagendados após uma falha temporária só saem da fila a partir deste instante
+    available_at = models.FloatField(null=True, blank=True, verbose_name='Disponível em')
+    dead_letter = models.BooleanField(default=False, verbose_name='Dead-letter')
+    # Cliente que enfileirou o job (IP hoje, chave de API no futuro), para o fair queuing
+    client_key = models.CharField(max_length=100, null=True, blank=True, verbose_name='Cliente')
+    # Ordem de despacho: instante virtual do cliente + envelhecimento da prioridade
+    dispatch_at = models.FloatField(null=True, blank=True, verbose_name='Ordem de Despacho')
+    # Cancelamento pedido enquanto o job estava em processamento (em qualquer processo)
+    cancel_requested = models.BooleanField(default=False, verbose_name='Cancelamento Solicitado')
+    # Job do próximo estágio do pipeline, enfileirado quando este concluiu
+    next_job_id = models.CharField(max_length=36, null=True, blank=True, verbose_name='Próximo Estágio')
+    # Requisições já reservadas no rate limiter do tipo, para o job que espera a vaga reservada
+    rate_reserved = models.IntegerField(default=0, verbose_name='Requisições Reservadas')
+    # Tokens estimados reservados junto com essas requisições
+    rate_reserved_tokens = models.IntegerField(default=0, verbose_name='Tokens Reservados')
+    # Segundos que as requisições reservadas ocuparam no balde do minuto, devolvidos exatamente
+    rate_reserved_seconds = models.FloatField(default=0.0, verbose_name='Segundos Reservados')
+
+    def __str__(self):
+        return f"{self.job_type} {self.id} - {self.status}"
+
+    class Meta:
+        verbose_name = 'Job da Fila'
+        verbose_name_plural = 'Jobs da Fila'
+        indexes = [
+            models.Index(fields=['status', 'dispatch_at'], name='classifier_job_fair_idx'),
+            models.Index(fields=['client_key', 'status'], name='classifier_job_client_idx'),
+            models.Index(fields=['status', 'expires_at'], name='classifier_job_expire_idx'),
+            models.Index(fields=['status', 'result_expires_at'], name='classifier_job_retention_idx'),
+            models.Index(fields=['status', 'lease_expires_at'], name='classifier_job_lease_idx'),
+            models.Index(fields=['coalesce_key', 'status'], name='classifier_job_coalesce_idx'),
+            models.Index(fields=['leader_id', 'status'], name='classifier_job_leader_idx'),
+            models.Index(fields=['dead_letter', 'completed_at'], name='classifier_job_dead_letter_idx'),
+        ]
@@ -1,29 +1,247 @@
+import os
+import json
 import time
+import asyncio
 import logging
+import sqlite3
+import tempfile
 import threading
-from datetime import datetime, timedelta
+import contextlib
+import contextvars
+from datetime import date, datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
+# Arquivo SQLite padrão do estado compartilhado entre os processos (workers do gunicorn) da máquina
+DEFAULT_SHARED_STATE_PATH = os.path.join(tempfile.gettempdir(), 'email_classifier_rate_limits.sqlite3')
+
+# AIMD do modo adaptativo: a taxa sobe devagar enquanto as chamadas vão bem e cai pela metade no 429
+ADAPTIVE_INCREASE = 1.0  # req/min somadas a cada minuto cheio de chamadas bem-sucedidas
+ADAPTIVE_THROTTLE_FACTOR = 0.5  # corte da taxa num 429/ResourceExhausted
+ADAPTIVE_LATENCY_FACTOR = 0.8  # corte mais brando num pico de latência
+LATENCY_SPIKE_RATIO = 2.0  # latência acima de 2x a média móvel é um pico
+LATENCY_ALPHA = 0.2  # peso da última chamada na média móvel da latência
+# Segundos entre dois cortes: os 429 das chamadas que já estavam em voo não cortam de novo
+ADAPTIVE_DECREASE_COOLDOWN = 10.0
+
+# Requisições e tokens reservados com reserve() que o job em execução ainda pode usar, por rate limiter.
+# O JobQueue reserva a vaga antes de despachar o job e a entrega ao handler por aqui
+_reserved = contextvars.ContextVar('rate_limiter_reserved', default=None)
+
+
+@contextlib.contextmanager
+def using_reservation(limiter, requests, tokens=0):
+    """Durante o bloco, wait_if_needed de `limiter` consome as `requests` e os `tokens` já reservados sem esperar"""
+    token = _reserved.set({limiter: [requests, tokens]} if requests or tokens else None)
+    try:
+        yield
+    finally:
+        _reserved.reset(token)
+
+
+class LimiterState:
+    """
+    Estado de um RateLimiter guardado no próprio processo.
+
+    O RateLimiter só lê e altera os campos dentro de transaction(); backends
+    compartilhados carregam e gravam os mesmos campos em um armazenamento comum.
+    """
+    shared = False  # Se o estado vale para todos os processos da máquina
+
+    # Campos do estado e seus valores iniciais
+    FIELDS = {
+        'tat': 0.0,  # instante teórico (clock()) em que o balde do minuto esvazia
+        'token_tat': 0.0,  # o mesmo para o balde de tokens por minuto
+        'day': None,  # dia (date.toordinal()) a que day_count se refere
+        'day_count': 0,  # requisições registradas (ou reservadas) no dia
+        'next_day_count': 0,  # reservas que já ficaram para o dia seguinte (cota do dia esgotada)
+        'rate': None,  # taxa efetiva em req/min no modo adaptativo (None: a inicial)
+        'latency': None,  # média móvel da latência por token das chamadas bem-sucedidas
+        'decreased_at': None,  # clock() do último corte da taxa
+        'class_tat': None,  # {classe: clock()} da fila de reservas ainda não ocupadas de cada classe abaixo
+    }
+
+    def __init__(self):
+        for field, default in self.FIELDS.items():
+            setattr(self, field, default)
+        self.lock = threading.RLock()
+
+    def clock(self) -> float:
+        """
+        Relógio do balde. O monotônico não volta com ajustes do relógio do sistema e tem
+        resolução de sobra para somar intervalos de milissegundos, o que timestamps de
+        época (~1,7e9) perdem nas casas decimais
+        """
+        return time.monotonic()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Acesso exclusivo ao estado durante o bloco"""
+        with self.lock:
+            yield self
+
+
+class SQLiteLimiterState(LimiterState):
+    """
+    Estado compartilhado por todos os processos da máquina em um arquivo SQLite.
+
+    Cada operação do limiter é uma transação BEGIN IMMEDIATE: o SQLite tranca o
+    arquivo para escrita entre processos, então os workers do gunicorn consomem
+    uma única cota e get_stats mostra o uso somado. Não depende de serviço externo.
+    """
+    shared = True
+
+    def __init__(self, name: str, path: str = DEFAULT_SHARED_STATE_PATH, timeout: float = 10.0):
+        super().__init__()
+        self.name = name
+        self.path = path
+        self.timeout = timeout
+        self.connection = None
+        self.pid = None
+        # Base do relógio, gravada junto com o estado. O monotônico não é comparável entre
+        # processos, então o relógio aqui é time.time() menos essa base, o que mantém os
+        # valores de tat pequenos e a soma dos intervalos precisa
+        self.epoch = None
+
+    def _connect(self):
+        # Processos criados por fork (gunicorn com --preload) abrem a própria conexão
+        if self.connection is None or self.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                              isolation_level=None, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            # Sem fsync a cada transação: perder o último instante do balde numa queda de energia é aceitável
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limiter_state "
+                "(name TEXT PRIMARY KEY, epoch REAL NOT NULL, state TEXT NOT NULL)"
+            )
+            self.pid = os.getpid()
+        return self.connection
+
+    def clock(self) -> float:
+        return time.time() - self.epoch
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT epoch, state FROM rate_limiter_state WHERE name = ?", (self.name,)
+                ).fetchone()
+                if row is None:
+                    self.epoch = float(int(time.time()))
+                    values = {}
+                else:
+                    self.epoch, values = row[0], json.loads(row[1])
+                for field, default in self.FIELDS.items():
+                    setattr(self, field, values.get(field, default))
+
+                yield self
+
+                state = json.dumps({field: getattr(self, field) for field in self.FIELDS})
+                connection.execute(
+                    "INSERT OR REPLACE INTO rate_limiter_state (name, epoch, state) VALUES (?, ?, ?)",
+                    (self.name, self.epoch, state)
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+
+def create_limiter_state(name: str, backend: str = None) -> LimiterState:
+    """
+    Cria o estado configurado em RATE_LIMITER_BACKEND ('shared' ou 'memory').
+    'shared' guarda o estado em RATE_LIMITER_STATE_PATH, arquivo comum aos processos da máquina.
+    """
+    backend = (backend or os.getenv('RATE_LIMITER_BACKEND', 'shared')).lower()
+    if backend == 'shared':
+        path = os.getenv('RATE_LIMITER_STATE_PATH') or DEFAULT_SHARED_STATE_PATH
+        logger.info(f"Rate limiter '{name}' com estado compartilhado entre processos em {path}")
+        return SQLiteLimiterState(name, path)
+    if backend != 'memory':
+        raise ValueError(f"Backend de rate limiter desconhecido: {backend}")
+    return LimiterState()
+
+
 class RateLimiter:
     """
     Implementa um sistema de rate limiting para APIs.
     Controla tanto o número de requisições por minuto quanto o número total por dia.
+
+    O limite por minuto usa GCRA (Generic Cell Rate Algorithm): em vez de guardar o
+    horário de cada requisição, guarda só o instante teórico (tat) em que o "balde"
+    do minuto esvazia. Cada requisição o avança em 60/requests_per_minute segundos e
+    é aceita enquanto ele não passar de 1 minuto à frente do relógio, o que permite
+    rajadas de até requests_per_minute. O limite diário é um contador zerado à
+    meia-noite. A memória e o custo de cada operação não dependem do volume.
+
+    Com tokens_per_minute, cada requisição também tem um custo em tokens num segundo
+    balde GCRA: quem chama informa uma estimativa dos tokens de entrada antes da
+    chamada (wait_if_needed(tokens=...)) e acerta a diferença com o uso real depois
+    (reconcile_tokens), de modo que prompts grandes esperam a sua vez em vez de
+    estourar a cota de tokens da API para todos.
+
+    Com adaptive=True, requests_per_minute é a taxa efetiva, ajustada por AIMD entre
+    min_requests_per_minute e max_requests_per_minute: sobe aos poucos a cada chamada
+    bem-sucedida (report_success) e é cortada ao receber 429 da API (report_throttled)
+    ou num pico de latência. A taxa efetiva também fica no estado, comum aos processos.
+
+    capacity_classes reserva parte de cada minuto (dos dois baldes) para classes de
+    chamadas nomeadas, em ordem de prioridade: {"classify": 0.3} garante 30% do minuto
+    às chamadas com capacity_class="classify", e as demais só ocupam os outros 70%.
+    Uma classe pode usar o que as classes acima dela deixaram livre, nunca a parte delas;
+    chamadas sem classe (ou de classe não listada) ficam abaixo de todas.
+
+    O estado fica em `state` (LimiterState): no próprio processo por padrão, ou
+    compartilhado entre os processos da máquina (create_limiter_state) para uma cota única.
     """
-    def __init__(self, requests_per_minute=10, requests_per_day=500, name="default"):
+    def __init__(self, requests_per_minute=10, requests_per_day=500, name="default", state=None,
+                 tokens_per_minute=None, adaptive=False, min_requests_per_minute=1,
+                 max_requests_per_minute=None, capacity_classes=None):
         self.name = name
         self.requests_per_minute = requests_per_minute
+        self.adaptive = adaptive
+        self.min_requests_per_minute = min(min_requests_per_minute, requests_per_minute)
+        self.max_requests_per_minute = max(max_requests_per_minute or requests_per_minute, requests_per_minute)
         self.requests_per_day = requests_per_day
-        self.minute_requests = []
-        self.day_requests = []
-        self.lock = threading.RLock()
+        self.tokens_per_minute = tokens_per_minute  # None: requisições sem custo em tokens
+        self.state = state if state is not None else LimiterState()
+
+        # Fração do minuto que cada classe deixa livre para as classes acima dela
+        self.capacity_classes = dict(capacity_classes or {})
+        self.reserved_fraction = sum(self.capacity_classes.values())
+        if self.reserved_fraction >= 1:
+            raise ValueError(f"Rate limiter '{name}': as classes reservam {self.reserved_fraction:.0%} do minuto")
+        self.held_back = {}
+        held = 0.0
+        for capacity_class, fraction in self.capacity_classes.items():
+            self.held_back[capacity_class] = held
+            held += fraction
 
         # Para estatísticas de uso
         self.total_requests_today = 0
         self.total_requests_minute = 0
         self.reset_day_stats()
 
-        logger.info(f"Rate limiter '{name}' iniciado: {requests_per_minute} req/min, {requests_per_day} req/dia")
+        logger.info(f"Rate limiter '{name}' iniciado: {requests_per_minute} req/min, {requests_per_day} req/dia"
+                    + (f", {tokens_per_minute} tokens/min" if tokens_per_minute else "")
+                    + (f", adaptativo até {self.max_requests_per_minute} req/min" if adaptive else ""))
+
+    @property
+    def interval(self):
+        """Segundos que cada requisição ocupa no balde do minuto"""
+        return 60.0 / self.requests_per_minute
+
+    @property
+    def token_interval(self):
+        """Segundos que cada token ocupa no balde de tokens do minuto"""
+        return 60.0 / self.tokens_per_minute
 
     def reset_day_stats(self):
         """Reseta as estatísticas diárias à meia-noite"""
@@ -31,88 +249,369 @@ class RateLimiter:
         self.day_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
         self.day_end = self.day_start + timedelta(days=1)
 
-    def _is_new_day(self):
+    def _is_new_day(self, state):
         """Verifica se é um novo dia para resetar contadores"""
-        now = datetime.now()
-        if now >= self.day_end:
+        today = date.today().toordinal()
+        if state.day == today:
+            if datetime.now() >= self.day_end:
+                # Outro processo já virou o dia no estado compartilhado
+                self.reset_day_stats()
+            return False
+
+        if state.day is not None:
             logger.info(f"Rate limiter '{self.name}': Novo dia iniciado, resetando contadores")
-            self.day_requests = []
-            self.reset_day_stats()
-            return True
-        return False
+        # Reservas feitas para o novo dia continuam valendo
+        state.day_count = state.next_day_count if state.day == today - 1 else 0
+        state.next_day_count = 0
+        state.day = today
+        self.reset_day_stats()
+        self.total_requests_today = state.day_count
+        return True
 
-    def _cleanup_old_requests(self):
-        """Remove requisições antigas das listas de controle"""
-        now = time.time()
+    def _refresh(self, state):
+        """Vira o dia se preciso e carrega a taxa efetiva do estado (modo adaptativo)"""
+        self._is_new_day(state)
+        if self.adaptive and state.rate is not None:
+            self.requests_per_minute = state.rate
 
-        # Remove requisições mais antigas que 1 minuto
-        minute_ago = now - 60
-        self.minute_requests = [t for t in self.minute_requests if t > minute_ago]
+    def _set_rate(self, state, rate):
+        state.rate = min(self.max_requests_per_minute, max(self.min_requests_per_minute, rate))
+        self.requests_per_minute = state.rate
 
-        # Se for um novo dia, o _is_new_day já limpou a lista de requisições diárias
+    def _decrease(self, state, factor):
+        """Corte multiplicativo da taxa, no máximo um a cada ADAPTIVE_DECREASE_COOLDOWN segundos"""
+        now = state.clock()
+        if state.decreased_at is not None and 0 <= now - state.decreased_at < ADAPTIVE_DECREASE_COOLDOWN:
+            return False
+        state.decreased_at = now
+        self._set_rate(state, self.requests_per_minute * factor)
+        return True
 
-    def can_make_request(self):
+    def report_success(self, latency, tokens=None):
         """
-        Verifica se podemos fazer mais uma requisição baseado nos limites
-        Retorna: (bool, tempo_de_espera_em_segundos)
+        Informa uma chamada bem-sucedida à API (modo adaptativo). Com `tokens`, a latência é
+        comparada por token, para que prompts grandes não pareçam picos de latência.
         """
-        with self.lock:
-            self._is_new_day()  # Verifica se é um novo dia
-            self._cleanup_old_requests()  # Limpa requisições antigas
+        if not self.adaptive:
+            return
+        with self.state.transaction() as state:
+            self._refresh(state)
+            decreased = self._observe_latency(state, latency, tokens)
+        if decreased:
+            self._log_latency_spike(latency)
+
+    def _observe_latency(self, state, latency, tokens):
+        """Atualiza a média de latência e ajusta a taxa; retorna True se a taxa foi reduzida"""
+        sample = latency / tokens if tokens else latency
+        spike = state.latency is not None and sample > state.latency * LATENCY_SPIKE_RATIO
+        state.latency = sample if state.latency is None else state.latency + LATENCY_ALPHA * (sample - state.latency)
+        if spike:
+            return self._decrease(state, ADAPTIVE_LATENCY_FACTOR)
+        # +ADAPTIVE_INCREASE req/min depois de um minuto inteiro de chamadas bem-sucedidas
+        self._set_rate(state, self.requests_per_minute + ADAPTIVE_INCREASE / self.requests_per_minute)
+        return False
+
+    def _log_latency_spike(self, latency):
+        logger.warning(f"Rate limiter '{self.name}': pico de latência ({latency:.1f}s), "
+                       f"taxa reduzida para {self.requests_per_minute:.1f} req/min")
+
+    def report_response(self, latency, estimated_tokens=0, actual_tokens=None, total_tokens=None):
+        """
+        Registra a resposta de uma chamada numa única transação: acerta os tokens estimados
+        com o uso real (como reconcile_tokens), informa a latência (como report_success) e
+        retorna o uso do dia e dos tokens no minuto, para o log de quem chamou.
+        """
+        with self.state.transaction() as state:
+            self._refresh(state)
+            if self.tokens_per_minute and actual_tokens is not None:
+                state.token_tat += (actual_tokens - estimated_tokens) * self.token_interval
+            # Latência comparada por token (entrada e saída): respostas longas não são picos
+            decreased = self.adaptive and self._observe_latency(state, latency, total_tokens or estimated_tokens)
+            day_usage = state.day_count
+            token_usage = self._token_usage(state, state.clock())
+        if decreased:
+            self._log_latency_spike(latency)
+        return {"day_usage": day_usage, "token_minute_usage": token_usage}
+
+    def report_throttled(self):
+        """Informa que a API recusou uma chamada por limite (429/ResourceExhausted) no modo adaptativo"""
+        if not self.adaptive:
+            return
+        with self.state.transaction() as state:
+            self._refresh(state)
+            decreased = self._decrease(state, ADAPTIVE_THROTTLE_FACTOR)
+            rate = self.requests_per_minute
+        if decreased:
+            logger.warning(f"Rate limiter '{self.name}': limite da API atingido (429), "
+                           f"taxa reduzida para {rate:.1f} req/min")
+
+    def _minute_usage(self, state, now):
+        """Requisições que ainda ocupam o balde do minuto (inclui reservas futuras)"""
+        backlog = state.tat - now
+        if backlog <= 0:
+            return 0
+        # Arredondado para cima: uma requisição ocupa o balde até sair por inteiro
+        return -int(-backlog // self.interval)
+
+    def _window(self, capacity_class):
+        """Segundos do balde que `capacity_class` pode ocupar: a parte das classes acima fica livre"""
+        return 60.0 * (1.0 - self.held_back.get(capacity_class, self.reserved_fraction))
 
-            # Verifica limite por minuto
-            if len(self.minute_requests) >= self.requests_per_minute:
-                oldest = self.minute_requests[0]
-                wait_time = 60 - (time.time() - oldest)
-                wait_time = max(1, int(wait_time))
-                return False, wait_time
+    def _minute_wait(self, state, now, capacity_class=None):
+        """Segundos até o balde do minuto aceitar mais uma requisição"""
+        return max(0.0, state.tat - (self._window(capacity_class) - self.interval) - now)
 
-            # Verifica limite diário
-            if len(self.day_requests) >= self.requests_per_day:
-                wait_time = int((self.day_end - datetime.now()).total_seconds())
-                return False, wait_time
+    def _token_usage(self, state, now):
+        """Tokens que ainda ocupam o balde de tokens do minuto"""
+        if not self.tokens_per_minute:
+            return 0
+        return max(0, int((state.token_tat - now) / self.token_interval))
 
-            return True, 0
+    def _token_wait(self, state, now, tokens, capacity_class=None):
+        """Segundos até o balde de tokens comportar mais `tokens`"""
+        if not tokens or not self.tokens_per_minute:
+            return 0.0
+        # Um prompt maior que a cota inteira da classe passa quando o balde estiver vazio
+        window = self._window(capacity_class)
+        cost = min(tokens * self.token_interval, window)
+        return max(0.0, max(state.token_tat, now) + cost - window - now)
 
-    def add_request(self):
+    def _record(self, state, now, requests=1, tokens=0):
+        """Ocupa os baldes do minuto e a cota do dia com `requests` requisições e `tokens` a partir de now"""
+        if requests:
+            state.tat = max(state.tat, now) + requests * self.interval
+            state.day_count += requests
+        if tokens and self.tokens_per_minute:
+            state.token_tat = max(state.token_tat, now) + tokens * self.token_interval
+        self.total_requests_minute = self._minute_usage(state, now)
+        self.total_requests_today = state.day_count
+
+    def _check(self, state, now, tokens=0, request=True, capacity_class=None):
+        """(pode_fazer_requisição, espera_em_segundos) sem registrar nada"""
+        wait_time = max(self._minute_wait(state, now, capacity_class) if request else 0.0,
+                        self._token_wait(state, now, tokens, capacity_class))
+        if wait_time > 0:
+            return False, max(1, int(wait_time))
+
+        if request and state.day_count >= self.requests_per_day:
+            return False, int((self.day_end - datetime.now()).total_seconds())
+
+        return True, 0
+
+    def can_make_request(self, tokens=0, capacity_class=None):
+        """
+        Verifica se podemos fazer mais uma requisição (com custo estimado de `tokens`) baseado nos limites
+        Retorna: (bool, tempo_de_espera_em_segundos)
+        """
+        with self.state.transaction() as state:
+            self._refresh(state)  # Verifica se é um novo dia
+            return self._check(state, state.clock(), tokens, capacity_class=capacity_class)
+
+    def try_acquire(self, tokens=0, request=True, capacity_class=None):
+        """
+        Verifica e registra uma requisição de uma vez, sem a janela entre
+        can_make_request e add_request em que outra thread (ou processo) pode passar na frente.
+        Com request=False só os `tokens` são cobrados (a requisição já foi reservada).
+        Retorna: (bool, tempo_de_espera_em_segundos)
+        """
+        with self.state.transaction() as state:
+            self._refresh(state)
+            now = state.clock()
+            can_request, wait_time = self._check(state, now, tokens, request, capacity_class)
+            if can_request:
+                self._record(state, now, 1 if request else 0, tokens)
+        if can_request and request:
+            self._log_usage()
+        return can_request, wait_time
+
+    def add_request(self, tokens=0):
         """Registra uma nova requisição"""
-        with self.lock:
-            now = time.time()
-            self.minute_requests.append(now)
-            self.day_requests.append(now)
-            self.total_requests_minute = len(self.minute_requests)
-            self.total_requests_today = len(self.day_requests)
+        with self.state.transaction() as state:
+            self._refresh(state)
+            self._record(state, state.clock(), 1, tokens)
+        self._log_usage()
+
+    def reconcile_tokens(self, estimated, actual):
+        """
+        Acerta o balde de tokens com o uso real informado pela API depois da resposta:
+        a diferença para a estimativa cobrada antes da chamada é somada (ou devolvida)
+        """
+        if not self.tokens_per_minute or actual is None or actual == estimated:
+            return
+        with self.state.transaction() as state:
+            state.token_tat += (actual - estimated) * self.token_interval
+        logger.debug(f"Rate limiter '{self.name}': {actual} tokens usados (estimativa {estimated})")
 
-            logger.debug(f"Rate limiter '{self.name}': requisição registrada. "
-                        f"{self.total_requests_minute}/{self.requests_per_minute} req/min, "
-                        f"{self.total_requests_today}/{self.requests_per_day} req/dia")
+    def _log_usage(self):
+        logger.debug(f"Rate limiter '{self.name}': requisição registrada. "
+                    f"{self.total_requests_minute}/{self.requests_per_minute} req/min, "
+                    f"{self.total_requests_today}/{self.requests_per_day} req/dia")
 
-            # Alerta se estiver chegando perto do limite
-            if self.total_requests_today > self.requests_per_day * 0.8:
-                logger.warning(f"Rate limiter '{self.name}': {self.total_requests_today} requisições hoje. "
-                              f"Aproximando-se do limite diário ({self.requests_per_day})")
+        # Alerta se estiver chegando perto do limite
+        if self.total_requests_today > self.requests_per_day * 0.8:
+            logger.warning(f"Rate limiter '{self.name}': {self.total_requests_today} requisições hoje. "
+                          f"Aproximando-se do limite diário ({self.requests_per_day})")
 
     def get_stats(self):
-        """Retorna estatísticas de uso atual"""
-        with self.lock:
-            self._cleanup_old_requests()
-            return {
-                "name": self.name,
-                "minute_usage": len(self.minute_requests),
-                "minute_limit": self.requests_per_minute,
-                "minute_percent": (len(self.minute_requests) / self.requests_per_minute) * 100 if self.requests_per_minute else 0,
-                "day_usage": len(self.day_requests),
-                "day_limit": self.requests_per_day,
-                "day_percent": (len(self.day_requests) / self.requests_per_day) * 100 if self.requests_per_day else 0,
-                "total_today": self.total_requests_today
-            }
-
-    def wait_if_needed(self):
+        """Retorna estatísticas de uso atual (somadas entre os processos, se o estado for compartilhado)"""
+        with self.state.transaction() as state:
+            self._refresh(state)
+            now = state.clock()
+            minute_usage = self._minute_usage(state, now)
+            token_usage = self._token_usage(state, now)
+            day_usage = state.day_count
+        return {
+            "name": self.name,
+            "minute_usage": minute_usage,
+            "minute_limit": int(self.requests_per_minute),
+            "minute_percent": (minute_usage / self.requests_per_minute) * 100 if self.requests_per_minute else 0,
+            "day_usage": day_usage,
+            "day_limit": self.requests_per_day,
+            "day_percent": (day_usage / self.requests_per_day) * 100 if self.requests_per_day else 0,
+            "total_today": day_usage,
+            "token_minute_usage": token_usage,
+            "token_minute_limit": self.tokens_per_minute,
+            "token_minute_percent": (token_usage / self.tokens_per_minute) * 100 if self.tokens_per_minute else 0,
+            "adaptive": self.adaptive,
+            "effective_rate": round(self.requests_per_minute, 2),  # req/min em vigor (minute_limit, no modo adaptativo)
+            "capacity_classes": dict(self.capacity_classes),
+            "shared": self.state.shared
+        }
+
+    def seconds_until_capacity(self, requests, capacity_class=None):
+        """
+        Estima em quantos segundos o limiter comporta mais `requests` requisições de `capacity_class`:
+        a folga do minuto atual sai na hora, o excedente no ritmo de requests_per_minute
+        """
+        with self.state.transaction() as state:
+            self._refresh(state)
+
+            if state.day_count + requests > self.requests_per_day:
+                # O excedente só cabe na cota de amanhã
+                return max(0.0, (self.day_end - datetime.now()).total_seconds())
+
+            now = state.clock()
+            # Instante em que a última das `requests` cabe no balde
+            return max(0.0, max(state.tat, now) + requests * self.interval - self._window(capacity_class) - now)
+
+    def reserve(self, requests=1, capacity_class=None, tokens=0):
+        """
+        Reserva `requests` requisições (e, com tokens_per_minute, os `tokens` estimados
+        delas) no primeiro instante em que os limites permitem e retorna esse instante
+        (timestamp de time.time()). Quem reserva não precisa esperar dentro do limiter:
+        agenda o trabalho para o instante retornado.
+        """
+        return self.try_reserve(requests, capacity_class, tokens)[0]
+
+    def try_reserve(self, requests=1, capacity_class=None, tokens=0):
+        """
+        Como reserve, mas classes abaixo da mais alta só registram a reserva quando ela cabe
+        agora: uma classe abaixo que ocupasse o balde com reservas para depois deixaria as
+        classes acima sem a parte reservada a elas. Sem vaga agora, a reserva entra na fila
+        da classe (class_tat), que espaça os jobs que esperam, e quem reservou reserva de novo
+        no instante retornado.
+        Retorna: (instante, reservado, segundos ocupados no balde do minuto pelas requisições),
+        os segundos para release: no modo adaptativo a taxa pode mudar antes da devolução
+        """
+        with self.state.transaction() as state:
+            self._refresh(state)
+
+            now = state.clock()
+            wall_now = time.time()
+            start = now
+            seconds = requests * self.interval
+            window = self._window(capacity_class)
+            if self.held_back.get(capacity_class, self.reserved_fraction):
+                delay = self._queue_reservation(state, now, wall_now, requests, capacity_class, tokens)
+                if delay > 0:
+                    return wall_now + delay, False, 0.0
+            if requests and state.day_count + requests > self.requests_per_day:
+                # A cota de hoje acabou: a reserva fica para o começo de amanhã
+                start = now + (self.day_end.timestamp() - wall_now)
+                state.next_day_count += requests
+                state.tat = max(state.tat, start) + seconds
+            elif requests:
+                self._record(state, now, requests)
+            # Instante em que a última requisição reservada cabe na parte do balde da classe
+            delay = max(start, state.tat - window if requests else now) - now
+
+            if tokens and self.tokens_per_minute:
+                # Como em _token_wait, uma reserva maior que a cota inteira da classe cabe no balde vazio
+                token_start = max(state.token_tat, now)
+                state.token_tat = token_start + tokens * self.token_interval
+                delay = max(delay, token_start + min(tokens * self.token_interval, window) - window - now)
+
+        if delay > 0:
+            logger.debug(f"Rate limiter '{self.name}': {requests} requisição(ões) e {tokens} tokens "
+                         f"reservados para daqui a {delay:.1f}s")
+        return wall_now + delay, True, seconds
+
+    def _queue_reservation(self, state, now, wall_now, requests, capacity_class, tokens):
+        """
+        Segundos até a reserva de uma classe abaixo caber na parte do balde da classe (0 se
+        cabe agora). Sem vaga agora, só a fila da classe avança; o balde não é ocupado
+        """
+        window = self._window(capacity_class)
+        delay = 0.0
+        if requests and state.day_count + requests > self.requests_per_day:
+            delay = self.day_end.timestamp() - wall_now
+        if requests:
+            delay = max(delay, max(state.tat, now) + requests * self.interval - window - now)
+        delay = max(delay, self._token_wait(state, now, tokens, capacity_class))
+        if delay <= 0:
+            return 0.0
+
+        queues = dict(state.class_tat or {})
+        key = str(capacity_class)
+        delay = max(delay, queues.get(key, now) - now)
+        queues[key] = now + delay + requests * self.interval
+        state.class_tat = queues
+        logger.debug(f"Rate limiter '{self.name}': {requests} requisição(ões) da classe {capacity_class} "
+                     f"na fila para daqui a {delay:.1f}s")
+        return delay
+
+    def release(self, requests=1, tokens=0, seconds=None):
+        """
+        Devolve requisições e tokens reservados com reserve() que não serão usados (job
+        cancelado ou expirado). `seconds` são os segundos que as requisições ocuparam no balde
+        quando foram reservadas (retornados por try_reserve); sem eles, usa a taxa atual
+        """
+        with self.state.transaction() as state:
+            self._refresh(state)
+            state.tat -= requests * self.interval if seconds is None else seconds
+            state.day_count = max(0, state.day_count - requests)
+            if tokens and self.tokens_per_minute:
+                state.token_tat -= tokens * self.token_interval
+        logger.debug(f"Rate limiter '{self.name}': {requests} requisição(ões) e {tokens} tokens reservados devolvidos")
+
+    def _take_reserved(self, tokens):
+        """
+        Consome a reserva do job em execução para uma chamada de `tokens`: retorna se a
+        requisição ainda precisa ser cobrada e quantos tokens a reserva não cobriu
+        """
+        reservation = (_reserved.get() or {}).get(self)
+        if not reservation:
+            return True, tokens
+        request = reservation[0] <= 0
+        if not request:
+            reservation[0] -= 1
+        covered = min(tokens, reservation[1])
+        reservation[1] -= covered
+        return request, tokens - covered
+
+    def wait_if_needed(self, tokens=0, capacity_class=None):
         """
         Verifica se podemos fazer mais uma requisição e espera se necessário.
+        `tokens` é a estimativa dos tokens de entrada da chamada (com tokens_per_minute) e
+        `capacity_class` a classe da chamada (com capacity_classes).
         Retorna True se a requisição pode prosseguir, False se devemos rejeitar.
         """
-        can_request, wait_time = self.can_make_request()
+        # Com reserva, só o que ela não cobre é cobrado (tokens além da estimativa reservada)
+        request, tokens = self._take_reserved(tokens)
+        if not request and not (tokens and self.tokens_per_minute):
+            return True
+
+        can_request, wait_time = self.try_acquire(tokens, request, capacity_class)
 
         if not can_request:
             if wait_time > 300:  # Se precisar esperar mais de 5 minutos
@@ -123,10 +622,36 @@ class RateLimiter:
             time.sleep(wait_time)
 
             # Verificar novamente após esperar
-            can_request, _ = self.can_make_request()
+            can_request, _ = self.try_acquire(tokens, request, capacity_class)
+            if not can_request:
+                logger.warning(f"Rate limiter '{self.name}': Ainda no limite após esperar, rejeitando requisição")
+                return False
+
+        return True
+
+    async def wait_if_needed_async(self, tokens=0, capacity_class=None):
+        """
+        Versão de wait_if_needed para corrotinas: espera com asyncio.sleep,
+        sem bloquear o event loop onde outras requisições estão em andamento.
+        A transação do estado (que pode esperar o lock do SQLite) roda em uma thread.
+        """
+        request, tokens = self._take_reserved(tokens)
+        if not request and not (tokens and self.tokens_per_minute):
+            return True
+
+        can_request, wait_time = await asyncio.to_thread(self.try_acquire, tokens, request, capacity_class)
+
+        if not can_request:
+            if wait_time > 300:  # Se precisar esperar mais de 5 minutos
+                logger.warning(f"Rate limiter '{self.name}': Limite atingido, espera necessária: {wait_time}s (rejeitando)")
+                return False
+
+            logger.info(f"Rate limiter '{self.name}': Limite atingido, esperando {wait_time}s")
+            await asyncio.sleep(wait_time)
+
+            can_request, _ = await asyncio.to_thread(self.try_acquire, tokens, request, capacity_class)
             if not can_request:
                 logger.warning(f"Rate limiter '{self.name}': Ainda no limite após esperar, rejeitando requisição")
                 return False
 
-        self.add_request()
         return True
@@ -1,8 +1,14 @@
+import threading
+import time
+
 from django.test import TestCase, Client
 from django.urls import reverse
-from .models import Email
+from .models import Email, QueuedJob
 from unittest.mock import patch
-from .ai_service import classify_email, suggest_response
+from .ai_service import (classify_email, suggest_response, classify_emails_batch, _parse_batch_classification,
+                         requeue_orphaned_emails, RESPONSE_PENDING)
+from .job_queue import Job, JobStatus
+from .job_store import DatabaseJobStore
 
 
 class EmailModelTests(TestCase):
@@ -52,6 +58,70 @@ class EmailViewTests(TestCase):
         self.assertContains(response, "Email de teste")
         self.assertContains(response, "test@example.com")
 
+    @patch('classifier.views.job_queue.admission_delay', return_value=120)
+    def test_api_submit_email_rejected_when_queue_cannot_serve_it(self, mock_admission):
+        """Teste do controle de admissão: fila cheia responde 429 com Retry-After e não salva o email"""
+        response = self.client.post(reverse('api_submit_email'), {
+            'input_method': 'text', 'subject': 'Assunto', 'content': 'Conteúdo', 'sender': 'a@example.com'
+        })
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '120')
+        self.assertIn('Retry-After', response['Access-Control-Expose-Headers'])
+        self.assertEqual(Email.objects.count(), 1)
+
+    @patch('classifier.views._job_event_slots', new_callable=lambda: threading.BoundedSemaphore(1))
+    def test_event_streams_over_the_limit_get_503_until_one_closes(self, mock_slots):
+        """Teste do SSE: acima do limite de streams abertos responde 503 com Retry-After"""
+        first = self.client.get(reverse('api_job_events', args=['job-1']))
+        self.assertEqual(first.status_code, 200)
+
+        refused = self.client.get(reverse('api_job_events', args=['job-2']))
+        self.assertEqual(refused.status_code, 503)
+        self.assertIn('Retry-After', refused)
+
+        first.close()  # o servidor fecha a resposta quando o cliente desconecta
+        second = self.client.get(reverse('api_job_events', args=['job-2']))
+        self.assertEqual(second.status_code, 200)
+        second.close()
+
+    def _dead_letter_job(self, client_key):
+        job = Job("classify_email", {'subject': 'Assunto', 'content': 'Conteúdo'})
+        job.client_key = client_key
+        job.dead_letter = True
+        job.status = JobStatus.FAILED
+        job.error = 'Falha definitiva'
+        return job
+
+    def test_dead_letter_list_shows_only_the_clients_jobs(self):
+        """Teste da dead-letter: um cliente anônimo vê só os próprios jobs"""
+        own, other = self._dead_letter_job('127.0.0.1'), self._dead_letter_job('10.0.0.9')
+        with patch('classifier.views.job_queue.get_dead_letters', return_value=[own, other]):
+            response = self.client.get(reverse('api_dead_letter_jobs'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([job['id'] for job in response.json()['jobs']], [own.id])
+
+    def test_retry_dead_letter_of_another_client_returns_403(self):
+        """Teste da dead-letter: só quem enviou o job pode devolvê-lo à fila"""
+        job = self._dead_letter_job('10.0.0.9')
+        with patch('classifier.views.job_queue.get_job', return_value=job), \
+                patch('classifier.views.job_queue.retry_dead_letter') as mock_retry:
+            response = self.client.post(reverse('api_retry_dead_letter', args=[job.id]))
+        self.assertEqual(response.status_code, 403)
+        mock_retry.assert_not_called()
+
+    @patch('classifier.views.job_queue.get_job', return_value=None)
+    def test_retry_unknown_dead_letter_returns_404(self, mock_get_job):
+        """Teste da dead-letter: job inexistente (ou fora da dead-letter) responde 404"""
+        response = self.client.post(reverse('api_retry_dead_letter', args=['job-inexistente']))
+        self.assertEqual(response.status_code, 404)
+
+    @patch('classifier.views.job_queue.cancel', return_value=None)
+    @patch('classifier.views.job_queue.get_job', return_value=Job("classify_email", {}))
+    def test_cancel_job_evicted_before_cancel_returns_404(self, mock_get_job, mock_cancel):
+        """Teste de cancelamento: job descartado entre a consulta e o cancelamento responde 404"""
+        response = self.client.delete(reverse('api_job_status', args=['job-descartado']))
+        self.assertEqual(response.status_code, 404)
+
 
 class AIServiceTests(TestCase):
     @patch('classifier.ai_service.co.classify')
@@ -79,3 +149,168 @@ class AIServiceTests(TestCase):
         result = suggest_response("Assunto de teste", "Conteúdo de teste", "productive")
         self.assertEqual(result, "Resposta sugerida de teste.")
         mock_generate.assert_called_once()
+
+    def test_parse_batch_classification(self):
+        """Teste da leitura da resposta JSON de uma classificação em lote"""
+        text = '```json\n[{"id": 1, "category": "Unproductive", "confidence": 80},' \
+               ' {"id": 0, "category": "productive"}, {"id": 7, "category": "productive"}]\n```'
+        parsed = _parse_batch_classification(text, 2)
+        self.assertEqual(parsed, {
+            0: {'category': 'productive', 'confidence_score': 75.0},
+            1: {'category': 'unproductive', 'confidence_score': 80.0},
+        })
+
+    @patch('classifier.ai_service.GEMINI_API_KEY', None)
+    def test_classify_emails_batch_falls_back_per_email(self):
+        """Teste do fallback heurístico para cada email do lote"""
+        results = classify_emails_batch([
+            {'subject': 'Erro no sistema', 'content': 'O login não funciona'},
+            {'subject': 'Parabéns', 'content': 'Feliz aniversário!'},
+        ])
+        self.assertEqual([r['category'] for r in results], ['productive', 'unproductive'])
+
+
+class OrphanedEmailTests(TestCase):
+    @patch('classifier.ai_service.queue_complete_email_processing')
+    def test_old_pending_emails_without_job_are_requeued(self, mock_queue):
+        """Teste da varredura de emails 'pending' cujo job se perdeu (ex.: redeploy)"""
+        orphan = Email.objects.create(subject="Órfão", content="Sem job", sender="a@example.com",
+                                      category="pending", job_id="job-perdido")
+        recent = Email.objects.create(subject="Novo", content="Ainda na fila", sender="b@example.com",
+                                      category="pending")
+        Email.objects.filter(pk=orphan.pk).update(created_at=orphan.created_at.replace(year=2020))
+
+        self.assertEqual(requeue_orphaned_emails(grace=60), 1)
+        orphan.refresh_from_db()
+        self.assertNotEqual(orphan.job_id, "job-perdido")
+        self.assertEqual(mock_queue.call_args.kwargs['job_id'], orphan.job_id)
+        self.assertEqual(mock_queue.call_args.args[1], orphan.pk)
+        self.assertNotEqual(mock_queue.call_args.args[1], recent.pk)
+
+    @patch('classifier.ai_service.queue_email_response')
+    @patch('classifier.ai_service.queue_complete_email_processing')
+    def test_classified_emails_missing_response_only_requeue_response_stage(self, mock_complete, mock_response):
+        """Teste de email já classificado cujo estágio de resposta se perdeu: a categoria é mantida"""
+        email = Email.objects.create(subject="Classificado", content="Falta a resposta", sender="a@example.com",
+                                     category="productive", suggested_response=RESPONSE_PENDING,
+                                     job_id="resposta-perdida")
+        Email.objects.filter(pk=email.pk).update(created_at=email.created_at.replace(year=2020))
+
+        self.assertEqual(requeue_orphaned_emails(grace=60), 1)
+        mock_complete.assert_not_called()
+        self.assertEqual(mock_response.call_args.args[1:3], ("productive", email.pk))
+
+
+class DatabaseJobStoreTests(TestCase):
+    def setUp(self):
+        self.store = DatabaseJobStore()
+
+    def test_claim_follows_priority_and_is_exclusive(self):
+        """Teste de retirada atômica de jobs pela ordem de prioridade"""
+        low = Job("classify_email", {"subject": "baixa"}, priority=2)
+        high = Job("classify_email", {"subject": "alta"}, priority=1)
+        self.store.add(low)
+        self.store.add(high)
+
+        self.assertEqual(self.store.queue_length(), 2)
+        self.assertEqual(self.store.get(low.id).position_in_queue, 1)
+
+        claimed = self.store.claim(["classify_email"], "worker-1")
+        self.assertEqual(claimed.id, high.id)
+        self.assertEqual(QueuedJob.objects.get(pk=high.id).status, JobStatus.PROCESSING)
+
+        second = self.store.claim(["classify_email"], "worker-2")
+        self.assertEqual(second.id, low.id)
+        self.assertIsNone(self.store.claim(["classify_email"], "worker-3"))
+
+    def test_update_shares_result_between_processes(self):
+        """Teste de persistência do resultado visível via get()"""
+        job = Job("classify_email", {"subject": "teste"})
+        self.store.add(job)
+        claimed = self.store.claim(["classify_email"], "worker-1")
+
+        claimed.start()
+        claimed.complete({"category": "productive"})
+        self.store.update(claimed)
+
+        stored = DatabaseJobStore().get(job.id)
+        self.assertEqual(stored.status, JobStatus.COMPLETED)
+        self.assertEqual(stored.result, {"category": "productive"})
+        self.assertIsNotNone(stored.completed_at)
+
+    def test_claim_interleaves_clients(self):
+        """Teste de fair queuing: o job de um segundo cliente não espera o lote do primeiro"""
+        bulk = []
+        for n in range(3):
+            job = Job("classify_email", {"subject": f"lote {n}"})
+            job.client_key = "10.0.0.1"
+            self.store.add(job)
+            bulk.append(job)
+        other = Job("classify_email", {"subject": "interativo"})
+        other.client_key = "10.0.0.2"
+        self.store.add(other)
+
+        self.assertEqual(self.store.get(other.id).position_in_queue, 1)
+        claimed = [self.store.claim(["classify_email"], "worker-1").id for _ in range(4)]
+        self.assertEqual(claimed[:3], [bulk[0].id, other.id, bulk[1].id])
+
+    def test_followers_are_not_dispatched_and_are_taken_once(self):
+        """Teste de jobs agrupados: só o líder é despachado e os seguidores saem uma vez"""
+        leader = Job("process_email_complete", {"email_id": 1})
+        leader.coalesce_key = "process_email_complete:abc"
+        self.store.add(leader)
+
+        found = self.store.find_inflight(leader.coalesce_key)
+        follower = Job("process_email_complete", {"email_id": 2})
+        follower.coalesce_key = leader.coalesce_key
+        follower.leader_id = found.id
+        self.store.add(follower)
+
+        self.assertEqual(self.store.queue_length(), 1)
+        self.assertEqual(self.store.claim(["process_email_complete"], "worker-1").id, leader.id)
+        self.assertIsNone(self.store.claim(["process_email_complete"], "worker-2"))
+
+        self.assertEqual([j.id for j in self.store.take_followers(leader.id)], [follower.id])
+        self.assertEqual(self.store.take_followers(leader.id), [])
+
+    def test_withdraw_takes_only_waiting_jobs_and_cancel_request_is_shared(self):
+        """Teste de cancelamento: só jobs aguardando saem da fila; os em processamento recebem o pedido"""
+        running = Job("classify_email", {"subject": "em processamento"})
+        waiting = Job("classify_email", {"subject": "aguardando"})
+        self.store.add(running)
+        self.store.add(waiting)
+        self.assertEqual(self.store.claim(["classify_email"], "worker-1").id, running.id)
+
+        self.assertEqual(self.store.withdraw(waiting.id).status, JobStatus.CANCELLED)
+        self.assertIsNone(self.store.withdraw(waiting.id))
+        self.assertIsNone(self.store.withdraw(running.id))
+        self.assertEqual(self.store.queue_length(), 0)
+
+        self.assertFalse(DatabaseJobStore().cancel_requested(running.id))
+        self.assertTrue(self.store.request_cancel(running.id))
+        self.assertTrue(DatabaseJobStore().cancel_requested(running.id))
+
+    def test_requeued_job_waits_until_available_and_dead_letter_survives_cleanup(self):
+        """Teste de nova tentativa agendada e de retenção da dead-letter"""
+        job = Job("classify_email", {"subject": "teste"})
+        self.store.add(job)
+        claimed = self.store.claim(["classify_email"], "worker-1")
+        claimed.start()
+        claimed.retry("API indisponível", time.time() + 60)
+        self.store.requeue(claimed)
+
+        self.assertIsNone(self.store.claim(["classify_email"], "worker-1"))
+        QueuedJob.objects.filter(pk=job.id).update(available_at=time.time() - 1)
+        claimed = self.store.claim(["classify_email"], "worker-1")
+        self.assertEqual(claimed.attempts, 1)
+
+        claimed.start()
+        claimed.fail("API indisponível")
+        claimed.result_ttl = 0
+        self.store.update(claimed)
+        self.store.dead_letter(claimed)
+        self.store.run_timers(time.time() + self.store.cleanup_interval)
+
+        self.assertEqual([j.id for j in self.store.dead_letters()], [job.id])
+        self.assertEqual(self.store.remove_dead_letter(job.id).attempts, 2)
+        self.assertIsNone(self.store.remove_dead_letter(job.id))
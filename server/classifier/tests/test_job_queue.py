@@ -0,0 +1,926 @@
+import asyncio
+import bisect
+import random
+import threading
+import time
+
+import pytest
+
+from classifier.job_queue import Job, JobQueue, JobStatus, RetryableJobError, RetryPolicy
+from classifier.job_stats import ProcessingStats
+from classifier.job_store import MemoryJobStore, OrderedIndex, ResultSpill
+from classifier.rate_limiter import RateLimiter
+
+
+def wait_until(predicate, timeout=5.0):
+    """Espera até que a condição seja verdadeira ou o tempo acabe."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+@pytest.fixture
+def make_queue():
+    """Cria instâncias novas do JobQueue (singleton) e as para ao final."""
+    created = []
+
+    def factory(**kwargs):
+        JobQueue._instance = None
+        queue = JobQueue(**kwargs)
+        created.append(queue)
+        return queue
+
+    yield factory
+
+    for queue in created:
+        queue.stop_worker()
+        queue.async_executor.stop(timeout=1.0)
+        queue.callbacks.stop(timeout=1.0)
+    JobQueue._instance = None
+
+
+def test_pool_runs_jobs_in_parallel(make_queue):
+    """Vários workers processam jobs ao mesmo tempo e o status lista todos."""
+    queue = make_queue(num_workers=4)
+    release = threading.Event()
+    queue.register_job_type("slow", lambda data: release.wait(5) and data["n"])
+
+    job_ids = [queue.enqueue("slow", {"n": n}) for n in range(4)]
+
+    assert wait_until(lambda: queue.get_queue_status()["processing_count"] == 4)
+    status = queue.get_queue_status()
+    assert {j["id"] for j in status["active_jobs"]} == set(job_ids)
+
+    release.set()
+    assert wait_until(lambda: all(queue.get_job(j).status == JobStatus.COMPLETED for j in job_ids))
+
+
+def test_job_type_options_are_keyword_only(make_queue):
+    """Opções do tipo de job só por nome: um argumento posicional fora de ordem não troca ttl por on_expire em silêncio."""
+    queue = make_queue(num_workers=1)
+    with pytest.raises(TypeError):
+        queue.register_job_type("echo", lambda data: data, 2, 30)
+    queue.register_job_type("echo", lambda data: data, max_concurrency=2, ttl=30)
+    spec = queue.job_types["echo"]
+    assert spec.max_concurrency == 2 and spec.ttl == 30 and spec.on_expire is None
+
+
+def test_async_handlers_run_on_event_loop_beyond_worker_pool(make_queue):
+    """Corrotinas ficam em andamento no event loop além do tamanho do pool, até o limite assíncrono."""
+    queue = make_queue(num_workers=2, async_concurrency=6)
+    running = {"now": 0, "peak": 0}
+    failed_once = set()
+
+    async def fetch(data):
+        running["now"] += 1
+        running["peak"] = max(running["peak"], running["now"])
+        try:
+            await asyncio.sleep(0.2)
+        finally:
+            running["now"] -= 1
+        if data["n"] == 0 and 0 not in failed_once:
+            failed_once.add(0)
+            raise RetryableJobError("indisponível", retry_after=0.05)
+        return data["n"] * 2
+
+    queue.register_job_type("fetch", fetch, retry_policy=RetryPolicy(max_attempts=2, base_delay=0.05))
+    job_ids = [queue.enqueue("fetch", {"n": n}) for n in range(10)]
+
+    assert wait_until(lambda: all(queue.get_job(j).status == JobStatus.COMPLETED for j in job_ids))
+    assert running["peak"] == 6
+    assert [queue.get_job(j).result for j in job_ids] == [n * 2 for n in range(10)]
+    assert queue.get_job(job_ids[0]).attempts == 2
+    assert queue.get_queue_status()["async_in_flight"] == 0
+
+
+def test_concurrency_limit_per_job_type(make_queue):
+    """O limite por tipo é respeitado sem bloquear jobs de outros tipos."""
+    queue = make_queue(num_workers=4)
+    release = threading.Event()
+    running = {"doc": 0, "peak": 0}
+    lock = threading.Lock()
+
+    def document_handler(data):
+        with lock:
+            running["doc"] += 1
+            running["peak"] = max(running["peak"], running["doc"])
+        release.wait(5)
+        with lock:
+            running["doc"] -= 1
+
+    queue.register_job_type("process_document", document_handler, max_concurrency=2)
+    queue.register_job_type("classify_email", lambda data: "productive")
+
+    doc_ids = [queue.enqueue("process_document", {}) for _ in range(5)]
+    classify_id = queue.enqueue("classify_email", {}, priority=2)
+
+    # O job de classificação passa na frente dos documentos bloqueados pelo limite
+    assert wait_until(lambda: queue.get_job(classify_id).status == JobStatus.COMPLETED)
+    assert queue.get_queue_status()["running_by_type"]["process_document"] == {"running": 2, "limit": 2}
+
+    release.set()
+    assert wait_until(lambda: all(queue.get_job(j).status == JobStatus.COMPLETED for j in doc_ids))
+    assert running["peak"] == 2
+
+
+def test_idle_workers_wake_on_enqueue_and_stop(make_queue):
+    """Workers ociosos acordam na hora do enqueue e param sem esperar polling."""
+    queue = make_queue(num_workers=2)
+    started = []
+    queue.register_job_type("echo", lambda data: started.append(time.perf_counter() - data["t0"]))
+
+    time.sleep(0.2)
+    queue.enqueue("echo", {"t0": time.perf_counter()})
+    assert wait_until(lambda: started)
+    assert started[0] < 0.05
+
+    t0 = time.perf_counter()
+    queue.stop_worker()
+    assert time.perf_counter() - t0 < 1.0
+    assert not any(t.is_alive() for t in queue.worker_threads)
+
+
+def test_processing_stats_quantiles_follow_recent_times():
+    """O sketch acerta os quantis dentro do erro dos buckets e esquece medições antigas."""
+    stats = ProcessingStats(alpha=0.0001)
+    for seconds in range(1, 101):
+        stats.observe(float(seconds))
+    p50, p90 = stats.service_time()
+    assert p50 == pytest.approx(50, rel=0.05)
+    assert p90 == pytest.approx(90, rel=0.05)
+
+    recent = ProcessingStats(alpha=0.1)
+    for seconds in [30.0] * 100 + [2.0] * 60:
+        recent.observe(seconds)
+    assert recent.service_time()[0] == pytest.approx(2.0, rel=0.05)
+    assert recent.to_dict()["ewma"] == pytest.approx(2.0, rel=0.05)
+
+
+def test_wait_estimates_use_measured_times_workers_and_limiter(make_queue):
+    """A espera considera o tempo medido, o número de workers e a folga do rate limiter."""
+    queue = make_queue(num_workers=2)
+    release = threading.Event()
+    limiter = RateLimiter(requests_per_minute=1000, requests_per_day=100000, name="test")
+    queue.register_job_type("slow", lambda data: release.wait(5), rate_limiter=limiter, rate_cost=2.0)
+    for _ in range(50):
+        queue.processing_stats["slow"].observe(4.0)
+
+    for _ in range(2):
+        queue.enqueue("slow", {})
+    assert wait_until(lambda: queue.get_queue_status()["processing_count"] == 2)
+    job_ids = [queue.enqueue("slow", {}) for _ in range(6)]
+
+    # 4 jobs na frente, 2 workers, ~4s cada: ~8s
+    job = queue.get_job(job_ids[4])
+    assert job.position_in_queue == 4
+    assert job.wait_estimate[0] == pytest.approx(8.0, rel=0.05)
+    assert job.to_dict()["estimated_wait_time"] == round(job.wait_estimate[0])
+
+    # Com 6 req/min, as 8 chamadas dos jobs na frente passam a ser o gargalo: 2 além da folga, 20s
+    limiter.requests_per_minute = 6
+    assert queue.get_job(job_ids[4]).wait_estimate[0] == pytest.approx(20.0)
+    assert queue.get_queue_status()["estimated_wait"] == 60
+
+    release.set()
+    assert wait_until(lambda: all(queue.get_job(j).status == JobStatus.COMPLETED for j in job_ids))
+    assert queue.processing_stats["slow"].samples == 58
+
+
+def test_rate_limited_jobs_wait_in_timer_without_holding_the_worker(make_queue):
+    """Sem vaga no limiter, o job espera num timer; o único worker segue com outros jobs e a reserva é usada uma vez."""
+    queue = make_queue(num_workers=1)
+    limiter = RateLimiter(requests_per_minute=1, requests_per_day=100000, name="test")
+    # A requisição que ocupa o minuto sai do balde daqui a ~0,5s
+    limiter.add_request()
+    limiter.state.tat = time.monotonic() + 0.5
+    calls = []
+
+    def call_api(data):
+        started = time.time()
+        assert limiter.wait_if_needed()
+        calls.append(time.time() - started)
+        return "ok"
+
+    queue.register_job_type("remote", call_api, rate_limiter=limiter, reserve_rate=True)
+    queue.register_job_type("local", lambda data: "local")
+
+    remote_id = queue.enqueue("remote", {})
+    assert wait_until(lambda: queue.get_job(remote_id).to_dict()["rate_limited_until"] is not None)
+    local_id = queue.enqueue("local", {})
+    assert wait_until(lambda: queue.get_job(local_id).status == JobStatus.COMPLETED, timeout=0.4)
+    assert queue.get_job(remote_id).status == JobStatus.QUEUED
+
+    assert wait_until(lambda: queue.get_job(remote_id).status == JobStatus.COMPLETED, timeout=3.0)
+    # O handler usou a vaga reservada sem dormir nem registrar outra requisição
+    assert calls[0] < 0.1
+    assert limiter.get_stats()["day_usage"] == 2
+    assert queue.get_job(remote_id).rate_reserved == 0
+
+
+def test_jobs_short_on_tokens_wait_in_timer_and_use_the_reserved_tokens(make_queue):
+    """Com rate_tokens, um job sem tokens na cota do minuto também espera no timer, e o handler usa os tokens reservados sem esperar."""
+    queue = make_queue(num_workers=1)
+    limiter = RateLimiter(requests_per_minute=100, requests_per_day=100000, name="test", tokens_per_minute=6000)
+    # O balde de tokens tem 55,5s ocupados: 500 tokens (5s do balde) só cabem daqui a ~0,5s
+    limiter.add_request()
+    limiter.state.token_tat = time.monotonic() + 55.5
+    calls = []
+
+    def call_api(data):
+        started = time.time()
+        assert limiter.wait_if_needed(tokens=data["tokens"])
+        calls.append(time.time() - started)
+        return "ok"
+
+    queue.register_job_type("remote", call_api, rate_limiter=limiter, reserve_rate=True,
+                            rate_tokens=lambda data: data["tokens"])
+
+    job_id = queue.enqueue("remote", {"tokens": 500})
+    assert wait_until(lambda: queue.get_job(job_id).to_dict()["rate_limited_until"] is not None)
+    assert queue.get_job(job_id).rate_reserved_tokens == 500
+
+    assert wait_until(lambda: queue.get_job(job_id).status == JobStatus.COMPLETED, timeout=3.0)
+    assert calls[0] < 0.1
+    job = queue.get_job(job_id)
+    assert job.rate_reserved == 0 and job.rate_reserved_tokens == 0
+    assert limiter.get_stats()["minute_usage"] == 2
+
+
+def test_cancelling_a_rate_limited_job_returns_its_reservation(make_queue):
+    """Job cancelado enquanto espera a vaga devolve a reserva ao limiter e deixa de mostrar rate_limited_until."""
+    queue = make_queue(num_workers=1)
+    limiter = RateLimiter(requests_per_minute=1, requests_per_day=100000, name="test")
+    limiter.add_request()
+    queue.register_job_type("remote", lambda data: "ok", rate_limiter=limiter, reserve_rate=True)
+
+    job_id = queue.enqueue("remote", {})
+    assert wait_until(lambda: queue.get_job(job_id).to_dict()["rate_limited_until"] is not None)
+    assert limiter.get_stats()["day_usage"] == 2
+
+    queue.cancel(job_id)
+    job = queue.get_job(job_id)
+    assert job.status == JobStatus.CANCELLED and job.rate_reserved == 0
+    assert job.to_dict()["rate_limited_until"] is None
+    stats = limiter.get_stats()
+    assert stats["day_usage"] == 1 and stats["minute_usage"] == 1
+
+
+def test_admission_delay_rejects_jobs_that_would_wait_too_long(make_queue):
+    """A admissão compara a espera estimada com o máximo e devolve quanto falta para a fila escoar."""
+    queue = make_queue(num_workers=1)
+    release = threading.Event()
+    limiter = RateLimiter(requests_per_minute=1000, requests_per_day=100000, name="test")
+    queue.register_job_type("slow", lambda data: release.wait(5), rate_limiter=limiter)
+    for _ in range(20):
+        queue.processing_stats["slow"].observe(10.0)
+
+    queue.enqueue("slow", {})
+    assert wait_until(lambda: queue.get_queue_status()["processing_count"] == 1)
+    assert queue.admission_delay("slow", max_wait=30) is None
+    for _ in range(4):
+        queue.enqueue("slow", {})
+
+    # 5 jobs de ~10s para um worker: ~50s, 20s além do máximo
+    assert queue.admission_delay("slow", max_wait=30) == pytest.approx(20, abs=2)
+    # Sem cota no dia, a espera vai até o dia seguinte
+    limiter.requests_per_day = 0
+    assert queue.admission_delay("slow", max_wait=30) > 60
+    release.set()
+
+
+def test_slow_callbacks_run_off_worker_with_timeout_and_metrics(make_queue):
+    """Callbacks rodam no pool de hooks: o worker não espera, hooks presos são substituídos e tudo entra nas métricas."""
+    queue = make_queue(num_workers=1, callback_timeout=0.2)
+    gate = threading.Event()
+    done = []
+    queue.register_job_type("echo", lambda data: data["n"])
+
+    def slow(job):
+        gate.wait(5)
+        done.append(job.result)
+
+    slow_ids = [queue.enqueue("echo", {"n": n}, callback=slow) for n in range(queue.callbacks.concurrency)]
+    failing_id = queue.enqueue("echo", {"n": -1}, callback=lambda job: 1 / 0)
+    fast_id = queue.enqueue("echo", {"n": 99}, callback=lambda job: done.append(job.result))
+
+    # O único worker conclui todos os jobs mesmo com todas as threads de hooks presas
+    assert wait_until(lambda: all(queue.get_job(j).status == JobStatus.COMPLETED
+                                  for j in slow_ids + [failing_id, fast_id]), timeout=1.0)
+    # Os hooks presos passam do prazo e threads novas executam os que aguardavam
+    assert wait_until(lambda: done == [99] and queue.callbacks.stats()["failed"] == 1, timeout=2.0)
+    assert queue.get_queue_status()["callbacks"]["timed_out"] == len(slow_ids)
+
+    gate.set()
+    assert wait_until(lambda: sorted(done) == list(range(len(slow_ids))) + [99])
+    assert wait_until(lambda: queue.callbacks.stats()["completed"] == len(slow_ids) + 1)
+    assert queue.callbacks.stats()["latency"]["samples"] == len(slow_ids) + 2
+
+
+def test_autoscaling_follows_backlog_and_rate_limit_headroom(make_queue):
+    """O pool cresce com a fila até o máximo, não passa do que a cota sustenta e dispensa workers ociosos."""
+    queue = make_queue(num_workers=1, min_workers=1, max_workers=6)
+    release = threading.Event()
+    limiter = RateLimiter(requests_per_minute=600, requests_per_day=100000, name="test")
+    queue.register_job_type("slow", lambda data: release.wait(5), rate_limiter=limiter)
+    for _ in range(20):
+        queue.processing_stats["slow"].observe(2.0)
+
+    job_ids = [queue.enqueue("slow", {}) for _ in range(40)]
+    assert wait_until(lambda: queue.get_queue_status()["processing_count"] == 1)
+    # 39 jobs de ~2s para escoar em 10s pedem 8 workers: limitado ao máximo
+    assert queue.desired_workers() == 6
+
+    # 45 req/min com jobs de ~2s sustentam só 1,5 em paralelo, além do que já está ocupado
+    limiter.requests_per_minute = 45
+    assert queue.desired_workers() == 3
+    # Sem folga no minuto, mais workers só esperariam o limiter
+    for _ in range(45):
+        limiter.add_request()
+    assert queue.desired_workers() == 1
+
+    assert queue.scale_workers(10) == 6
+    assert wait_until(lambda: queue.get_queue_status()["processing_count"] == 6)
+    release.set()
+    assert wait_until(lambda: all(queue.get_job(j).status == JobStatus.COMPLETED for j in job_ids))
+
+    queue.scale_workers(2)
+    assert wait_until(lambda: len(queue.worker_threads) == 2)
+    assert sum(t.is_alive() for t in queue.worker_threads) == 2
+
+
+def test_ordered_index_matches_sorted_list():
+    """Inserções, remoções e ranks batem com uma lista ordenada de referência."""
+    rng = random.Random(42)
+    index, reference = OrderedIndex(), []
+
+    for _ in range(2000):
+        if reference and rng.random() < 0.4:
+            key = rng.choice(reference)
+            index.remove(key)
+            reference.remove(key)
+        else:
+            key = (rng.randint(1, 3), rng.random())
+            index.insert(key)
+            bisect.insort(reference, key)
+
+        probe = (rng.randint(1, 3), rng.random())
+        assert index.rank(probe) == bisect.bisect_left(reference, probe)
+
+    assert list(index) == reference
+    assert len(index) == len(reference)
+    with pytest.raises(KeyError):
+        index.remove((9, 0.0))
+
+
+def test_positions_follow_priority_across_job_types():
+    """A posição considera a prioridade real, somando todos os tipos de job."""
+    store = MemoryJobStore()
+    low = Job("suggest_response", {}, priority=2)
+    first = Job("classify_email", {}, priority=1)
+    second = Job("process_document", {}, priority=1)
+    for job in (low, first, second):
+        store.add(job)
+
+    assert store.get(low.id).position_in_queue == 2
+    assert store.get(second.id).position_in_queue == 1
+    assert [j.id for j in store.queued(limit=2)] == [first.id, second.id]
+    assert store.queue_length() == 3
+
+    assert store.claim(["suggest_response", "process_document"], "w").id == second.id
+    assert store.get(low.id).position_in_queue == 1
+
+
+def make_client_job(client_key, priority=1, weight=1.0):
+    job = Job("classify_email", {}, priority=priority)
+    job.client_key = client_key
+    job.weight = weight
+    return job
+
+
+def test_clients_are_interleaved_by_weight():
+    """Um envio em massa não trava quem chega depois; o peso define a proporção."""
+    store = MemoryJobStore()
+    bulk = [make_client_job("10.0.0.1") for _ in range(6)]
+    for job in bulk:
+        store.add(job)
+    interactive = make_client_job("10.0.0.2")
+    store.add(interactive)
+
+    assert store.get(interactive.id).position_in_queue == 1
+    order = [store.claim(["classify_email"], "w").id for _ in range(7)]
+    assert order[:3] == [bulk[0].id, interactive.id, bulk[1].id]
+    assert store.clients == {}
+
+    # Peso 2: dois jobs do cliente pesado para cada um do outro
+    heavy = [make_client_job("api-key", weight=2.0) for _ in range(4)]
+    light = [make_client_job("10.0.0.3") for _ in range(2)]
+    for job in heavy + light:
+        store.add(job)
+    order = [store.claim(["classify_email"], "w").id for _ in range(6)]
+    assert order[:3].count(light[0].id) == 1 and order[3:].count(light[1].id) == 1
+
+
+def test_priority_ages_so_low_priority_is_not_starved():
+    """Prioridade baixa perde para a alta, mas não depois de esperar o bastante."""
+    store = MemoryJobStore(priority_aging=0.05)
+    waiting = make_client_job("a", priority=2)
+    store.add(waiting)
+    assert store.queued()[0].id == waiting.id
+
+    fresh = make_client_job("b", priority=1)
+    store.add(fresh)
+    # Ainda dentro do envelhecimento: a prioridade alta passa na frente
+    assert store.queued()[0].id == fresh.id
+
+    time.sleep(0.12)
+    late = make_client_job("c", priority=1)
+    store.add(late)
+    assert [j.id for j in store.queued()] == [fresh.id, waiting.id, late.id]
+
+
+def test_queued_job_expires_after_deadline(make_queue):
+    """Um job que passa do prazo na fila expira sem chamar o manipulador."""
+    queue = make_queue(num_workers=1)
+    release = threading.Event()
+    calls, expired = [], []
+    queue.register_job_type("blocker", lambda data: release.wait(5))
+    queue.register_job_type("classify_email", lambda data: calls.append(data),
+                            ttl=0.1, on_expire=expired.append)
+
+    queue.enqueue("blocker", {})
+    job_id = queue.enqueue("classify_email", {"subject": "sem pressa"})
+
+    # O prazo vence enquanto o único worker está ocupado; ao ser liberado,
+    # ele processa o timer antes de retirar o próximo job
+    time.sleep(0.2)
+    release.set()
+
+    assert wait_until(lambda: queue.get_job(job_id).status == JobStatus.EXPIRED)
+    assert wait_until(lambda: [j.id for j in expired] == [job_id])
+    assert queue.get_queue_status()["queue_length"] == 0
+    assert calls == []
+
+
+def test_finished_jobs_are_evicted_after_result_ttl(make_queue):
+    """Jobs finalizados saem do store quando a retenção vence, sem varredura."""
+    queue = make_queue(num_workers=1, result_ttl=0.1)
+    queue.register_job_type("echo", lambda data: data)
+
+    job_id = queue.enqueue("echo", {"n": 1})
+    assert wait_until(lambda: queue.get_job(job_id) is None)
+    assert queue.store.timers == []
+
+
+def test_leases_of_running_jobs_are_renewed_until_they_finish(make_queue):
+    """Com um store que tem lease, o heartbeat renova o lease dos jobs em processamento enquanto o handler roda."""
+    class LeasedStore(MemoryJobStore):
+        lease_seconds = 0.15
+
+        def __init__(self):
+            super().__init__()
+            self.renewals = []
+
+        def renew_leases(self, job_ids):
+            self.renewals.append(list(job_ids))
+
+    store = LeasedStore()
+    queue = make_queue(num_workers=1, store=store)
+    release = threading.Event()
+    queue.register_job_type("slow", lambda data: release.wait(5))
+
+    job_id = queue.enqueue("slow", {})
+    assert wait_until(lambda: sum(job_id in ids for ids in store.renewals) >= 3)
+    release.set()
+    assert wait_until(lambda: queue.get_job(job_id).status == JobStatus.COMPLETED)
+    renewed = len(store.renewals)
+    assert wait_until(lambda: len(store.renewals) > renewed)
+    assert job_id not in store.renewals[-1]
+
+
+def test_updates_of_finished_jobs_schedule_a_single_eviction():
+    """Só a transição para o estado final agenda o EVICT; atualizações seguintes não empilham timers."""
+    store = MemoryJobStore()
+    job = Job("echo", {})
+    store.add(job)
+    store.claim(["echo"], "w1")
+    job.status = JobStatus.COMPLETED
+    for _ in range(3):
+        store.update(job)
+    assert [t[2] for t in store.timers].count(MemoryJobStore.EVICT) == 1
+
+
+def test_retained_jobs_are_capped_lru_and_payloads_dropped(make_queue):
+    """Acima do limite sai o job finalizado consultado há mais tempo; os dados de entrada são descartados."""
+    queue = make_queue(num_workers=1, store=MemoryJobStore(max_jobs=2))
+    queue.register_job_type("doc", lambda data: len(data["text"]), drop_payload=True, keep_fields=("email_id",))
+
+    first = queue.enqueue("doc", {"email_id": 1, "text": "x" * 1000})
+    second = queue.enqueue("doc", {"email_id": 2, "text": "y" * 1000})
+    assert wait_until(lambda: queue.get_job(second).data == {"email_id": 2})
+    assert queue.get_job(first).result == 1000
+    assert not hasattr(queue.get_job(first), "__dict__")
+
+    # first foi consultado por último: o terceiro job desloca second
+    # (verificado direto no store, já que get_job também conta como consulta)
+    third = queue.enqueue("doc", {"email_id": 3, "text": "z"})
+    assert wait_until(lambda: second not in queue.store.jobs)
+    assert first in queue.store.jobs
+    assert wait_until(lambda: queue.get_job(third).data == {"email_id": 3})
+
+
+def test_large_results_spill_to_disk(make_queue, tmp_path):
+    """Resultados acima do limite ficam em disco e são lidos sob demanda."""
+    spill = ResultSpill(str(tmp_path), threshold=100)
+    queue = make_queue(num_workers=1, store=MemoryJobStore(spill=spill), result_ttl=0.3)
+    queue.register_job_type("echo", lambda data: data)
+
+    small = queue.enqueue("echo", {"text": "curto"})
+    large = queue.enqueue("echo", {"text": "x" * 500})
+    assert wait_until(lambda: queue.get_job(large).result_path is not None)
+
+    job = queue.get_job(large)
+    assert job._result is None
+    assert job.result == {"text": "x" * 500}
+    assert job.to_dict()["has_result"] is True
+    assert queue.get_job(small).result_path is None
+    assert [p.name for p in tmp_path.iterdir()] == [f"{large}.json"]
+
+    # A retenção apaga o arquivo junto com o job
+    assert wait_until(lambda: queue.get_job(large) is None)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_shutdown_drains_and_snapshot_is_restored(make_queue, tmp_path):
+    """O desligamento termina o job em andamento e grava a fila; a próxima instância a retoma."""
+    queue = make_queue(num_workers=1, snapshot_dir=str(tmp_path))
+    started = threading.Event()
+
+    def slow(data):
+        started.set()
+        time.sleep(0.2)
+        return data["n"]
+
+    queue.register_job_type("slow", slow)
+    running = queue.enqueue("slow", {"n": 0})
+    assert started.wait(5)
+    waiting = [queue.enqueue("slow", {"n": n}, client_key="10.0.0.1") for n in (1, 2)]
+
+    assert queue.shutdown(timeout=5) == 2
+    assert queue.get_job(running).status == JobStatus.COMPLETED
+    assert len(list(tmp_path.glob("queue-*.json"))) == 1
+
+    restored = make_queue(num_workers=1, snapshot_dir=str(tmp_path))
+    restored.register_job_type("slow", lambda data: data["n"])
+    assert restored.restore_snapshot() == 2
+    assert restored.restore_snapshot() == 0
+    assert list(tmp_path.iterdir()) == []
+    assert wait_until(lambda: all(restored.get_job(j).status == JobStatus.COMPLETED for j in waiting))
+    assert [restored.get_job(j).result for j in waiting] == [1, 2]
+    assert restored.get_job(waiting[0]).client_key == "10.0.0.1"
+
+
+def test_shutdown_returns_reservations_of_jobs_written_to_the_snapshot(make_queue, tmp_path):
+    """Jobs esperando o rate limiter vão para o snapshot sem reserva, e as vagas voltam ao limiter."""
+    queue = make_queue(num_workers=1, snapshot_dir=str(tmp_path))
+    limiter = RateLimiter(requests_per_minute=1, requests_per_day=100000, name="test")
+    limiter.add_request()
+    queue.register_job_type("remote", lambda data: "ok", rate_limiter=limiter, reserve_rate=True)
+
+    job_id = queue.enqueue("remote", {})
+    assert wait_until(lambda: queue.get_job(job_id).rate_reserved == 1)
+    assert limiter.get_stats()["day_usage"] == 2
+
+    assert queue.shutdown(timeout=0.2) == 1
+    assert queue.get_job(job_id).rate_reserved == 0
+    stats = limiter.get_stats()
+    assert stats["day_usage"] == 1 and stats["minute_usage"] == 1
+
+
+def test_identical_jobs_coalesce_into_one_handler_call(make_queue):
+    """Jobs com o mesmo conteúdo em andamento compartilham uma única execução."""
+    queue = make_queue(num_workers=2)
+    release = threading.Event()
+    calls, shared = [], []
+
+    def handler(data):
+        calls.append(data["email_id"])
+        release.wait(5)
+        return {"category": "productive"}
+
+    def share_result(data, result):
+        shared.append(data["email_id"])
+        return dict(result, email_id=data["email_id"])
+
+    queue.register_job_type("process_email_complete", handler,
+                            coalesce_key=lambda data: data["content"], share_result=share_result)
+
+    leader_id = queue.enqueue("process_email_complete", {"content": "oi", "email_id": 1})
+    follower_ids = [queue.enqueue("process_email_complete", {"content": "oi", "email_id": n}) for n in (2, 3)]
+    other_id = queue.enqueue("process_email_complete", {"content": "outro", "email_id": 4})
+
+    assert queue.get_job(follower_ids[0]).to_dict()["coalesced_with"] == leader_id
+    release.set()
+
+    job_ids = [leader_id, other_id] + follower_ids
+    assert wait_until(lambda: all(queue.get_job(j).status == JobStatus.COMPLETED for j in job_ids))
+    assert sorted(calls) == [1, 4]
+    assert sorted(shared) == [2, 3]
+    assert queue.get_job(follower_ids[1]).result == {"category": "productive", "email_id": 3}
+
+    # Depois que o líder termina, o mesmo conteúdo volta a ser processado
+    again_id = queue.enqueue("process_email_complete", {"content": "oi", "email_id": 5})
+    assert wait_until(lambda: queue.get_job(again_id).status == JobStatus.COMPLETED)
+    assert queue.get_job(again_id).leader_id is None
+
+
+def test_cancel_withdraws_waiting_jobs_and_stops_running_job(make_queue):
+    """Jobs na fila saem na hora; o job em processamento para na próxima etapa."""
+    queue = make_queue(num_workers=1)
+    started, release = threading.Event(), threading.Event()
+    suggested, cancelled = [], []
+
+    def handler(data):
+        started.set()
+        release.wait(5)
+        queue.raise_if_cancelled()
+        suggested.append(data["n"])
+        return data["n"]
+
+    queue.register_job_type("email", handler, coalesce_key=lambda data: data["content"],
+                            on_cancel=lambda job: cancelled.append(job.data["n"]))
+
+    running_id = queue.enqueue("email", {"content": "a", "n": 1})
+    assert started.wait(5)
+    queued_id = queue.enqueue("email", {"content": "b", "n": 2})
+    follower_id = queue.enqueue("email", {"content": "b", "n": 3})
+    assert queue.get_job(follower_id).leader_id == queued_id
+
+    assert queue.cancel(queued_id).status == JobStatus.CANCELLED
+    # O seguidor foi enviado por outra requisição: volta para a fila por conta própria
+    assert queue.get_job(follower_id).leader_id is None
+    assert queue.store.queue_length() == 1
+
+    running = queue.cancel(running_id)
+    assert running.status == JobStatus.PROCESSING and running.cancel_requested
+    release.set()
+
+    assert wait_until(lambda: queue.get_job(follower_id).status == JobStatus.COMPLETED)
+    assert queue.get_job(running_id).status == JobStatus.CANCELLED
+    assert suggested == [3]
+    assert wait_until(lambda: cancelled == [2, 1])
+    assert queue.cancel(follower_id).status == JobStatus.COMPLETED
+
+
+def test_next_stage_runs_as_independent_job_and_cancel_follows_pipeline(make_queue):
+    """Cada estágio concluído enfileira o próximo, inclusive para seguidores, e o cancelamento segue o pipeline."""
+    queue = make_queue(num_workers=4)
+    classify_gate, respond_gate = threading.Event(), threading.Event()
+    responded = []
+
+    def classify(data):
+        classify_gate.wait(5)
+        return "productive"
+
+    def respond(data):
+        respond_gate.wait(5)
+        queue.raise_if_cancelled()
+        responded.append(data["email"])
+
+    queue.register_job_type("classify", classify, coalesce_key=lambda data: data["content"],
+                            next_stage=lambda job, result: queue.enqueue(
+                                "respond", {"email": job.data["email"], "category": result}))
+    queue.register_job_type("respond", respond)
+
+    first = queue.enqueue("classify", {"email": 1, "content": "x"})
+    second = queue.enqueue("classify", {"email": 2, "content": "x"})  # agrupado ao primeiro
+    classify_gate.set()
+    assert wait_until(lambda: all(queue.get_job(j).next_job_id for j in (first, second)))
+
+    # A categoria já está pronta enquanto as respostas ainda estão em andamento
+    stages = [queue.get_job(j).next_job_id for j in (first, second)]
+    assert stages[0] != stages[1]
+    assert all(queue.get_job(j).status == JobStatus.COMPLETED for j in (first, second))
+    assert all(queue.get_job(j).status not in JobStatus.FINISHED for j in stages)
+
+    # Cancelar um estágio já concluído cancela o restante do pipeline
+    assert queue.cancel(second).id == stages[1]
+    respond_gate.set()
+    assert wait_until(lambda: all(queue.get_job(j).status in JobStatus.FINISHED for j in stages))
+    assert queue.get_job(stages[0]).status == JobStatus.COMPLETED
+    assert queue.get_job(stages[1]).status == JobStatus.CANCELLED
+    assert responded == [1]
+
+
+def test_batch_handler_groups_queued_jobs(make_queue):
+    """Jobs do mesmo tipo são agrupados em lotes de até max_batch_size."""
+    queue = make_queue(num_workers=1)
+    release = threading.Event()
+    batches = []
+
+    def batch_handler(items):
+        batches.append([item["n"] for item in items])
+        return [{"double": item["n"] * 2} for item in items]
+
+    queue.register_job_type("blocker", lambda data: release.wait(5))
+    queue.register_job_type("classify_email", lambda data: {"double": data["n"] * 2},
+                            batch_handler=batch_handler, max_batch_size=3, batch_linger=0.2)
+
+    queue.enqueue("blocker", {})
+    job_ids = [queue.enqueue("classify_email", {"n": n}) for n in range(5)]
+    release.set()
+
+    assert wait_until(lambda: all(queue.get_job(j).status == JobStatus.COMPLETED for j in job_ids))
+    assert batches == [[0, 1, 2], [3, 4]]
+    assert [queue.get_job(j).result["double"] for j in job_ids] == [0, 2, 4, 6, 8]
+
+
+def test_cancelling_the_first_job_of_a_parked_batch_returns_only_its_share(make_queue):
+    """A reserva de um lote esperando o rate limiter é dividida entre os jobs: cancelar batch[0] devolve só a parte dele."""
+    queue = make_queue(num_workers=1)
+    release = threading.Event()
+    limiter = RateLimiter(requests_per_minute=1, requests_per_day=100000, name="test", tokens_per_minute=6000)
+    limiter.add_request()
+    queue.register_job_type("blocker", lambda data: release.wait(5))
+    queue.register_job_type("classify_email", lambda data: "ok", batch_handler=lambda items: ["ok"] * len(items),
+                            max_batch_size=3, rate_limiter=limiter, reserve_rate=True, rate_cost=0.5,
+                            rate_tokens=lambda data: data["tokens"])
+
+    queue.enqueue("blocker", {})
+    job_ids = [queue.enqueue("classify_email", {"tokens": 100 * (n + 1)}) for n in range(3)]
+    release.set()
+    assert wait_until(lambda: all(queue.get_job(j).to_dict()["rate_limited_until"] for j in job_ids))
+
+    # Três jobs a meia chamada: duas chamadas, com os tokens de cada job
+    jobs = [queue.get_job(j) for j in job_ids]
+    assert [job.rate_reserved for job in jobs] == [1, 0, 1]
+    assert [job.rate_reserved_tokens for job in jobs] == [100, 200, 300]
+    assert limiter.get_stats()["day_usage"] == 3
+
+    queue.cancel(job_ids[0])
+    assert [job.rate_reserved for job in jobs[1:]] == [0, 1]
+    assert [job.rate_reserved_tokens for job in jobs[1:]] == [200, 300]
+    stats = limiter.get_stats()
+    assert stats["day_usage"] == 2 and stats["token_minute_usage"] == pytest.approx(500, abs=20)  # o balde escoa 100 tokens/s
+
+
+def test_async_batch_handler_runs_on_event_loop_without_holding_the_worker(make_queue):
+    """Um batch_handler assíncrono roda no event loop: o único worker segue com outros jobs enquanto o lote espera."""
+    queue = make_queue(num_workers=1)
+    release, finish = threading.Event(), threading.Event()
+    batches = []
+
+    async def handler(data):
+        return {"double": data["n"] * 2}
+
+    async def batch_handler(items):
+        batches.append([item["n"] for item in items])
+        await asyncio.to_thread(finish.wait, 5)
+        return [{"double": item["n"] * 2} for item in items]
+
+    queue.register_job_type("blocker", lambda data: release.wait(5))
+    queue.register_job_type("classify_email", handler, batch_handler=batch_handler, max_batch_size=3)
+    queue.register_job_type("local", lambda data: "local")
+
+    blocker_id = queue.enqueue("blocker", {})
+    job_ids = [queue.enqueue("classify_email", {"n": n}) for n in range(3)]
+    assert wait_until(lambda: queue.get_job(blocker_id).status == JobStatus.PROCESSING)
+    release.set()
+
+    assert wait_until(lambda: batches == [[0, 1, 2]])
+    local_id = queue.enqueue("local", {})
+    assert wait_until(lambda: queue.get_job(local_id).status == JobStatus.COMPLETED, timeout=1.0)
+    assert queue.get_job(job_ids[0]).status == JobStatus.PROCESSING
+
+    finish.set()
+    assert wait_until(lambda: all(queue.get_job(j).status == JobStatus.COMPLETED for j in job_ids))
+    assert [queue.get_job(j).result["double"] for j in job_ids] == [0, 2, 4]
+    assert queue.async_in_flight == 0
+
+
+def test_batch_waits_for_late_jobs_within_linger(make_queue):
+    """Um job que chega dentro da janela entra no lote já iniciado."""
+    queue = make_queue(num_workers=2)
+    batches = []
+    queue.register_job_type("classify_email", lambda data: data["n"],
+                            batch_handler=lambda items: batches.append(len(items)) or [i["n"] for i in items],
+                            max_batch_size=10, batch_linger=0.3)
+
+    first = queue.enqueue("classify_email", {"n": 1})
+    time.sleep(0.1)
+    second = queue.enqueue("classify_email", {"n": 2})
+
+    assert wait_until(lambda: queue.get_job(second).status == JobStatus.COMPLETED)
+    assert queue.get_job(first).result == 1
+    assert batches == [2]
+
+
+def test_transient_failures_are_retried_with_backoff(make_queue):
+    """Falhas temporárias voltam para a fila após o backoff, sem prender o worker."""
+    queue = make_queue(num_workers=1)
+    attempts, other = [], []
+
+    def flaky(data):
+        attempts.append(time.monotonic())
+        if len(attempts) < 3:
+            raise RetryableJobError("API indisponível")
+        return "ok"
+
+    queue.register_job_type("flaky", flaky, retry_policy=RetryPolicy(max_attempts=3, base_delay=0.2))
+    queue.register_job_type("other", lambda data: other.append(data))
+
+    job_id = queue.enqueue("flaky", {})
+    assert wait_until(lambda: len(attempts) == 1)
+
+    # Durante o backoff o único worker continua livre para outros jobs
+    queue.enqueue("other", {"n": 1})
+    assert wait_until(lambda: other == [{"n": 1}], timeout=0.1)
+
+    assert wait_until(lambda: queue.get_job(job_id).status == JobStatus.COMPLETED)
+    job = queue.get_job(job_id)
+    assert job.attempts == 3 and job.result == "ok"
+    assert attempts[1] - attempts[0] >= 0.1
+    assert queue.get_dead_letters() == []
+
+
+def test_exhausted_jobs_go_to_dead_letter_and_can_be_retried(make_queue):
+    """Jobs que esgotam as tentativas vão para a dead-letter e podem voltar à fila."""
+    queue = make_queue(num_workers=1, result_ttl=0.2)
+    healthy = threading.Event()
+    dead = []
+
+    def handler(data):
+        if not healthy.is_set():
+            raise RetryableJobError("API indisponível")
+        return "ok"
+
+    queue.register_job_type("flaky", handler, on_dead_letter=dead.append,
+                            retry_policy=RetryPolicy(max_attempts=2, base_delay=0.05))
+    queue.register_job_type("strict", lambda data: 1 / 0)
+
+    job_id = queue.enqueue("flaky", {})
+    strict_id = queue.enqueue("strict", {})
+    assert wait_until(lambda: [j.id for j in dead] == [job_id])
+
+    # Sobrevive à retenção normal; tipos sem política apenas falham
+    time.sleep(0.4)
+    assert [j.id for j in queue.get_dead_letters()] == [job_id]
+    assert queue.get_job(job_id).to_dict()["attempts"] == 2
+    assert queue.get_job(strict_id) is None
+
+    healthy.set()
+    assert queue.retry_dead_letter(job_id).status == JobStatus.QUEUED
+    assert queue.retry_dead_letter(job_id) is None
+    assert wait_until(lambda: queue.get_job(job_id).status == JobStatus.COMPLETED)
+    assert queue.get_dead_letters() == []
+
+
+def test_watch_streams_status_changes_for_several_jobs(make_queue):
+    """watch entrega cada mudança de status assim que ela acontece, sem polling."""
+    queue = make_queue(num_workers=1)
+    release = threading.Event()
+    queue.register_job_type("slow", lambda data: release.wait(5) and data["n"])
+
+    first = queue.enqueue("slow", {"n": 1})
+    second = queue.enqueue("slow", {"n": 2})
+    events = []
+
+    def consume():
+        for update in queue.watch([first, second, "desconhecido"], timeout=5, heartbeat=0.05):
+            if update is not None:
+                job_id, job = update
+                events.append((job_id, job.status if job else None, time.monotonic()))
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    assert wait_until(lambda: (first, JobStatus.PROCESSING) in [e[:2] for e in events])
+
+    released_at = time.monotonic()
+    release.set()
+    consumer.join(5)
+
+    statuses = {job_id: [status for j, status, _ in events if j == job_id] for job_id in (first, second)}
+    assert statuses[first][-2:] == [JobStatus.PROCESSING, JobStatus.COMPLETED]
+    # Mudanças muito próximas são entregues pelo estado mais recente
+    assert statuses[second][0] == JobStatus.QUEUED and statuses[second][-1] == JobStatus.COMPLETED
+    assert ("desconhecido", None) in [e[:2] for e in events]
+    assert max(t for _, _, t in events) - released_at < 0.5
+    assert queue.subscriptions == {}
+
+
+def test_wait_for_change_returns_on_transition_or_timeout(make_queue):
+    """O long-poll retorna na mudança de status ou ao fim da espera."""
+    queue = make_queue(num_workers=1)
+    release = threading.Event()
+    queue.register_job_type("slow", lambda data: release.wait(5))
+    job_id = queue.enqueue("slow", {})
+    assert wait_until(lambda: queue.get_job(job_id).status == JobStatus.PROCESSING)
+
+    t0 = time.monotonic()
+    assert queue.wait_for_change(job_id, JobStatus.PROCESSING, timeout=0.2).status == JobStatus.PROCESSING
+    assert time.monotonic() - t0 >= 0.2
+
+    threading.Timer(0.1, release.set).start()
+    assert queue.wait_for_change(job_id, JobStatus.PROCESSING, timeout=5).status == JobStatus.COMPLETED
@@ -0,0 +1,229 @@
+import asyncio
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from classifier.rate_limiter import RateLimiter, SQLiteLimiterState, using_reservation
+
+
+def test_reserve_returns_the_first_free_slot_of_the_window():
+    """Reservas ocupam a janela do minuto: além do limite, a vaga abre 60s depois da mais antiga."""
+    limiter = RateLimiter(requests_per_minute=2, requests_per_day=100000, name="test")
+    now = time.time()
+    first, second = limiter.reserve(), limiter.reserve()
+    assert first == pytest.approx(now, abs=0.5) and second == pytest.approx(now, abs=0.5)
+    assert limiter.reserve(2) == pytest.approx(second + 60)
+    assert limiter.can_make_request()[0] is False
+    assert limiter.get_stats()["minute_usage"] == 4
+
+
+def test_gcra_limiter_admits_exactly_the_burst_from_many_threads():
+    """O balde aceita rajadas de requests_per_minute entre threads concorrentes e depois uma a cada 60/limite segundos."""
+    limiter = RateLimiter(requests_per_minute=50, requests_per_day=100000, name="test")
+    admitted = []
+
+    def hammer():
+        for _ in range(20):
+            admitted.append(limiter.try_acquire()[0])
+
+    threads = [threading.Thread(target=hammer) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(admitted) == 50
+    can_request, wait_time = limiter.can_make_request()
+    assert not can_request and wait_time == 1  # a próxima vaga abre em 60/50 = 1,2s
+    stats = limiter.get_stats()
+    assert stats["minute_usage"] == 50 and stats["day_usage"] == 50
+    assert limiter.seconds_until_capacity(5) == pytest.approx(6.0, abs=0.1)
+
+
+def test_token_budget_paces_large_prompts_and_reconciles_actual_usage():
+    """Com tokens_per_minute, um prompt grande espera a cota de tokens mesmo com requisições livres, e o uso real acerta o balde."""
+    limiter = RateLimiter(requests_per_minute=100, requests_per_day=100000, name="test", tokens_per_minute=6000)
+
+    assert limiter.try_acquire(tokens=5000)[0]
+    can_request, wait_time = limiter.try_acquire(tokens=2000)
+    assert not can_request and wait_time in (9, 10)  # faltam 1000 tokens, liberados a 100/s
+    assert limiter.try_acquire(tokens=500)[0]
+    assert limiter.get_stats()["token_minute_usage"] == pytest.approx(5500, abs=5)
+
+    # A API informou menos tokens do que a estimativa: a sobra volta para o balde
+    limiter.reconcile_tokens(5000, 3000)
+    assert limiter.try_acquire(tokens=2000)[0]
+    assert limiter.get_stats()["minute_usage"] == 3
+
+    # Um prompt maior que a cota inteira passa quando o balde está vazio
+    empty = RateLimiter(requests_per_minute=100, requests_per_day=100000, name="test", tokens_per_minute=6000)
+    assert empty.try_acquire(tokens=20000)[0]
+    assert not empty.try_acquire(tokens=1)[0]
+
+
+def test_adaptive_limiter_raises_rate_on_success_and_cuts_it_on_throttling():
+    """No modo adaptativo a taxa sobe aos poucos com sucessos, cai pela metade no 429 (uma vez por rajada) e cai menos em picos de latência."""
+    limiter = RateLimiter(requests_per_minute=20, requests_per_day=100000, name="test",
+                          adaptive=True, min_requests_per_minute=5, max_requests_per_minute=30)
+
+    for _ in range(20):
+        limiter.report_success(1.0)
+    assert 20.9 < limiter.get_stats()["effective_rate"] < 21.0  # +1 req/min por minuto cheio de sucessos
+
+    limiter.report_throttled()
+    limiter.report_throttled()  # 429 de chamadas já em voo não cortam de novo
+    stats = limiter.get_stats()
+    assert stats["effective_rate"] == pytest.approx(10.5, abs=0.05) and stats["minute_limit"] == 10
+
+    limiter.state.decreased_at = None
+    limiter.report_success(5.0)  # 5x a latência média
+    assert limiter.get_stats()["effective_rate"] == pytest.approx(8.4, abs=0.05)
+
+    for _ in range(5):
+        limiter.state.decreased_at = None
+        limiter.report_throttled()
+    assert limiter.get_stats()["effective_rate"] == 5  # nunca abaixo do mínimo
+
+    fixed = RateLimiter(requests_per_minute=20, requests_per_day=100000, name="test")
+    fixed.report_throttled()
+    assert fixed.get_stats()["effective_rate"] == 20 and not fixed.get_stats()["adaptive"]
+
+
+def test_report_response_reconciles_tokens_and_adapts_the_rate_in_one_transaction():
+    """report_response acerta os tokens e ajusta a taxa numa só transação e devolve o uso para o log."""
+    limiter = RateLimiter(requests_per_minute=20, requests_per_day=100000, name="test",
+                          tokens_per_minute=6000, adaptive=True, max_requests_per_minute=30)
+    limiter.add_request(tokens=5000)
+    transactions = []
+    transaction = limiter.state.transaction
+
+    def counting_transaction():
+        transactions.append(1)
+        return transaction()
+
+    limiter.state.transaction = counting_transaction
+    stats = limiter.report_response(1.0, estimated_tokens=5000, actual_tokens=3000, total_tokens=3500)
+
+    assert len(transactions) == 1
+    assert stats["day_usage"] == 1
+    assert stats["token_minute_usage"] == pytest.approx(3000, abs=5)
+    assert limiter.requests_per_minute > 20
+
+
+def test_capacity_classes_keep_part_of_the_minute_for_higher_classes():
+    """Classes abaixo só ocupam o que sobra da parte reservada às de cima; a classe mais alta pode usar o minuto inteiro."""
+    limiter = RateLimiter(requests_per_minute=10, requests_per_day=100000, name="test",
+                          capacity_classes={"classify": 0.3, "response": 0.2})
+
+    assert sum(limiter.try_acquire(capacity_class="document")[0] for _ in range(10)) == 5
+    assert sum(limiter.try_acquire(capacity_class="response")[0] for _ in range(10)) == 2
+    assert sum(limiter.try_acquire(capacity_class="classify")[0] for _ in range(10)) == 3
+    assert limiter.get_stats()["minute_usage"] == 10
+
+    # Reservas e estimativas também respeitam a parte da classe; a reserva que espera não ocupa o balde
+    assert limiter.reserve(1, "document") - time.time() == pytest.approx(36, abs=0.5)
+    assert limiter.seconds_until_capacity(1, "classify") == pytest.approx(6, abs=0.5)
+
+    with pytest.raises(ValueError):
+        RateLimiter(requests_per_minute=10, name="test", capacity_classes={"classify": 0.6, "response": 0.4})
+
+
+def test_waiting_reservations_of_lower_classes_do_not_starve_higher_classes():
+    """Uma classe abaixo só ocupa o balde com reservas que cabem agora; as demais esperam na fila da classe, sem atrasar as classes acima."""
+    limiter = RateLimiter(requests_per_minute=20, requests_per_day=100000, name="test",
+                          capacity_classes={"classify": 0.3, "response": 0.2})
+
+    slots = [limiter.try_reserve(1, "document") for _ in range(60)]
+    assert sum(reserved for _, reserved, _ in slots) == 10  # os 30s do minuto que cabem a document
+    waiting = [slot for slot, reserved, _ in slots if not reserved]
+    assert waiting[0] - time.time() == pytest.approx(3, abs=0.5)
+    assert waiting[-1] - waiting[-2] == pytest.approx(3, abs=0.05)  # uma vez a cada 60/20 s
+
+    assert limiter.can_make_request(capacity_class="classify") == (True, 0)
+    assert limiter.get_stats()["minute_usage"] == 10
+    # A classe mais alta ainda reserva vagas futuras, que as de baixo respeitam
+    assert all(limiter.try_reserve(1, "classify")[1] for _ in range(12))
+    assert not limiter.try_reserve(1, "document")[1]
+
+
+def _acquire_from_process(path, results):
+    limiter = RateLimiter(requests_per_minute=30, requests_per_day=100000, name="gemini",
+                          state=SQLiteLimiterState("gemini", path))
+    results.put(sum(limiter.try_acquire()[0] for _ in range(20)))
+
+
+def test_shared_limiter_state_enforces_one_budget_across_processes(tmp_path):
+    """Processos com o estado no mesmo arquivo SQLite dividem uma única cota, e get_stats mostra o uso somado."""
+    path = str(tmp_path / "rate_limits.sqlite3")
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [context.Process(target=_acquire_from_process, args=(path, results)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    admitted = sum(results.get(timeout=30) for _ in processes)
+    for process in processes:
+        process.join()
+
+    assert admitted == 30
+    limiter = RateLimiter(requests_per_minute=30, requests_per_day=100000, name="gemini",
+                          state=SQLiteLimiterState("gemini", path))
+    stats = limiter.get_stats()
+    assert stats["shared"] and stats["minute_usage"] == 30 and stats["day_usage"] == 30
+    assert not limiter.try_acquire()[0]
+
+
+def test_async_wait_runs_the_state_transaction_off_the_event_loop():
+    """wait_if_needed_async faz a transação do estado (que pode esperar o lock do SQLite) fora da thread do event loop."""
+    limiter = RateLimiter(requests_per_minute=10, requests_per_day=100000, name="test")
+    acquire = limiter.try_acquire
+    threads = []
+
+    def recording_acquire(*args):
+        threads.append(threading.get_ident())
+        return acquire(*args)
+
+    limiter.try_acquire = recording_acquire
+
+    async def wait():
+        return await limiter.wait_if_needed_async(), threading.get_ident()
+
+    admitted, loop_thread = asyncio.run(wait())
+    assert admitted and threads and loop_thread not in threads
+    assert limiter.get_stats()["minute_usage"] == 1
+
+
+def test_reserve_books_tokens_and_the_reserved_call_does_not_pay_them_again():
+    """reserve(tokens=...) também ocupa o balde de tokens: a vaga abre quando os tokens cabem, e wait_if_needed com a reserva não cobra de novo."""
+    limiter = RateLimiter(requests_per_minute=100, requests_per_day=100000, name="test", tokens_per_minute=6000)
+    assert limiter.try_acquire(tokens=6000)[0]
+
+    slot = limiter.reserve(1, tokens=1000)
+    assert slot - time.time() == pytest.approx(10, abs=0.5)  # 1000 tokens liberados a 100/s
+    assert limiter.get_stats()["token_minute_usage"] == pytest.approx(7000, abs=5)
+
+    with using_reservation(limiter, 1, 1000):
+        started = time.time()
+        assert limiter.wait_if_needed(tokens=1000)
+        assert time.time() - started < 0.1
+    assert limiter.get_stats()["minute_usage"] == 2
+
+    limiter.release(0, 1000)
+    assert limiter.get_stats()["token_minute_usage"] == pytest.approx(6000, abs=5)
+
+
+def test_release_returns_the_seconds_booked_even_after_the_rate_changes():
+    """release com os segundos de try_reserve devolve exatamente o que foi reservado, mesmo depois de o AIMD mudar a taxa."""
+    limiter = RateLimiter(requests_per_minute=20, requests_per_day=100000, name="test", adaptive=True)
+    limiter.add_request()
+    tat = limiter.state.tat
+
+    _, reserved, seconds = limiter.try_reserve(2)
+    assert reserved and seconds == pytest.approx(6.0)  # 2 x 60/20 s
+    limiter.report_throttled()  # a taxa cai pela metade: cada requisição passa a valer 6s
+    assert limiter.interval == pytest.approx(6.0)
+
+    limiter.release(2, seconds=seconds)
+    assert limiter.state.tat == pytest.approx(tat)
+    assert limiter.get_stats()["day_usage"] == 1
@@ -11,5 +11,9 @@ urlpatterns = [
     path('api/emails/', views.api_emails_list, name='api_emails_list'),
     path('api/emails/<int:pk>/', views.api_email_detail, name='api_email_detail'),
     path('api/usage/', views.api_usage, name='api_usage'),
+    path('api/jobs/events/', views.api_jobs_events, name='api_jobs_events'),
+    path('api/jobs/dead-letter/', views.api_dead_letter_jobs, name='api_dead_letter_jobs'),
+    path('api/jobs/dead-letter/<str:job_id>/retry/', views.api_retry_dead_letter, name='api_retry_dead_letter'),
     path('api/jobs/<str:job_id>/', views.api_job_status, name='api_job_status'),
+    path('api/jobs/<str:job_id>/events/', views.api_job_events, name='api_job_events'),
 ]
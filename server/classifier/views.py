@@ -4,19 +4,28 @@ from django.views.generic import ListView, DetailView
 import logging
 import sys
 import os
+import json
+import uuid
+import threading
 from datetime import datetime
 from django.conf import settings
 import django
 from .models import Email
 from .forms import EmailForm
 from .utils import extract_text_from_file
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from .ai_service import process_email, queue_email_processing, queue_complete_email_processing, gemini_limiter, job_queue
+from .ai_service import (process_email, queue_email_processing, queue_complete_email_processing, gemini_limiter,
+                         job_queue, RESPONSE_PENDING)
 from .job_queue import JobStatus
 
 logger = logging.getLogger(__name__)
 
+# Controle de admissão: emails enviados pela API que só começariam a ser processados
+# depois disso (em segundos) são recusados com 429 e Retry-After, em vez de ficarem
+# pendentes por horas ou expirarem na fila (EMAIL_JOB_TTL é de 1 hora)
+EMAIL_ADMISSION_MAX_WAIT = float(os.getenv('EMAIL_ADMISSION_MAX_WAIT', 900))
+
 def get_client_ip(request):
     """Obtém o IP real do cliente de forma mais robusta"""
     ip_headers = [
@@ -359,6 +368,7 @@ def _add_cors_headers(response, origin=None):
     response["Access-Control-Allow-Methods"] = "GET, POST, PUT, PATCH, DELETE, OPTIONS"
     response["Access-Control-Allow-Headers"] = "Content-Type, X-Requested-With, Accept, Authorization, X-CSRFToken"
     response["Access-Control-Allow-Credentials"] = "true"
+    response["Access-Control-Expose-Headers"] = "Retry-After"
 
 def api_usage(request):
     """
@@ -370,9 +380,13 @@ def api_usage(request):
         logger.info(f"API usage chamado, origem: {origin}")
 
         # Obter estatísticas dos rate limiters
+        document_stats = None
         try:
-            from .ai_service import gemini_limiter
+            from .ai_service import gemini_limiter, document_limiter
             gemini_stats = gemini_limiter.get_stats()
+            # O document_model só tem estatísticas próprias com GEMINI_DOCUMENT_LIMITER
+            if document_limiter is not gemini_limiter:
+                document_stats = document_limiter.get_stats()
         except Exception as e:
             logger.error(f"Erro ao obter estatísticas do Gemini: {e}")
             gemini_stats = {
@@ -413,6 +427,8 @@ def api_usage(request):
                 "origin": origin
             }
         }
+        if document_stats:
+            data["gemini_document_api"] = document_stats
 
         response = JsonResponse(data)
         logger.info("✅ API usage response enviada com sucesso")
@@ -440,6 +456,18 @@ def api_submit_email(request):
     origin = request.headers.get('origin', request.META.get('HTTP_ORIGIN', 'desconhecida'))
     logger.info(f"API submit email chamado | Origin: {origin}")
 
+    # Recusa antes de ler o formulário e salvar o email: com a fila acima do que a vazão
+    # medida e a cota do Gemini atendem a tempo, o email ficaria pendente por horas
+    retry_after = job_queue.admission_delay("process_email_complete", EMAIL_ADMISSION_MAX_WAIT)
+    if retry_after is not None:
+        response = JsonResponse({
+            'status': 'error',
+            'message': 'Fila de processamento cheia. Tente novamente mais tarde.',
+            'retry_after': retry_after
+        }, status=429)
+        response['Retry-After'] = str(retry_after)
+        return response
+
     try:
         # Obter IP do usuário para API
         user_ip = get_client_ip(request)
@@ -531,10 +559,13 @@ def _process_valid_form_async(form, is_api=False, user_ip=None):
     email.category = "pending"  # Status temporário até que o job seja concluído
     email.confidence_score = 0.0
     email.suggested_response = "Processando..."
+    email.job_id = str(uuid.uuid4())  # Registrado antes de enfileirar: emails órfãos são detectados pelo job
     email.save()
 
     # Enfileirar para processamento completo com referência ao email
-    job_id = queue_complete_email_processing(email_data, email.pk)
+    # O IP identifica o cliente: envios em massa de um IP não atrasam os demais
+    job_id = queue_complete_email_processing(email_data, email.pk, client_key=email.user_ip,
+                                             job_id=email.job_id)
 
     # Retornar resposta ao cliente
     if is_api:
@@ -547,6 +578,7 @@ def _process_valid_form_async(form, is_api=False, user_ip=None):
             'job_id': job_id,
             'queue_position': queue_status['queue_length'],
             'estimated_wait': queue_status['estimated_wait'],
+            'estimated_wait_p90': queue_status['estimated_wait_p90'],
             'queue_status': queue_status
         })
 
@@ -672,6 +704,8 @@ def api_email_detail(request, pk):
             'sender': email.sender,
             'category': email.category,
             'suggested_response': email.suggested_response,
+            # Já classificado, com o estágio de resposta ainda na fila ou em processamento
+            'response_pending': email.suggested_response == RESPONSE_PENDING,
             'created_at': created_at_str,
             'confidence_score': email.confidence_score
         }
@@ -686,16 +720,68 @@ def api_email_detail(request, pk):
         _add_cors_headers(response, request.headers.get('origin'))
         return response
 
+# Long-poll em api/jobs/<id>/?wait=N: espera máxima por requisição
+JOB_STATUS_MAX_WAIT = 30
+
+# Duração máxima de uma conexão SSE; o EventSource do navegador reconecta sozinho
+JOB_EVENTS_MAX_SECONDS = int(os.getenv('JOB_EVENTS_MAX_SECONDS', 60))
+
+# Cada stream SSE ocupa uma thread do gunicorn (gthread) enquanto está aberto: acima deste
+# limite por processo, novos streams recebem 503 e as threads restantes ficam para a API
+JOB_EVENTS_MAX_STREAMS = int(os.getenv('JOB_EVENTS_MAX_STREAMS', 8))
+_job_event_slots = threading.BoundedSemaphore(JOB_EVENTS_MAX_STREAMS)
+
+def _job_payload(job, user_ip):
+    """Dados de um job para a API, com o email processado quando o job concluiu"""
+    job_data = job.to_dict()
+
+    # Se o job foi concluído e tem resultado, incluir detalhes do email
+    if job.status == JobStatus.COMPLETED and job.has_result:
+        # Verificar se o resultado contém dados de email processado
+        if isinstance(job.result, dict) and 'email_id' in job.data:
+            try:
+                email = Email.objects.filter(pk=job.data['email_id'], user_ip=user_ip).first()
+
+                if email:
+                    job_data['email'] = {
+                        'id': email.id,
+                        'subject': email.subject,
+                        'category': email.category,
+                        'confidence_score': email.confidence_score,
+                        'is_processed': email.category not in ['pending', 'error'],
+                        'response_pending': email.suggested_response == RESPONSE_PENDING
+                    }
+            except Exception as e:
+                logger.error(f"Erro ao obter dados do email para job {job.id}: {e}")
+
+    return job_data
+
+@csrf_exempt
 def api_job_status(request, job_id):
     """
     API para verificar o status de um job específico na fila.
+
+    Com ?wait=N (long-poll), a resposta espera até N segundos por uma mudança
+    em relação ao ?status= informado, em vez de o cliente repetir a consulta.
+    Com DELETE, cancela o job.
     """
+    if request.method == 'DELETE':
+        return _cancel_job(request, job_id)
+
     try:
         origin = request.headers.get('origin', 'desconhecida')
         logger.info(f"API job status chamado para job {job_id}, origem: {origin}")
 
+        try:
+            wait = min(float(request.GET.get('wait', 0)), JOB_STATUS_MAX_WAIT)
+        except ValueError:
+            wait = 0
+
         # Obter o job da fila
-        job = job_queue.get_job(job_id)
+        if wait > 0:
+            job = job_queue.wait_for_change(job_id, request.GET.get('status'), wait)
+        else:
+            job = job_queue.get_job(job_id)
 
         if not job:
             return JsonResponse({
@@ -704,26 +790,7 @@ def api_job_status(request, job_id):
             }, status=404)
 
         # Retornar dados do job
-        job_data = job.to_dict()
-
-        # Se o job foi concluído e tem resultado, incluir detalhes do email
-        if job.status == JobStatus.COMPLETED and job.result:
-            # Verificar se o resultado contém dados de email processado
-            if isinstance(job.result, dict) and 'email_id' in job.data:
-                try:
-                    user_ip = get_client_ip(request)
-                    email = Email.objects.filter(pk=job.data['email_id'], user_ip=user_ip).first()
-
-                    if email:
-                        job_data['email'] = {
-                            'id': email.id,
-                            'subject': email.subject,
-                            'category': email.category,
-                            'confidence_score': email.confidence_score,
-                            'is_processed': email.category not in ['pending', 'error']
-                        }
-                except Exception as e:
-                    logger.error(f"Erro ao obter dados do email para job {job_id}: {e}")
+        job_data = _job_payload(job, get_client_ip(request))
 
         response = JsonResponse(job_data)
         _add_cors_headers(response, request.headers.get('origin'))
@@ -737,3 +804,211 @@ def api_job_status(request, job_id):
         }, status=500)
         _add_cors_headers(response, request.headers.get('origin'))
         return response
+
+def _cancel_job(request, job_id):
+    """
+    Cancela um job: sai da fila na hora se ainda aguarda (200) ou para na próxima
+    etapa se já está em processamento (202). Só o cliente que enfileirou pode cancelar.
+    """
+    try:
+        user_ip = get_client_ip(request)
+        job = job_queue.get_job(job_id)
+
+        if job and not (job.client_key and job.client_key != user_ip):
+            # None se o job foi descartado (retenção) entre a consulta e o cancelamento
+            job = job_queue.cancel(job_id)
+
+        if not job:
+            response = JsonResponse({
+                'status': 'error',
+                'message': f'Job {job_id} não encontrado'
+            }, status=404)
+        elif job.client_key and job.client_key != user_ip:
+            response = JsonResponse({
+                'status': 'error',
+                'message': 'Apenas quem enviou o job pode cancelá-lo'
+            }, status=403)
+        else:
+            job_data = _job_payload(job, user_ip)
+            if job.status == JobStatus.CANCELLED:
+                logger.info(f"Job {job_id} cancelado via API")
+                response = JsonResponse(job_data)
+            elif job.status in JobStatus.FINISHED:
+                job_data['message'] = f'Job já finalizado com status {job.status}'
+                response = JsonResponse(job_data, status=409)
+            else:
+                logger.info(f"Cancelamento do job {job_id} solicitado via API")
+                response = JsonResponse(job_data, status=202)
+
+        _add_cors_headers(response, request.headers.get('origin'))
+        return response
+
+    except Exception as e:
+        logger.error(f"Erro ao cancelar job {job_id}: {str(e)}")
+        response = JsonResponse({
+            'status': 'error',
+            'message': f'Erro interno: {str(e)}'
+        }, status=500)
+        _add_cors_headers(response, request.headers.get('origin'))
+        return response
+
+def _owns_dead_letter(request, job, user_ip):
+    """A dead-letter traz erros e dados dos jobs: só a equipe ou o cliente que enfileirou o job os vê"""
+    user = getattr(request, 'user', None)
+    return bool(user is not None and user.is_staff) or bool(job.client_key and job.client_key == user_ip)
+
+def api_dead_letter_jobs(request):
+    """
+    API para inspecionar os jobs que esgotaram as tentativas (dead-letter).
+    Cada cliente vê só os seus jobs; usuários da equipe (is_staff) veem todos.
+    """
+    try:
+        try:
+            limit = min(int(request.GET.get('limit', 50)), 500)
+        except ValueError:
+            limit = 50
+
+        user_ip = get_client_ip(request)
+        jobs = [job for job in job_queue.get_dead_letters(500) if _owns_dead_letter(request, job, user_ip)][:limit]
+        data = {
+            'count': len(jobs),
+            'jobs': [dict(job.to_dict(), error=job.error) for job in jobs],
+        }
+
+        response = JsonResponse(data)
+        _add_cors_headers(response, request.headers.get('origin'))
+        return response
+
+    except Exception as e:
+        logger.error(f"Erro ao listar dead-letter: {str(e)}")
+        response = JsonResponse({
+            'status': 'error',
+            'message': f'Erro interno: {str(e)}'
+        }, status=500)
+        _add_cors_headers(response, request.headers.get('origin'))
+        return response
+
+@csrf_exempt
+def api_retry_dead_letter(request, job_id):
+    """
+    API para devolver à fila um job da dead-letter. Só o cliente que enfileirou o job
+    (ou um usuário da equipe) pode reprocessá-lo: a nova tentativa gasta a cota do Gemini.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Método não permitido'}, status=405)
+
+    try:
+        job = job_queue.get_job(job_id)
+        if job is not None and job.dead_letter and _owns_dead_letter(request, job, get_client_ip(request)):
+            job = job_queue.retry_dead_letter(job_id)
+        elif job is not None and job.dead_letter:
+            response = JsonResponse({
+                'status': 'error',
+                'message': 'Apenas quem enviou o job pode reprocessá-lo'
+            }, status=403)
+            _add_cors_headers(response, request.headers.get('origin'))
+            return response
+        else:
+            job = None
+
+        if job is None:
+            response = JsonResponse({
+                'status': 'error',
+                'message': f'Job {job_id} não está na dead-letter'
+            }, status=404)
+        else:
+            logger.info(f"Job {job_id} devolvido para a fila via API")
+            response = JsonResponse(job.to_dict())
+
+        _add_cors_headers(response, request.headers.get('origin'))
+        return response
+
+    except Exception as e:
+        logger.error(f"Erro ao reprocessar job {job_id} da dead-letter: {str(e)}")
+        response = JsonResponse({
+            'status': 'error',
+            'message': f'Erro interno: {str(e)}'
+        }, status=500)
+        _add_cors_headers(response, request.headers.get('origin'))
+        return response
+
+def _job_event_stream(job_ids, user_ip):
+    """Gera os eventos SSE das mudanças de status dos jobs"""
+    # O navegador espera 3s antes de reconectar se a conexão cair
+    yield "retry: 3000\n\n"
+
+    for update in job_queue.watch(job_ids, JOB_EVENTS_MAX_SECONDS):
+        if update is None:
+            # Comentário SSE: mantém a conexão viva em proxies
+            yield ": keep-alive\n\n"
+            continue
+
+        job_id, job = update
+        if job is None:
+            payload = {'id': job_id, 'status': 'not_found'}
+        else:
+            payload = _job_payload(job, user_ip)
+        yield f"event: job\ndata: {json.dumps(payload)}\n\n"
+
+    yield "event: end\ndata: {}\n\n"
+
+class _EventStreamSlot:
+    """
+    Conteúdo de um stream SSE que devolve a vaga em _job_event_slots quando o servidor
+    fecha a resposta (fim do stream ou cliente desconectado), mesmo antes do primeiro evento
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.released = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.stream)
+
+    def close(self):
+        self.stream.close()
+        if not self.released:
+            self.released = True
+            _job_event_slots.release()
+
+def _job_event_response(request, job_ids):
+    if not _job_event_slots.acquire(blocking=False):
+        logger.warning(f"Limite de {JOB_EVENTS_MAX_STREAMS} streams SSE atingido; recusando novo stream")
+        response = JsonResponse({
+            'status': 'error',
+            'message': 'Muitos acompanhamentos em tempo real abertos; use GET /api/jobs/<id>/?wait=N',
+            'retry_after': JOB_STATUS_MAX_WAIT
+        }, status=503)
+        response['Retry-After'] = str(JOB_STATUS_MAX_WAIT)
+        _add_cors_headers(response, request.headers.get('origin'))
+        return response
+
+    response = StreamingHttpResponse(
+        _EventStreamSlot(_job_event_stream(job_ids, get_client_ip(request))),
+        content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Desativa buffer em proxies nginx
+    _add_cors_headers(response, request.headers.get('origin'))
+    return response
+
+def api_job_events(request, job_id):
+    """
+    API de Server-Sent Events: envia o status do job a cada mudança
+    (queued, processing, completed...) na mesma conexão, até ele terminar.
+    """
+    logger.info(f"API job events aberto para job {job_id}")
+    return _job_event_response(request, [job_id])
+
+def api_jobs_events(request):
+    """
+    API de Server-Sent Events para vários jobs: /api/jobs/events/?ids=id1,id2
+    """
+    job_ids = [job_id for job_id in request.GET.get('ids', '').split(',') if job_id][:50]
+    if not job_ids:
+        return JsonResponse({'status': 'error', 'message': 'Informe os IDs em ?ids='}, status=400)
+
+    logger.info(f"API job events aberto para {len(job_ids)} job(s)")
+    return _job_event_response(request, job_ids)
@@ -33,6 +33,11 @@ try:
     application = get_wsgi_application()
     logger.info("Aplicação WSGI inicializada com sucesso")
 
+    # Fila de jobs: retoma o que ficou do último desligamento (snapshot e emails
+    # pendentes sem job) e drena a fila no próximo (redeploy, reinício do worker)
+    from classifier.ai_service import resume_interrupted_jobs
+    resume_interrupted_jobs()
+
     # Teste rápido da aplicação
     from django.test import RequestFactory
     from django.urls import reverse
@@ -174,16 +174,18 @@ export CORS_ALLOW_ALL_ORIGINS=True
 export CORS_ORIGIN_WHITELIST=${CORS_ORIGIN_WHITELIST:-"https://email-classifier-ten.vercel.app,http://localhost:3000"}
 
 # Iniciar o servidor com configuração otimizada para Railway
+# Sem --preload: a fila de jobs (threads e snapshot do desligamento) é de cada worker.
+# --graceful-timeout dá aos workers a janela de drenagem da Railway para terminar os jobs
 exec gunicorn email_classifier.wsgi:application \
     --bind 0.0.0.0:${PORT} \
     --workers 3 \
-    --worker-class sync \
-    --worker-connections 1000 \
+    --worker-class gthread \
+    --threads ${GUNICORN_THREADS:-16} \
     --timeout 120 \
     --keep-alive 5 \
     --max-requests 1000 \
     --max-requests-jitter 100 \
-    --preload \
+    --graceful-timeout ${RAILWAY_DEPLOYMENT_DRAINING_SECONDS:-30} \
     --log-level info \
     --access-logfile - \
     --error-logfile - \